@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.conf.urls import url, include
+from django.urls import re_path as url, include
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
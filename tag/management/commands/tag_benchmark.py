@@ -0,0 +1,153 @@
+"""
+benchmark of the tag hierarchy and tagging operations, reporting queries, latency and memory as JSON
+
+Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
+Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.conf import settings
+
+from itertools import product
+
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from ...models.tag import Tag, _Dummy, _QueryCounter, __version__
+
+
+class Command(BaseCommand):
+    """
+    generates a synthetic taxonomy and tag assignments, times the tag operations, and reports as JSON
+
+    NOTES
+    - the taxonomy has `--fanout` root tags, each with `--fanout` children, down to `--depth` levels;
+        each of `--items` `_Dummy` records is tagged with `--tags-per-item` random leaves (`--seed`),
+        so eg `--depth 4 --fanout 10 --items 200000 --tags-per-item 5` gives 11110 tags and a
+        million assignments
+    - everything runs in a single transaction that is rolled back at the end, so the database is
+        left unchanged (and the tag caches are invalidated)
+    - every operation is run once measuring the number of queries and the peak memory allocated (via
+        `tracemalloc`), and then `--repeat` times measuring the latency (in seconds)
+    - the benchmark runs against the default database (eg SQLite, or Postgres where one is configured);
+        the report includes the database vendor, the version of `tag` and the cache settings, so
+        that runs can be compared between versions
+
+    USAGE
+        python3 manage.py tag_benchmark
+        python3 manage.py tag_benchmark --depth 4 --fanout 10 --items 200000 --output bench.json
+    """
+    help = 'benchmark of the tag operations (JSON report)'
+
+    def add_arguments(s, parser):
+        parser.add_argument('--depth', type=int, default=3, help='depth of the taxonomy')
+        parser.add_argument('--fanout', type=int, default=5, help='number of children per tag (and of root tags)')
+        parser.add_argument('--items', type=int, default=1000, help='number of tagged records')
+        parser.add_argument('--tags-per-item', type=int, default=5, help='number of (leaf) tags per record')
+        parser.add_argument('--repeat', type=int, default=20, help='number of timed runs per operation')
+        parser.add_argument('--seed', type=int, default=0, help='seed for the random assignments')
+        parser.add_argument('--output', default=None, help='file for the JSON report (default: stdout)')
+
+    def handle(s, *args, **options):
+        s.rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            try: report = s.run(options)
+            finally: transaction.set_rollback(True)
+        Tag.tags_changed()
+            # the rolled back tags must not remain in the caches
+
+        report = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f: f.write(report + '\n')
+        else: s.stdout.write(report)
+
+    def run(s, options):
+        """creates the data and runs the benchmarks; returns the report"""
+        start = time.perf_counter()
+        leaves, items = s.setup(options)
+        setup_time = time.perf_counter() - start
+
+        roots = sorted({ t.tag.split(Tag.hierarchy_separator)[0] for t in leaves })
+        middle = sorted({ t.tag.rsplit(Tag.hierarchy_separator, 1)[0] for t in leaves })
+        item = items[0]
+        tokens = [ item.tag_token_toggle(tag) for tag in leaves ]
+        view = _Dummy.tag_as_view()
+        factory = RequestFactory()
+        def post(i): return view(factory.post('/', json.dumps({'token': tokens[i % len(tokens)]}), content_type='application/json'))
+
+        benchmarks = [
+            ('Tag.get',             lambda i: Tag.get(leaves[i % len(leaves)].tag)),
+            ('Tag.get_many',        lambda i: Tag.get_many([t.tag for t in leaves[:100]])),
+            ('Tag.family',          lambda i: Tag.get(roots[i % len(roots)]).family),
+            ('Tag.all_leaves',      lambda i: tuple(Tag.all_leaves())),
+            ('Tag.load_tree',       lambda i: Tag.load_tree(refresh=True)),
+            ('tagged_as',           lambda i: len(_Dummy.tagged_as(middle[i % len(middle)], as_queryset=False))),
+            ('tags_fromqs',         lambda i: _Dummy.tags_fromqs(_Dummy.objects.filter(id__in=[x.id for x in items[:100]]))),
+            ('token_create',        lambda i: item.tag_token_toggle(leaves[i % len(leaves)])),
+            ('token_execute',       lambda i: _Dummy.tag_token_execute(tokens[i % len(tokens)])),
+            ('view',                post),
+        ]
+        return {
+            'version':      __version__,
+            'database':     connection.vendor,
+            'caches': {
+                'TAG_CACHE_SIZE':       getattr(settings, 'TAG_CACHE_SIZE', None),
+                'TAG_SHARED_CACHE':     getattr(settings, 'TAG_SHARED_CACHE', None),
+                'TAG_TOKEN_CACHE_SIZE': getattr(settings, 'TAG_TOKEN_CACHE_SIZE', None),
+            },
+            'parameters':   { key: options[key] for key in ('depth', 'fanout', 'items', 'tags_per_item', 'repeat', 'seed') },
+            'setup': {
+                'tags':         Tag.objects.count(),
+                'assignments':  _Dummy._tag_through()[0].objects.count(),
+                'seconds':      setup_time,
+            },
+            'benchmarks':   { name: s.measure(func, options['repeat']) for name, func in benchmarks },
+        }
+
+    def setup(s, options):
+        """creates the taxonomy, the records and the assignments; returns (leaves, items)"""
+        fanout, depth = options['fanout'], options['depth']
+        tagstrs = [ Tag.hierarchy_separator.join('_bench{}'.format(n) if level == 0 else 'l{}'.format(n)
+            for level, n in enumerate(path)) for path in product(range(fanout), repeat=depth) ]
+        tags = Tag.get_many(tagstrs)
+        leaves = [ tags[tagstr] for tagstr in tagstrs ]
+
+        items = _Dummy.objects.bulk_create(
+            [ _Dummy(title='_bench {}'.format(n)) for n in range(options['items']) ], batch_size=Tag.batch_size)
+        if items and items[0].id == None:
+            items = list(_Dummy.objects.filter(title__startswith='_bench ').order_by('id'))
+                # databases that do not return the ids from bulk_create
+
+        per_item = min(options['tags_per_item'], len(leaves))
+        chunk = max(1, 100000 // max(per_item, 1))
+        for n in range(0, len(items), chunk):
+            _Dummy._relations_insert( (item.id, tag.id) for item in items[n:n+chunk] for tag in s.rnd.sample(leaves, per_item) )
+        return leaves, items
+
+    def measure(s, func, repeat):
+        """runs func once counting queries and memory, and `repeat` times timing it"""
+        counter = _QueryCounter()
+        tracemalloc.start()
+        try:
+            with connection.execute_wrapper(counter): func(0)
+            memory = tracemalloc.get_traced_memory()[1]
+        finally: tracemalloc.stop()
+
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func(i)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        return {
+            'queries':      counter.queries,
+            'memory_peak':  memory,
+            'min':          times[0] if times else None,
+            'median':       statistics.median(times) if times else None,
+            'p95':          times[min(len(times) - 1, int(len(times) * 0.95))] if times else None,
+            'mean':         statistics.mean(times) if times else None,
+        }
@@ -0,0 +1,51 @@
+"""
+rebuilds the denormalized tag fields of `DenormalizedTagMixin` models
+
+Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
+Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.apps import apps
+
+from ...models.tag import DenormalizedTagMixin
+
+
+class Command(BaseCommand):
+    """
+    rebuilds the denormalized tag fields (see `DenormalizedTagMixin.tags_denormalize`) in batches
+
+    NOTES
+    - without arguments all models deriving from `DenormalizedTagMixin` are rebuilt
+    - the records are processed in batches of `--batch-size`, in order of their ids; every batch
+        takes three queries (ids, tags, update), and is committed on its own
+
+    USAGE
+        python3 manage.py tag_denormalize
+        python3 manage.py tag_denormalize myapp.MyTaggedClass --batch-size 500
+    """
+    help = 'rebuilds the denormalized tag fields of DenormalizedTagMixin models'
+
+    def add_arguments(s, parser):
+        parser.add_argument('models', nargs='*', help='the models to rebuild (app_label.ModelName)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of records per batch')
+
+    def handle(s, *args, **options):
+        if options['models']:
+            try: models = [ apps.get_model(label) for label in options['models'] ]
+            except (LookupError, ValueError) as e: raise CommandError(str(e))
+            for model in models:
+                if not issubclass(model, DenormalizedTagMixin):
+                    raise CommandError("{} does not derive from DenormalizedTagMixin".format(model._meta.label))
+        else:
+            models = [ model for model in apps.get_models() if issubclass(model, DenormalizedTagMixin) ]
+
+        for model in models:
+            last_id, count = None, 0
+            while True:
+                qs = model.objects.order_by('id')
+                if last_id != None: qs = qs.filter(id__gt=last_id)
+                item_ids = list(qs.values_list('id', flat=True)[:options['batch_size']])
+                if not item_ids: break
+                model.tags_denormalize(item_ids)
+                last_id, count = item_ids[-1], count + len(item_ids)
+            s.stdout.write('{}: {} records'.format(model._meta.label, count))
@@ -0,0 +1,101 @@
+"""
+load test comparing the sync (`tag_as_view`) and async (`tag_as_async_view`) tag API views
+
+Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
+Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory
+
+from asgiref.sync import sync_to_async, ThreadSensitiveContext
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import json
+import time
+
+from ...models.tag import Tag, _Dummy
+
+
+class Command(BaseCommand):
+    """
+    runs the same toggle requests against the sync and the async view, and reports the throughput
+
+    NOTES
+    - the sync view is run by a pool of `--threads` workers (like a WSGI server), the async view
+        with up to `--concurrency` requests in flight (like an ASGI server, every request having
+        its own thread for the ORM calls); each request opens and closes its database connection
+    - `--latency` adds a delay to every query, simulating a database server across the network;
+        without it the queries against a local database are too fast for concurrency to matter
+    - the load test creates (and finally deletes) `_Dummy` records and the `_loadtest` tag (which is
+        kept if it existed before); on SQLite the writes are serialised by the database lock, so the 
+        results are only meaningful for database servers like Postgres
+
+    USAGE
+        python3 manage.py tag_loadtest --requests 500 --threads 4 --concurrency 50 --latency 5
+    """
+    help = 'load test of the sync vs the async tag API view'
+
+    def add_arguments(s, parser):
+        parser.add_argument('--requests', type=int, default=200, help='number of requests per view')
+        parser.add_argument('--threads', type=int, default=4, help='number of threads for the sync view')
+        parser.add_argument('--concurrency', type=int, default=20, help='number of concurrent async requests')
+        parser.add_argument('--latency', type=float, default=0, help='simulated latency per query (ms)')
+
+    def handle(s, *args, **options):
+        n_requests = options['requests']
+        latency = options['latency'] / 1000
+
+        def delay(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def add_delay(sender, connection, **kwargs):
+            if not delay in connection.execute_wrappers: connection.execute_wrappers.append(delay)
+
+        items = [ _Dummy.objects.create(title='_loadtest {}'.format(n)) for n in range(n_requests) ]
+        existing = Tag.get_if_exists('_loadtest')
+        tag = existing or Tag.get('_loadtest')
+        bodies = [ json.dumps({'token': item.tag_token_toggle(tag)}) for item in items ]
+        factory = RequestFactory()
+        if latency:
+            connection_created.connect(add_delay)
+            connection.execute_wrappers.append(delay)
+
+        try:
+            sync_view = _Dummy.tag_as_view()
+            def sync_request(body):
+                try: return json.loads(sync_view(factory.post('/', body, content_type='application/json')).content)
+                finally: connections.close_all()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                results = list(executor.map(sync_request, bodies))
+            s.report('sync', results, time.perf_counter() - start)
+
+            async_view = _Dummy.tag_as_async_view()
+            async def run():
+                semaphore = asyncio.Semaphore(options['concurrency'])
+                async def async_request(body):
+                    async with semaphore:
+                        async with ThreadSensitiveContext():
+                            try: return json.loads((await async_view(factory.post('/', body, content_type='application/json'))).content)
+                            finally: await sync_to_async(connections.close_all)()
+                return await asyncio.gather(*[async_request(body) for body in bodies])
+            start = time.perf_counter()
+            results = asyncio.run(run())
+            s.report('async', results, time.perf_counter() - start)
+
+        finally:
+            if latency:
+                connection_created.disconnect(add_delay)
+                connection.execute_wrappers.remove(delay)
+            _Dummy.objects.filter(id__in=[item.id for item in items]).delete()
+            if existing == None: tag.delete()
+                # only what the load test created is deleted
+
+    def report(s, name, results, seconds):
+        errors = len([r for r in results if not r['success']])
+        s.stdout.write('{:6s} {:6d} requests in {:7.3f}s  {:8.1f} requests/s  {} errors'.format(
+            name, len(results), seconds, len(results) / seconds, errors))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """brings the migration state of the fields created before Django 2.0 in line with the models"""
+
+    dependencies = [
+        ('tag', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='_dummy',
+            name='_tag_references',
+            field=models.ManyToManyField(blank=True, to='tag.Tag'),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='_parent_tag',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='tag.Tag'),
+        ),
+    ]
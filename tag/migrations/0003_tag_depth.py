@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_depth(apps, schema_editor):
+    """computes the depth of all existing tags from their parent links (one update per level)"""
+    Tag = apps.get_model('tag', 'Tag')
+    parents = dict(Tag.objects.values_list('id', '_parent_tag'))
+    depths = {}
+    def depth(tag_id):
+        if tag_id not in depths:
+            parent_id = parents[tag_id]
+            depths[tag_id] = 1 if parent_id is None else depth(parent_id) + 1
+        return depths[tag_id]
+    levels = {}
+    for tag_id in parents: levels.setdefault(depth(tag_id), []).append(tag_id)
+    for level, ids in levels.items(): Tag.objects.filter(id__in=ids).update(_depth=level)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag', '0002_alter_tag_references_parent_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='_depth',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(set_depth, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag', '0004_dummy_tag_references_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='_DenormalizedDummy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('_tags_str', models.TextField(blank=True, default='', editable=False)),
+                ('_tags_ids', models.TextField(blank=True, default=' ', editable=False)),
+                ('title', models.CharField(blank=True, db_index=True, default='', max_length=32, unique=True)),
+                ('_tag_references', models.ManyToManyField(blank=True, to='tag.Tag')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_child_count(apps, schema_editor):
+    """computes the number of direct children of all existing tags (one update per distinct count)"""
+    Tag = apps.get_model('tag', 'Tag')
+    counts = {}
+    for parent_id in Tag.objects.exclude(_parent_tag=None).values_list('_parent_tag', flat=True):
+        counts[parent_id] = counts.get(parent_id, 0) + 1
+    ids_by_count = {}
+    for tag_id, count in counts.items(): ids_by_count.setdefault(count, []).append(tag_id)
+    for count, ids in ids_by_count.items(): Tag.objects.filter(id__in=ids).update(_child_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag', '0005_denormalizeddummy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='_child_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(set_child_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag', '0006_tag_child_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagAlias',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('_alias', models.CharField(max_length=255, unique=True)),
+                ('_tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='_aliases', to='tag.Tag')),
+            ],
+        ),
+    ]
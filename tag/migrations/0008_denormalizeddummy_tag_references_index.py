@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from tag.operations import AddTagReferencesIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag', '0007_tagalias'),
+    ]
+
+    operations = [
+        AddTagReferencesIndex('_denormalizeddummy'),
+    ]
@@ -4,19 +4,199 @@ a generic tag model for Django
 Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
 Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
 """
-__version__ = "1.5"
-__version_dt__ = "2016-05-13"
+__version__ = "1.7"
+__version_dt__ = "2026-10-16"
 __copyright__ = "Stefan LOESCH, oditorium 2016"
 __license__ = "MPL v2.0"
 
-from django.db import models
-from django.core.signing import Signer, BadSignature
+from django.db import models, connections, router, transaction
+from django.db.models import Q, F, Value, Case, When, OuterRef, Subquery, Count, Exists
+from django.db.models.functions import Coalesce, Concat, Substr
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
+from django.conf import settings
+from django.apps import apps
+from django.core.cache import caches
+from django.core.signing import Signer, BadSignature, b62_encode, b62_decode
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+from asgiref.sync import sync_to_async
 
 import json
+import copy
+import threading
+import hashlib
+import hmac
+import base64
+import struct
+import logging
+import time
+
+from itertools import chain
+from functools import wraps
+from contextlib import ExitStack, contextmanager
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping
+from array import array
+
+
+#####################################################################################################
+## INSTRUMENTATION
+tag_operation = Signal()
+    # sent after every instrumented operation by `signal_sink`, with the arguments operation, queries,
+    # db_time and wall_time
+
+def log_sink(operation, queries, db_time, wall_time):
+    """instrumentation sink writing every operation to the `tag.instrumentation` logger (level DEBUG)"""
+    logging.getLogger('tag.instrumentation').debug("{} queries={} db={:.3f}ms wall={:.3f}ms".format(
+        operation, queries, db_time * 1000, wall_time * 1000))
+
+def signal_sink(operation, queries, db_time, wall_time):
+    """instrumentation sink sending the `tag_operation` signal"""
+    tag_operation.send(sender=Instrumentation, operation=operation, queries=queries, db_time=db_time, wall_time=wall_time)
+
+
+class InstrumentationRegistry():
+    """
+    an in-memory, thread safe registry of counters and histograms per operation (an instrumentation sink)
+
+    NOTES
+    - the histograms count the operations per bucket; the buckets are given by their (inclusive) upper
+        bounds, and a last bucket (upper bound None) takes everything above
+    - times are in seconds
+
+    USAGE
+        registry = InstrumentationRegistry()
+        registry('Tag.get', queries=1, db_time=0.0002, wall_time=0.0003)
+        registry.stats          # {'Tag.get': {'calls': 1, 'queries': 1, ..., 'queries_histogram': [[0, 0], [1, 1], ...]}}
+        registry.reset()
+    """
+    query_buckets = (0, 1, 2, 5, 10, 20, 50, 100)
+        # the upper bounds of the buckets of the query count histogram
+    time_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+        # the upper bounds of the buckets of the time histograms
+
+    def __init__(s):
+        s.lock = threading.Lock()
+        s.data = {}
+
+    def __call__(s, operation, queries, db_time, wall_time):
+        """records one operation"""
+        with s.lock:
+            entry = s.data.get(operation)
+            if entry == None:
+                entry = s.data[operation] = {
+                    'calls': 0, 'queries': 0, 'db_time': 0.0, 'wall_time': 0.0,
+                    'queries_histogram':    [0] * (len(s.query_buckets) + 1),
+                    'db_time_histogram':    [0] * (len(s.time_buckets) + 1),
+                    'wall_time_histogram':  [0] * (len(s.time_buckets) + 1),
+                }
+            entry['calls'] += 1
+            entry['queries'] += queries
+            entry['db_time'] += db_time
+            entry['wall_time'] += wall_time
+            entry['queries_histogram'][bisect_left(s.query_buckets, queries)] += 1
+            entry['db_time_histogram'][bisect_left(s.time_buckets, db_time)] += 1
+            entry['wall_time_histogram'][bisect_left(s.time_buckets, wall_time)] += 1
+
+    def reset(s):
+        """removes all entries"""
+        with s.lock: s.data.clear()
+
+    @property
+    def stats(s):
+        """the counters and histograms per operation, as dict (JSON serialisable)"""
+        def histogram(buckets, counts): return [ [bound, count] for bound, count in zip(buckets + (None,), counts) ]
+        with s.lock:
+            return { operation: {
+                'calls':                entry['calls'],
+                'queries':              entry['queries'],
+                'db_time':              entry['db_time'],
+                'wall_time':            entry['wall_time'],
+                'queries_histogram':    histogram(s.query_buckets, entry['queries_histogram']),
+                'db_time_histogram':    histogram(s.time_buckets, entry['db_time_histogram']),
+                'wall_time_histogram':  histogram(s.time_buckets, entry['wall_time_histogram']),
+            } for operation, entry in s.data.items() }
+
+
+class _QueryCounter():
+    """a database execute wrapper counting the queries and the time spent executing them"""
+    def __init__(s):
+        s.queries = 0
+        s.db_time = 0.0
+
+    def __call__(s, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try: return execute(sql, params, many, context)
+        finally:
+            s.queries += 1
+            s.db_time += time.perf_counter() - start
+
+
+class Instrumentation():
+    """
+    measures the number of queries, the database time and the wall time of the instrumented operations
+    (see `instrumented`), and passes them to the sinks
+
+    NOTES
+    - sinks are callables `sink(operation, queries, db_time, wall_time)`; the names 'log' (`log_sink`),
+        'signal' (`signal_sink`) and 'registry' (the in-memory registry `s.registry`, see
+        `InstrumentationRegistry`) can be used instead, as can dotted paths of callables
+    - it is enabled by setting `TAG_INSTRUMENTATION` to a sink, or a list of sinks (`True` meaning 'registry'),
+        or directly by setting `Tag.instrumentation`; if it is None (the default) the instrumented
+        operations only check this attribute
+    - the queries are counted on all database connections of the current thread; nested operations
+        (eg `Tag.get` called by `tag_token_execute`) are counted in both
+    - operations returning querysets (eg `tagged_as`) only execute their queries when evaluated
+
+    USAGE
+        Tag.instrumentation = Instrumentation(['registry', 'log'])
+        Tag.get('parent::child')
+        Tag.instrumentation.registry.stats      # {'Tag.get': {'calls': 1, 'queries': 4, ...}}
+    """
+    def __init__(s, sinks='registry'):
+        if sinks == True: sinks = 'registry'
+        if isinstance(sinks, str) or callable(sinks): sinks = [sinks]
+        s.registry = InstrumentationRegistry()
+        named = {'log': log_sink, 'signal': signal_sink, 'registry': s.registry}
+        s.sinks = [ named.get(sink) or import_string(sink) if isinstance(sink, str) else sink for sink in sinks ]
+
+    def measure(s, operation, func, args, kwargs):
+        """executes func(*args, **kwargs), measuring it as `operation`"""
+        counter = _QueryCounter()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all(): stack.enter_context(connection.execute_wrapper(counter))
+                return func(*args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - start
+            for sink in s.sinks:
+                try: sink(operation, counter.queries, counter.db_time, wall_time)
+                except Exception as e:
+                    logging.getLogger(__name__).warning("instrumentation sink failed [{}]".format(e))
+
+
+def instrumented(operation):
+    """
+    decorator measuring the function as `operation` if instrumentation is enabled (see `Instrumentation`)
 
-#from itertools import chain
+    USAGE
+        @classmethod
+        @instrumented('Tag.get')
+        def get(cls, tagstr):
+            ...
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if Tag.instrumentation == None: return func(*args, **kwargs)
+            return Tag.instrumentation.measure(operation, func, args, kwargs)
+        return wrapper
+    return decorator
 
 
 #####################################################################################################
@@ -45,7 +225,14 @@ class TagBase(object):
         """
         a tag is a leaf iff it has no children
         """
-        return len(tuple(self.direct_children_g)) == 0
+        return not self.has_children
+
+    @property
+    def has_children(self):
+        """
+        whether the tag has any children (derived classes should check without retrieving them)
+        """
+        return next(iter(self.direct_children_g), None) != None
 
     @property
     def direct_children(self):
@@ -55,16 +242,26 @@ class TagBase(object):
         return { t for t in self.direct_children_g }
 
     @property
+    def children_g(self):
+        """
+        the children of the current tag, at all levels (returns generator of objects, not tag strings)
+
+        NOTES
+        - this walks the hierarchy, calling `direct_children_g` once per node; derived classes that
+            can retrieve an entire subtree at once (eg `Tag`) should override it
+        """
+        return ( t1 for t2 in self.direct_children_g for t1 in chain((t2,), t2.children_g) )
+
+    @property
+    @instrumented('Tag.children')
     def children(self):
         """
         the children of the current tag (returns the objects, not the tag strings)
         """
-        children = self.direct_children
-        for t in self.direct_children:
-            children = children.union(t.children)
-        return children
+        return { t for t in self.children_g }
 
     @property
+    @instrumented('Tag.family')
     def family(self):
         """
         the children plus the tag itself (returns set of objects, not the tag strings)
@@ -148,8 +345,11 @@ class TagBase(object):
     def deltag(cls, tagstr):
         """
         deletes the tag object corresponding to the tag string (possibly deleting the entire hierarchy below)
+
+        NOTES
+        - nothing is created (or deleted) if the tag does not exist
         """
-        tag = cls.get(tagstr)
+        tag = cls.get_if_exists(tagstr)
         if tag != None: tag.delete()
         
     @classmethod
@@ -172,6 +372,26 @@ class TagBase(object):
         parent = self.parent
         if  parent != None: return 1 + parent.depth
         return 1
+
+    @property
+    def ancestors(self):
+        """
+        the ancestors of the current tag, from the top-level tag down to the parent (returns tuple of objects)
+        """
+        ancestors = []
+        parent = self.parent
+        while parent.depth > 0:
+            ancestors.insert(0, parent)
+            parent = parent.parent
+        return tuple(ancestors)
+
+    @classmethod
+    def ancestor_tagstrs(cls, tagstr):
+        """
+        the tag strings of all ancestors of tagstr, top-level first (eg 'a::b::c' -> ['a', 'a::b'])
+        """
+        parts = tagstr.split(cls.hierarchy_separator)
+        return [ cls.hierarchy_separator.join(parts[:n]) for n in range(1, len(parts)) ]
         
     hierarchy_separator = "::"
         # defines the string that separtes tags in the hierarchy; for example:
@@ -215,6 +435,473 @@ class RootTag(TagBase):
 
 
 
+#####################################################################################################
+## CACHE
+class LRUCache():
+    """
+    a bounded, thread safe, least-recently-used cache, with hit / miss counters
+
+    NOTES
+    - if `ttl` is given, entries expire `ttl` seconds after they have been set
+
+    USAGE
+        cache = LRUCache(maxsize=1000)
+        cache.set('key', 'value')
+        cache.get('key')                    # 'value'
+        cache.get('other')                  # None
+        cache.stats                         # {'hits': 1, 'misses': 1, 'hit_rate': 0.5, ...}
+    """
+    def __init__(s, maxsize=1024, ttl=None):
+        s.maxsize = maxsize
+        s.ttl = ttl
+        s.data = OrderedDict()
+        s.lock = threading.Lock()
+        s.hits = 0
+        s.misses = 0
+
+    def get(s, key, default=None):
+        """returns the value for key (marking it as recently used), or default if not present"""
+        with s.lock:
+            try: value = s.data[key]
+            except KeyError:
+                s.misses += 1
+                return default
+            if s.ttl != None:
+                expires, value = value
+                if expires < time.monotonic():
+                    del s.data[key]
+                    s.misses += 1
+                    return default
+            s.data.move_to_end(key)
+            s.hits += 1
+            return value
+
+    def set(s, key, value):
+        """sets the value for key, evicting the least recently used entries if need be"""
+        with s.lock: s._set(key, value)
+
+    def add(s, key, value):
+        """sets the value for key only if key is not present (or expired); returns whether it was set"""
+        with s.lock:
+            if key in s.data:
+                if s.ttl == None or s.data[key][0] >= time.monotonic(): return False
+            s._set(key, value)
+            return True
+
+    def _set(s, key, value):
+        """sets the value for key (the lock must be held)"""
+        if s.ttl != None: value = (time.monotonic() + s.ttl, value)
+        s.data[key] = value
+        s.data.move_to_end(key)
+        while len(s.data) > s.maxsize: s.data.popitem(last=False)
+
+    def pop(s, key, default=None):
+        """removes key from the cache, and returns its value (or default if not present)"""
+        with s.lock: 
+            if not key in s.data: return default
+            value = s.data.pop(key)
+        return value[1] if s.ttl != None else value
+
+    def clear(s):
+        """removes all entries from the cache (counters are not reset)"""
+        with s.lock: s.data.clear()
+
+    def __len__(s):
+        return len(s.data)
+
+    @property
+    def stats(s):
+        """the cache statistics, as dict"""
+        lookups = s.hits + s.misses
+        return {
+            'hits':         s.hits,
+            'misses':       s.misses,
+            'hit_rate':     s.hits / lookups if lookups else None,
+            'size':         len(s.data),
+            'maxsize':      s.maxsize,
+            'ttl':          s.ttl,
+        }
+
+
+class TagCache():
+    """
+    a process-local identity cache for tag objects, keyed by tag string and by id
+
+    NOTES
+    - the cache is invalidated via the `post_save` and `post_delete` signals of `Tag` (which are also
+        sent for every tag deleted in a cascade), and via `Tag.tags_changed` for bulk operations
+    - the cached tag objects are shared, so they must not be modified in place
+    - objects cached within a transaction that is later rolled back remain in the cache; clear the
+        cache (`Tag.tags_changed()`) after such a rollback
+
+    USAGE
+        Tag.cache = TagCache(maxsize=1000)      # or via the TAG_CACHE_SIZE setting
+        Tag.get('aaa')                          # hits the database
+        Tag.get('aaa')                          # served from the cache
+        Tag.cache.stats                         # {'hits': 1, 'misses': 1, ...}
+    """
+    def __init__(s, maxsize=1024):
+        s.lru = LRUCache(maxsize)
+        s.aliases = {}
+            # tag id -> the aliases cached for it
+        s.lock = threading.Lock()
+
+    def get(s, tagstr):
+        """returns the tag object for tagstr if cached, None else"""
+        return s.lru.get(('tag', tagstr))
+
+    def get_by_id(s, tag_id):
+        """returns the tag object for tag_id if cached, None else"""
+        entry = s.lru.get(('id', tag_id))
+        if entry: return entry[1]
+        return None
+
+    def set(s, tag):
+        """adds a (saved) tag object to the cache"""
+        s.lru.set(('tag', tag._tag), tag)
+        s.lru.set(('id', tag.id), (tag._tag, tag))
+
+    def get_alias(s, alias):
+        """returns the tag id for the alias (see `TagAlias`) if cached, None else"""
+        return s.lru.get(('alias', alias))
+
+    def set_alias(s, alias, tag_id):
+        """adds an alias (the tag id only, so the tag object is invalidated as usual) to the cache"""
+        s.lru.set(('alias', alias), tag_id)
+        with s.lock: s.aliases.setdefault(tag_id, set()).add(alias)
+
+    def invalidate(s, tag):
+        """
+        removes a tag object from the cache (by id as well as by its current and cached tag string),
+        together with the aliases for it and any alias entry for those tag strings
+        """
+        tagstrs = {tag._tag}
+        entry = s.lru.pop(('id', tag.id))
+        if entry: tagstrs.add(entry[0])
+        with s.lock: aliases = s.aliases.pop(tag.id, set())
+        for tagstr in tagstrs: s.lru.pop(('tag', tagstr))
+        for alias in aliases.union(tagstrs): s.lru.pop(('alias', alias))
+
+    def clear(s):
+        """removes all tag objects from the cache"""
+        s.lru.clear()
+        with s.lock: s.aliases.clear()
+
+    @property
+    def stats(s):
+        """the cache statistics, as dict"""
+        return s.lru.stats
+
+
+class SharedTagCache():
+    """
+    a tag cache shared between processes, using a Django cache backend
+
+    NOTES
+    - every entry is stored together with the generation counter that was current when the data was
+        read from the database; any tag write increments the counter (`invalidate`) when it is
+        committed, which invalidates all entries in all processes at once
+    - the counter is retrieved together with the entry, so a lookup costs a single cache round trip
+    - if the cache backend is unavailable lookups simply miss (and invalidations are logged), so the
+        tag layer falls back to the database
+    - the process-local `TagCache` (and `TagTree`) are only updated by writes within the same process;
+        `sync` clears them whenever the generation counter has changed (checking at most every
+        `sync_interval` seconds)
+
+    USAGE
+        Tag.shared_cache = SharedTagCache('default')    # or via the TAG_SHARED_CACHE setting
+    """
+    def __init__(s, alias='default', prefix='tag', timeout=None, sync_interval=1.0):
+        s.alias = alias
+        s.prefix = prefix
+        s.timeout = timeout
+        s.sync_interval = sync_interval
+        s.generation_key = "{}:generation".format(prefix)
+        s.synced = (None, 0)
+            # (generation, time) of the last `sync`
+
+    @property
+    def backend(s):
+        """the Django cache backend"""
+        return caches[s.alias]
+
+    def key(s, *parts):
+        """the cache key for the parts (hashed, so that it is valid for any backend)"""
+        return "{}:{}".format(s.prefix, hashlib.md5(repr(parts).encode()).hexdigest())
+
+    def get(s, *parts):
+        """
+        returns (generation, value) for the key parts; value is None if not cached (or not current)
+        """
+        key = s.key(*parts)
+        try:
+            entries = s.backend.get_many([s.generation_key, key])
+            generation = entries.get(s.generation_key) or s._init_generation()
+        except Exception: return None, None
+        entry = entries.get(key)
+        if entry and entry[0] == generation: return generation, entry[1]
+        return generation, None
+
+    def set(s, generation, value, *parts):
+        """stores the value for the key parts, as of generation (as returned by the preceding `get`)"""
+        if generation == None: return
+        try: s.backend.set(s.key(*parts), (generation, value), s.timeout)
+        except Exception: pass
+
+    @property
+    def generation(s):
+        """the current generation counter (None if the cache is unavailable)"""
+        try: return s.backend.get(s.generation_key) or s._init_generation()
+        except Exception: return None
+
+    def _init_generation(s):
+        """initialises the generation counter (with a time stamp, so that old generations are never reused)"""
+        s.backend.add(s.generation_key, int(time.time()*1000000), None)
+        return s.backend.get(s.generation_key)
+
+    def invalidate(s):
+        """invalidates all entries (in all processes)"""
+        try:
+            try: s.backend.incr(s.generation_key)
+            except ValueError: s._init_generation()
+        except Exception as e:
+            logging.getLogger(__name__).warning("could not invalidate shared tag cache [{}]".format(e))
+
+    def sync(s, clear):
+        """calls clear() if the generation changed since the last sync (checks at most every sync_interval)"""
+        generation, checked = s.synced
+        now = time.monotonic()
+        if now - checked < s.sync_interval: return
+        current = s.generation
+        if current != generation: clear()
+        s.synced = (current, now)
+
+
+#####################################################################################################
+## TAG TREE
+class TagTree():
+    """
+    an in-memory snapshot of the entire tag hierarchy, allowing to navigate it without any queries
+
+    NOTES
+    - all tags are retrieved with a single query; the hierarchy is held in compact arrays indexed by
+        position (tag id, parent position), plus the tag strings and the list of children per position
+    - tags can be given as tag objects or tag strings; the tag objects returned are created from the
+        snapshot (no queries)
+    - `update` and `remove` apply changes incrementally (see `Tag.tags_changed`); they hold the lock,
+        as do all readers while they collect their result, so a tree can be shared between threads
+
+    USAGE
+        tree = Tag.load_tree()
+        tree.roots                          # (TAG('aaa'), TAG('bbb'), ...), ordered by id
+        tree.leaves()                       # all leaf tags
+        tree.leaves('aaa')                  # all leaf tags below (and including) aaa
+        tree.children('aaa')                # all tags below aaa
+        tree.is_leaf('aaa')                 # False
+        tree.depth('aaa::bbb')              # 2
+        tree.path('aaa::bbb')               # (TAG('aaa'), TAG('aaa::bbb'))
+    """
+    def __init__(s, model, rows):
+        """
+        creates the tree from rows (id, tagstr, parent_id); use `load` to create it from the database
+        """
+        s.model = model
+        s.loaded = time.monotonic()
+        s.lock = threading.RLock()
+        s.ids = array('q')
+        s.parents = array('q')
+            # the position of the parent, -1 for none
+        s.tagstrs = []
+            # the tag string, None for removed tags
+        s.children_pos = []
+        s.positions = {}
+            # tag string -> position
+        s.index = {}
+            # tag id -> position
+        rows = list(rows)
+        for tag_id, tagstr, parent_id in rows:
+            s.index[tag_id] = len(s.ids)
+            s.positions[tagstr] = len(s.ids)
+            s.ids.append(tag_id)
+            s.tagstrs.append(tagstr)
+            s.children_pos.append([])
+        for pos, (tag_id, tagstr, parent_id) in enumerate(rows):
+            parent = s.index.get(parent_id, -1)
+            s.parents.append(parent)
+            if parent >= 0: s.children_pos[parent].append(pos)
+
+    @classmethod
+    def load(cls, model):
+        """
+        loads the entire hierarchy of model (`Tag`) with a single query
+        """
+        return cls(model, model.objects.order_by('_tag').values_list('id', '_tag', '_parent_tag'))
+
+    def _pos(s, tag_or_tagstr):
+        """the position of the tag (KeyError if not in the tree)"""
+        tagstr = tag_or_tagstr.tag if isinstance(tag_or_tagstr, TagBase) else tag_or_tagstr
+        return s.positions[tagstr]
+
+    def _tag(s, pos):
+        """the tag object at position pos"""
+        parent = s.parents[pos]
+        values = (s.ids[pos], s.tagstrs[pos], s.ids[parent] if parent >= 0 else None, s._depth(pos), len(s.children_pos[pos]))
+        return s.model.from_db(router.db_for_read(s.model), s.model._cache_fields, values)
+
+    def _depth(s, pos):
+        """the depth of the tag at position pos"""
+        depth = 1
+        while s.parents[pos] >= 0:
+            pos = s.parents[pos]
+            depth += 1
+        return depth
+
+    def _subtree(s, pos):
+        """generator of the positions of all tags below pos (depth first, excluding pos)"""
+        for child in s.children_pos[pos]:
+            yield child
+            yield from s._subtree(child)
+
+    def __len__(s):
+        return len(s.positions)
+
+    def __contains__(s, tag_or_tagstr):
+        try: s._pos(tag_or_tagstr)
+        except KeyError: return False
+        return True
+
+    def get(s, tagstr):
+        """the tag object corresponding to tagstr, or None"""
+        with s.lock:
+            pos = s.positions.get(tagstr)
+            if pos == None: return None
+            return s._tag(pos)
+
+    @property
+    def roots(s):
+        """the root tags (ie tags with no parent), ordered by id"""
+        with s.lock:
+            return tuple( s._tag(pos) for pos in sorted(s.positions.values(), key=lambda pos: s.ids[pos])
+                            if s.parents[pos] < 0 )
+
+    def parent(s, tag_or_tagstr):
+        """the parent of the tag (`RootTag` for root tags)"""
+        with s.lock:
+            parent = s.parents[s._pos(tag_or_tagstr)]
+            if parent < 0: return RootTag()
+            return s._tag(parent)
+
+    def direct_children(s, tag_or_tagstr):
+        """the direct children of the tag"""
+        with s.lock: return tuple( s._tag(pos) for pos in s.children_pos[s._pos(tag_or_tagstr)] )
+
+    def children(s, tag_or_tagstr):
+        """all children of the tag, at all levels (depth first)"""
+        with s.lock: return tuple( s._tag(pos) for pos in s._subtree(s._pos(tag_or_tagstr)) )
+
+    def family(s, tag_or_tagstr):
+        """the tag and all its children (depth first)"""
+        with s.lock:
+            pos = s._pos(tag_or_tagstr)
+            return tuple( s._tag(p) for p in chain((pos,), s._subtree(pos)) )
+
+    def is_leaf(s, tag_or_tagstr):
+        """whether the tag has no children"""
+        with s.lock: return not s.children_pos[s._pos(tag_or_tagstr)]
+
+    def leaves(s, tag_or_tagstr=None):
+        """all leaves below (and including) the tag, or all leaves in the tree if None (depth first)"""
+        with s.lock:
+            if tag_or_tagstr == None:
+                roots = sorted((pos for pos in s.positions.values() if s.parents[pos] < 0), key=lambda pos: s.ids[pos])
+                positions = chain.from_iterable( chain((pos,), s._subtree(pos)) for pos in roots )
+            else:
+                pos = s._pos(tag_or_tagstr)
+                positions = chain((pos,), s._subtree(pos))
+            return tuple( s._tag(pos) for pos in positions if not s.children_pos[pos] )
+
+    def depth(s, tag_or_tagstr):
+        """the depth of the tag (top-level=1)"""
+        with s.lock: return s._depth(s._pos(tag_or_tagstr))
+
+    def path(s, tag_or_tagstr):
+        """the tag and all its ancestors, from the top-level tag down to the tag"""
+        path = []
+        with s.lock:
+            pos = s._pos(tag_or_tagstr)
+            while pos >= 0:
+                path.insert(0, s._tag(pos))
+                pos = s.parents[pos]
+        return tuple(path)
+
+    def update(s, tags):
+        """
+        adds new tags to the tree, or updates changed ones (returns False if that is not possible)
+        """
+        with s.lock:
+            for tag in tags:
+                parent = -1
+                if tag._parent_tag_id != None:
+                    parent = s.index.get(tag._parent_tag_id)
+                    if parent == None: return False
+                        # the parent is not in the tree
+                pos = s.index.get(tag.id)
+                if pos == None:
+                    pos = len(s.ids)
+                    s.index[tag.id] = pos
+                    s.ids.append(tag.id)
+                    s.tagstrs.append(tag._tag)
+                    s.parents.append(-1)
+                    s.children_pos.append([])
+                else:
+                    del s.positions[s.tagstrs[pos]]
+                    s.tagstrs[pos] = tag._tag
+                    if s.parents[pos] >= 0: s.children_pos[s.parents[pos]].remove(pos)
+                s.positions[tag._tag] = pos
+                s.parents[pos] = parent
+                if parent >= 0: s.children_pos[parent].append(pos)
+        return True
+
+    def remove(s, tags):
+        """
+        removes the tags from the tree (their children must be removed as well)
+        """
+        with s.lock:
+            for tag in tags:
+                pos = s.index.pop(tag.id, None)
+                if pos == None: continue
+                s.positions.pop(s.tagstrs[pos], None)
+                s.tagstrs[pos] = None
+                if s.parents[pos] >= 0: s.children_pos[s.parents[pos]].remove(pos)
+                s.parents[pos] = -1
+                for child in s.children_pos[pos]: s.parents[child] = -1
+                s.children_pos[pos] = []
+        return True
+
+
+#####################################################################################################
+## TAG HIERARCHY QUERYSET
+class TagHierarchyQuerySet(models.QuerySet):
+    """
+    the queryset of `Tag`
+
+    NOTES
+    - `delete` runs within `Tag._collect_deletes`, so the caches are invalidated, the children recounted,
+        and the denormalized tag fields updated, once for the entire statement (and cascade)
+    """
+    def delete(self):
+        model = self.model
+        tagstrs = set(self.values_list('_tag', flat=True))
+        q = Q(pk__in=[])
+        for tagstr in tagstrs:
+            if not any( t in tagstrs for t in model.ancestor_tagstrs(tagstr) ): q |= model.subtree_q(tagstr)
+                # the cascade deletes the subtrees
+        with model._collect_deletes(model.objects.filter(q)): return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 #####################################################################################################
 ## TAG      
 class Tag(TagBase, models.Model):
@@ -247,6 +934,33 @@ class Tag(TagBase, models.Model):
     _parent_tag = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True)
         # the parent of the current tag, if any
 
+    _depth = models.PositiveSmallIntegerField(default=0, db_index=True)
+        # the depth of the tag in the hierarchy (top-level=1); set when saving, 0 for unsaved tags
+
+    _child_count = models.PositiveIntegerField(default=0, db_index=True)
+        # the number of direct children; maintained when tags are created or deleted (see `_count_children`)
+
+    objects = TagHierarchyQuerySet.as_manager()
+        # deletes in bulk with a single recount (see `TagHierarchyQuerySet`)
+
+    def save(self, *args, **kwargs):
+        cls = self.__class__
+        adding = self._state.adding
+        old = None if adding else cls.objects.filter(pk=self.pk).values_list('_tag', '_parent_tag_id', '_depth').first()
+            # the stored tag, to detect a new parent (tag objects may come from caches, so it is read back)
+        reparented = old != None and old[1] != self._parent_tag_id
+        if reparented or not self._depth: self._depth = self.parent.depth + 1
+        super().save(*args, **kwargs)
+        if adding and self._parent_tag_id != None:
+            self._count_children([self._parent_tag_id])
+            if cls._parent_tag.is_cached(self): self._parent_tag._child_count += 1
+                # the parent object (if any) is kept consistent as well
+        if reparented:
+            if self._depth != old[2]:
+                cls.objects.filter(cls.subtree_q(old[0], include_self=False)).update(_depth=F('_depth') + (self._depth - old[2]))
+                cls.tags_changed()
+            self._count_children( tag_id for tag_id in (old[1], self._parent_tag_id) if tag_id != None )
+
     def __eq__(self, other):
         if isinstance(other, self.__class__): 
             return self._tag == other._tag
@@ -270,188 +984,1268 @@ class Tag(TagBase, models.Model):
         return self._parent_tag
 
     @property
-    def direct_children_g(self):
+    def depth(self):
         """
-        the direct children of the current tag (returns generator of objects, not tag strings)
+        returns the depth of the current tag in the hierachy (root=0; no query)
         """
-        return ( t for t in self.__class__.objects.filter(_parent_tag=self) )
+        return self._depth or self.parent.depth + 1
 
-    @classmethod
-    def root_tags(cls):
+    @property
+    def ancestors(self):
         """
-        returns a generator of root tags (ie tags with no parent), ordered by id
+        the ancestors of the current tag, from the top-level tag down to the parent (single query)
         """
-        return (t for t in cls.objects.filter(_parent_tag=None).order_by('id'))
+        return tuple(self.ancestors_qs)
 
-    @classmethod
-    def get_if_exists(cls, tagstr):
+    @property
+    def ancestors_qs(self):
         """
-        gets the tag object corresponding to the tag string if it exists, None else
+        the ancestors of the current tag, as queryset ordered from the top-level tag down to the parent
         """
-        if tagstr=="": return RootTag()
-        try: return cls.objects.get(_tag=tagstr)
-        except: return None
+        return self.__class__.objects.filter(_tag__in=self.ancestor_tagstrs(self._tag)).order_by('_depth')
 
-    @classmethod
-    def create_no_checks(cls, tagstr, parent_tag=None):
+    @property
+    def direct_children_g(self):
         """
-        creates the tag object corresponding to the tag string (must not previously exist, exception else)
+        the direct children of the current tag (returns generator of objects, not tag strings)
         """
-        if tagstr=="": return RootTag()
-        newtag = cls(_tag=tagstr, _parent_tag=parent_tag)
-        newtag.save()
-        return newtag
-
-    def __repr__(s):
-        return "TAG('{0.tag}')".format(s, s.__class__.__name__)
-    
-
-def TAG(tagstr):
-    """convenience method for Tag.get"""
-    return Tag.get(tagstr)
-    
-    
-#####################################################################################################
-## TAG MIXIN
-
-#############################################################
-## ERROR / SUCCESS
-def _error(msg, reference=None, status=None):
-    if status == None: status = 404
-    return JsonResponse({'success': False, 'errmsg': msg, 'data': {}, 'reference': reference}, status=status)
-
-def _success(data, reference=None, status=None):
-    if status == None: status = 200
-    return JsonResponse({'data': data, 'success': True, 'reference': reference}, status=status)
-
-#############################################################
-## EXCEPTIONS
-class TokenSignatureError(RuntimeError): pass       # the token signature is invalid
-class TokenFormatError(RuntimeError): pass          # the token format is invalid
-class IllegalCommandError(RuntimeError): pass       # that command is not valid
-class ItemDoesNotExistError(RuntimeError): pass     # the item does not exist
-class TagDoesNotExistError(RuntimeError): pass      # the tag does not exist
-class TokenContentError(RuntimeError): pass         # the token content is invalid
-class TokenDefinitionError(RuntimeError): pass      # bad parameters when defining a token
-
+        return ( t for t in self.__class__.objects.filter(_parent_tag=self) )
 
-#############################################################
-## TOKEN
-class Token():
-    """
-    allows definition tokens for the tag API
-    """
-    def __init__(s, token):
-        try: token = Signer(sep=s.separators, salt=s.salt).unsign(token)
-        except BadSignature: raise TokenSignatureError(token)
-        s.token = token.split(s.separator)
-        if len(s.token) != 4: raise TokenFormatError("Invalid token format [1]")
-    
-    separators=":::"
-    separator="::"
-    separator2=":"
-    salt="token"
-    
-    @classmethod
-    def create(cls, namespace, command, tag_id=None, item_id=None):
+    @property
+    def has_children(self):
         """
-        create a token
-        
-        PARAMETERS
-        - namespace: the token namespace (string, minimum 2 characters)
-        - command: the token command (can be a string, or a list of strings if it uses parameters)
-        - tag_id: the tag id (if any) this command relates to
-        - item_id: the item id (if any) this command relates to
+        whether the tag has any children (single query, retrieving no tags; unlike `is_leaf` this
+        does not depend on the state of the tag object)
         """
-        if len(namespace) < 2: raise TokenDefinitionError("namespace minimum 2 characters")
-        if not isinstance(command, str): command = cls.separator2.join(command)
-        token = cls.separator.join([namespace, command, str(tag_id), str(item_id)])
-        return Signer(sep=cls.separators, salt=cls.salt).sign(token)
+        return self.__class__.objects.filter(_parent_tag=self).exists()
 
     @property
-    def namespace(s):
+    def is_leaf(self):
         """
-        the token namespace
+        a tag is a leaf iff it has no children (no query; uses the stored number of children)
+
+        NOTES
+        - like `depth` this reflects the state when the tag object was retrieved (or created); tag 
+            objects returned by `get` and the caches are updated when children are created or deleted
         """
-        return s.token[0]
-        
+        return not self._child_count
+
     @property
-    def command(s):
+    def children_g(self):
         """
-        the token command (without paramters)
+        the children of the current tag, at all levels (returns generator of objects, not tag strings)
         """
-        return s.token[1].split(s.separator2)[0]
-        
+        return ( t for t in self.subtree(self._tag, include_self=False) )
+
     @property
-    def parameters(s):
+    def children_qs(self):
         """
-        the token command parameters (as list)
+        the children of the current tag, at all levels (as queryset; single query)
         """
-        return s.token[1].split(s.separator2)[1:]
-        
+        return self.subtree_qs(self._tag, include_self=False)
+
     @property
-    def numparameters(s):
+    def family_qs(self):
         """
-        the number of token parameters
-        """ 
-        return len(s.parameters)
+        the children plus the tag itself (as queryset; single query)
+        """
+        return self.subtree_qs(self._tag)
 
     @property
-    def tag_id(s):
+    def leaves(self):
         """
-        the (numeric) tag id, or None
-        """ 
-        value = s.token[2]
-        if value == "None": return None
-        return int(value)
-        
-    @property
-    def item_id(s):
+        all leaf-tags below self, as generator of objects (single query, or none if cached; see `subtree`)
+
+        NOTES
+        - the leaves are ordered depth first, siblings by tag string (see `path_key`)
         """
-        the (numeric) item id, or None
-        """ 
-        value = s.token[3]
-        if value == "None": return None
-        return int(value)
+        return ( t for t in sorted(self.subtree(self._tag), key=self.path_key) if not t._child_count )
 
-    def __str__(s):
-        return "Token({})"
+    @classmethod
+    def path_key(cls, tag):
+        """
+        the sort key ordering tags depth first, siblings by tag string (eg `a::b::c` before `a::b-c`)
+        """
+        return tag._tag.split(cls.hierarchy_separator)
 
+    @classmethod
+    def subtree_q(cls, tagstr, include_self=True, prefix=""):
+        """
+        returns a Q object selecting all tags below tagstr (and possibly tagstr itself)
 
+        NOTES
+        - the hierarchy is materialised in the tag strings (`a::b::c` is below `a::b` is below `a`)
+            so the entire subtree is a prefix match on the (indexed and unique) `_tag` field
+        - `prefix` allows to use the Q object on related models, eg `prefix="tag__"` on a through table
+        - sqlite's LIKE is case insensitive, so there the equivalent range condition is used instead
+            (sqlite compares strings binary, so the range is exact, and it can use the index as well)
+        - MySQL's default collations compare case insensitively (so `A` would match `a`); Django's
+            `startswith` is a binary LIKE there, so it is used to make the match on tagstr itself
+            case sensitive as well
+        - this relies on the tag strings being consistent with the parent links, which is always the
+            case for tags created via `get` (but not necessarily via `create_no_checks`)
+        """
+        subtree_prefix = tagstr + cls.hierarchy_separator
+        vendor = connections[router.db_for_read(cls)].vendor
+        if vendor == 'sqlite':
+            upper = subtree_prefix[:-1] + chr(ord(subtree_prefix[-1])+1)
+            q = Q(**{prefix+'_tag__gte': subtree_prefix, prefix+'_tag__lt': upper})
+        else:
+            q = Q(**{prefix+'_tag__startswith': subtree_prefix})
+        if include_self:
+            if vendor == 'mysql':
+                q = q | Q(**{prefix+'_tag': tagstr, prefix+'_tag__startswith': tagstr})
+            else: q = q | Q(**{prefix+'_tag': tagstr})
+        return q
 
+    @classmethod
+    def subtree_qs(cls, tagstr, include_self=True):
+        """
+        returns a queryset of all tags below tagstr (and possibly tagstr itself), ordered by tag string
+        """
+        return cls.objects.filter(cls.subtree_q(tagstr, include_self)).order_by('_tag')
 
-#############################################################
-## TAG MIXIN
-class TagMixin(models.Model):
-    """
-    a mixin for Django models, linking them to the Tag model
+    @classmethod
+    @instrumented('Tag.subtree')
+    def subtree(cls, tagstr, include_self=True):
+        """
+        returns a tuple of all tags below tagstr (and possibly tagstr itself), ordered by tag string
 
-    NOTES
-    - this mixin contains a model field (`_tag_references`); in order for this field to actually
-        appear in the database table of the final the mixin must derive from `models.Model`*
-        
-    - for this table to not appear in the database, we need the Meta class with `abstract=True`
+        NOTES
+        - this is served from the shared cache if there is one, and `subtree_qs` else
+        """
+        if not cls.shared_cache: return tuple(cls.subtree_qs(tagstr, include_self))
+        generation, values = cls.shared_cache.get('subtree', tagstr)
+        if values == None:
+            values = [cls._to_values(t) for t in cls.subtree_qs(tagstr)]
+            cls.shared_cache.set(generation, values, 'subtree', tagstr)
+        return tuple( cls._from_values(v) for v in values if include_self or v[1] != tagstr )
 
-    USAGE
-    Basic usage is here. See the tests for more detailed examples.
-    
-        class MyTaggedClass(TagMixin, models.Model):
-            ...
-            
-        tc = MyTaggedClass()
-        tc.tag_add('mytag1')
-        tc.tag_add('mytag1')
-        tc.tags                                 # {TAG('mytag1'), TAG('mytag2')}
-        tc.tag_remove('mytag1')
-        tc.tags                                 # {TAG('mytag2')}
-        MyTaggedClass.tagged_as('mytag2')       # set(tc)
-    
-    *see <http://stackoverflow.com/questions/6014282/django-creating-a-mixin-for-reusable-model-fields>
+    @classmethod
+    def all_leaves(cls, root_tags=None):
+        """
+        generator for all leaves below root_tags (or all root tags if None)
+
+        NOTES
+        - the leaves are ordered by root tag (in the order given, or by id), and depth first below
+            each of them, as in `TagBase` (siblings by tag string, see `path_key`)
+        - the leaves are the tags without children (see `_child_count`), so they are retrieved with a
+            single query, together with the root tags if root_tags is None
+        """
+        if root_tags == None:
+            tags = list(cls.objects.filter(Q(_child_count=0) | Q(_parent_tag=None)).order_by('_tag'))
+            root_tags = sorted((t for t in tags if t._parent_tag_id == None), key=lambda t: t.id)
+        else:
+            root_tags = list(root_tags)
+            q = Q()
+            for root_tag in root_tags: q |= cls.subtree_q(root_tag._tag)
+            tags = list(cls.objects.filter(q, _child_count=0).order_by('_tag')) if root_tags else []
+        leaves = {root_tag._tag: [] for root_tag in root_tags}
+        for t in sorted(tags, key=cls.path_key):
+            if t._child_count: continue
+            for tagstr in cls.ancestor_tagstrs(t._tag) + [t._tag]:
+                if tagstr in leaves: leaves[tagstr].append(t)
+        return ( t for root_tag in root_tags for t in leaves[root_tag._tag] )
+
+    @classmethod
+    def root_tags(cls):
+        """
+        returns a generator of root tags (ie tags with no parent), ordered by id
+        """
+        return (t for t in cls.objects.filter(_parent_tag=None).order_by('id'))
+
+    @classmethod
+    @instrumented('Tag.get')
+    def get(cls, tagstr):
+        """
+        gets the tag object corresponding to the tag string (possibly creating it and entire hierarchy)
+
+        NOTES
+        - if the tag does not exist, all its ancestors are retrieved with a single query, and the missing
+            ones are then created top-down
+        - if `aliases` is true'ish, a tag string that does not exist but is an alias (see `TagAlias`)
+            returns the tag it stands for (one more query, or none if the alias is cached); an existing
+            tag always takes precedence over an alias
+        """
+        if tagstr==None or isinstance(tagstr, TagBase): return super().get(tagstr)
+
+        tag = cls.get_if_exists(tagstr)
+        if tag: return tag
+        if cls.aliases:
+            tag = cls.get_aliases([tagstr]).get(tagstr)
+            if tag: return tag
+        return cls._create_with_ancestors(tagstr)
+
+    @classmethod
+    def _create_with_ancestors(cls, tagstr):
+        """
+        creates the tag (which must not exist) and its missing ancestors, without resolving aliases
+        """
+        ancestor_tagstrs = cls.ancestor_tagstrs(tagstr)
+        existing = {t._tag: t for t in cls.objects.filter(_tag__in=ancestor_tagstrs)}
+        tag = None
+        for t in ancestor_tagstrs + [tagstr]:
+            tag = existing.get(t) or cls.create_no_checks(t, tag)
+        return tag
+
+    @classmethod
+    @instrumented('Tag.get_many')
+    def get_many(cls, tagstrs):
+        """
+        gets the tag objects for many tag strings at once (possibly creating them and their hierarchies)
+
+        NOTES
+        - returns a dict mapping every tag string to its tag object (`None`, "" and tag objects are
+            treated as in `get`)
+        - the tags and all their ancestors are retrieved with a single query (per `batch_size` strings);
+            the missing ones are then created level by level, with one `bulk_create` and one query
+            retrieving the new ids per level, so the number of queries depends on the depth of the
+            hierarchy, not on the number of tags
+        - if `aliases` is true'ish, the tag strings that do not exist are first looked up as aliases
+            (with one more query, see `get_aliases`)
+
+        USAGE
+            tags = Tag.get_many(['aaa::bbb', 'aaa::ccc', 'ddd'])
+            tags['aaa::bbb']                                        # TAG('aaa::bbb')
+        """
+        tagstrs = list(tagstrs)
+        result = {}
+        wanted = set()
+        for tagstr in tagstrs:
+            if tagstr==None or tagstr=="" or isinstance(tagstr, TagBase): result[tagstr] = super().get(tagstr)
+            else:
+                wanted.add(tagstr)
+                wanted.update(cls.ancestor_tagstrs(tagstr))
+        wanted.discard("")
+
+        existing = cls._get_existing(wanted)
+        if cls.aliases:
+            aliased = cls.get_aliases( t for t in tagstrs if isinstance(t, str) and t and not t in existing )
+            result.update(aliased)
+            wanted = set(existing).union( chain.from_iterable( [t] + cls.ancestor_tagstrs(t) for t in tagstrs
+                if isinstance(t, str) and t and not t in existing and not t in aliased ) )
+                # the ancestors of aliases need not be created
+        levels = {}
+        for tagstr in wanted.difference(existing):
+            levels.setdefault(len(cls.ancestor_tagstrs(tagstr)), []).append(tagstr)
+        for level in sorted(levels):
+            newtags = []
+            for tagstr in sorted(levels[level]):
+                newtag = cls(_tag=tagstr, _parent_tag=existing.get(cls.parent_tagstr(tagstr)))
+                newtag._depth = newtag.depth
+                newtags.append(newtag)
+            cls.objects.bulk_create(newtags, batch_size=cls.batch_size, ignore_conflicts=True)
+                # ignoring conflicts means that tags created concurrently are simply picked up below
+            created = cls._get_existing(levels[level])
+            existing.update(created)
+            cls.tags_changed(created.values())
+                # bulk_create does not send signals, but the new tags change the subtrees
+            cls._count_children( t._parent_tag_id for t in created.values() if t._parent_tag_id != None )
+            by_id = {t.id: t for t in existing.values()}
+            for t in created.values():
+                if t._parent_tag_id in by_id: by_id[t._parent_tag_id]._child_count += 1
+                    # the parent objects returned are kept consistent as well
+
+        result.update({tagstr: existing[tagstr] for tagstr in wanted if tagstr in existing})
+        return {tagstr: result[tagstr] for tagstr in tagstrs}
+
+    @classmethod
+    def get_aliases(cls, tagstrs):
+        """
+        returns a dict tagstr -> tag object for those tag strings that are aliases (see `TagAlias`)
+
+        NOTES
+        - the aliases are retrieved with a single query (per `batch_size` strings), and the tags with
+            one more; both are taken from the `TagCache` if there is one
+        - this does not check whether a tag with that tag string exists (see `get`)
+        """
+        tagstrs = sorted(set(tagstrs))
+        tag_ids = {}
+        if cls.cache:
+            tag_ids = {tagstr: cls.cache.get_alias(tagstr) for tagstr in tagstrs}
+            tag_ids = {tagstr: tag_id for tagstr, tag_id in tag_ids.items() if tag_id}
+            tagstrs = [tagstr for tagstr in tagstrs if not tagstr in tag_ids]
+        for n in range(0, len(tagstrs), cls.batch_size):
+            for alias, tag_id in TagAlias.objects.filter(_alias__in=tagstrs[n:n+cls.batch_size]).values_list('_alias', '_tag'):
+                tag_ids[alias] = tag_id
+                if cls.cache: cls.cache.set_alias(alias, tag_id)
+        tags = {}
+        if cls.cache:
+            tags = {tag_id: cls.cache.get_by_id(tag_id) for tag_id in set(tag_ids.values())}
+            tags = {tag_id: tag for tag_id, tag in tags.items() if tag}
+        missing = sorted(set(tag_ids.values()).difference(tags))
+        for n in range(0, len(missing), cls.batch_size):
+            for tag in cls.objects.filter(id__in=missing[n:n+cls.batch_size]):
+                tags[tag.id] = tag
+                if cls.cache: cls.cache.set(tag)
+        return {tagstr: tags[tag_id] for tagstr, tag_id in tag_ids.items() if tag_id in tags}
+
+    @classmethod
+    def _get_existing(cls, tagstrs):
+        """
+        returns a dict tagstr -> tag object for those tag strings that exist (one query per batch_size)
+        """
+        tagstrs = sorted(tagstrs)
+        existing = {}
+        if cls.cache:
+            existing = {tagstr: cls.cache.get(tagstr) for tagstr in tagstrs}
+            existing = {tagstr: tag for tagstr, tag in existing.items() if tag}
+            tagstrs = [tagstr for tagstr in tagstrs if not tagstr in existing]
+        for n in range(0, len(tagstrs), cls.batch_size):
+            for tag in cls.objects.filter(_tag__in=tagstrs[n:n+cls.batch_size]):
+                existing[tag._tag] = tag
+                if cls.cache: cls.cache.set(tag)
+        return existing
+
+    batch_size = 500
+        # the maximum number of tag strings in a single `_tag__in` query or `bulk_create` batch
+
+    @classmethod
+    def get_if_exists(cls, tagstr):
+        """
+        gets the tag object corresponding to the tag string if it exists, None else
+        """
+        if tagstr=="": return RootTag()
+        if cls.cache:
+            if cls.shared_cache: cls.shared_cache.sync(cls._clear_local)
+            tag = cls.cache.get(tagstr)
+            if tag: return tag
+        if cls.shared_cache:
+            generation, values = cls.shared_cache.get('tag', tagstr)
+            if values: tag = cls._from_values(values)
+            else:
+                try: tag = cls.objects.get(_tag=tagstr)
+                except: return None
+                cls.shared_cache.set(generation, cls._to_values(tag), 'tag', tagstr)
+        else:
+            try: tag = cls.objects.get(_tag=tagstr)
+            except: return None
+        if cls.cache: cls.cache.set(tag)
+        return tag
+
+    @classmethod
+    def get_by_id(cls, tag_id):
+        """
+        gets the tag object corresponding to the tag id (exception if it does not exist)
+        """
+        if cls.cache:
+            if cls.shared_cache: cls.shared_cache.sync(cls._clear_local)
+            tag = cls.cache.get_by_id(tag_id)
+            if tag: return tag
+        tag = cls.objects.get(id=tag_id)
+        if cls.cache: cls.cache.set(tag)
+        return tag
+
+    @classmethod
+    async def aget(cls, tagstr):
+        """
+        async version of `get`
+
+        NOTES
+        - tags in the local cache are returned without database access, and existing tags are 
+            retrieved using the async ORM; creating tags (and using the shared cache) runs `get` 
+            in a thread
+        """
+        if tagstr==None or tagstr=="" or isinstance(tagstr, TagBase): return cls.get(tagstr)
+        if cls.shared_cache: return await sync_to_async(cls.get)(tagstr)
+        if cls.cache:
+            tag = cls.cache.get(tagstr)
+            if tag: return tag
+        tag = await cls.objects.filter(_tag=tagstr).afirst()
+        if tag == None: return await sync_to_async(cls.get)(tagstr)
+        if cls.cache: cls.cache.set(tag)
+        return tag
+
+    @classmethod
+    async def aget_by_id(cls, tag_id):
+        """
+        async version of `get_by_id`
+        """
+        if cls.shared_cache: return await sync_to_async(cls.get_by_id)(tag_id)
+        if cls.cache:
+            tag = cls.cache.get_by_id(tag_id)
+            if tag: return tag
+        tag = await cls.objects.aget(id=tag_id)
+        if cls.cache: cls.cache.set(tag)
+        return tag
+
+    cache = TagCache(settings.TAG_CACHE_SIZE) if getattr(settings, 'TAG_CACHE_SIZE', None) else None
+        # the optional process-local tag cache (see `TagCache`); None means no caching
+
+    shared_cache = SharedTagCache(settings.TAG_SHARED_CACHE) if getattr(settings, 'TAG_SHARED_CACHE', None) else None
+        # the optional shared tag cache (see `SharedTagCache`); None means no caching
+
+    aliases = getattr(settings, 'TAG_ALIASES', False)
+        # whether `get` and `get_many` resolve aliases (see `TagAlias` and `merge_into`)
+
+    instrumentation = Instrumentation(settings.TAG_INSTRUMENTATION) if getattr(settings, 'TAG_INSTRUMENTATION', None) else None
+        # the optional instrumentation of the tag operations (see `Instrumentation`); None means off
+
+    _cache_fields = ('id', '_tag', '_parent_tag_id', '_depth', '_child_count')
+        # the fields stored in the shared cache (and in the `TagTree` snapshot)
+
+    @classmethod
+    def _to_values(cls, tag):
+        """the field values of tag that are stored in the shared cache (see `_cache_fields`)"""
+        return tuple( getattr(tag, f) for f in cls._cache_fields )
+
+    @classmethod
+    def _from_values(cls, values):
+        """recreates the tag object from the field values stored in the shared cache"""
+        return cls.from_db(router.db_for_read(cls), cls._cache_fields, values)
+
+    @classmethod
+    def tags_changed(cls, tags=None, deleted=False):
+        """
+        invalidates all caches for the tags changed (all tags if None), and updates the tag tree
+
+        NOTES
+        - this is called automatically whenever a tag is saved or deleted via the ORM; operations
+            that bypass the ORM signals (eg `update` or `bulk_create`) must call it explicitly
+        - `deleted` indicates whether the tags have been deleted (as opposed to created or changed)
+        - the shared cache and the tag tree snapshot are only updated once the changes are committed
+        """
+        cls._invalidate_shared()
+        if tags == None:
+            cls._clear_local()
+            return
+        tags = list(tags)
+        if cls.cache:
+            for tag in tags: cls.cache.invalidate(tag)
+        if cls._tree:
+            tags = [copy.copy(tag) for tag in tags]
+            transaction.on_commit(lambda: cls._tree_changed(tags, deleted), using=router.db_for_write(cls))
+
+    @classmethod
+    def _invalidate_shared(cls):
+        """
+        invalidates the shared cache once the current transaction is committed (at once if there is none)
+
+        NOTES
+        - invalidating it before, other processes could cache the old data again until the commit
+        """
+        shared_cache = cls.shared_cache
+        if shared_cache: transaction.on_commit(shared_cache.invalidate, using=router.db_for_write(cls))
+
+    @classmethod
+    def _tree_changed(cls, tags, deleted):
+        """
+        applies committed changes to the tag tree snapshot (see `tags_changed`)
+        """
+        tree = cls._tree
+        if not tree: return
+        if deleted: tree.remove(tags)
+        elif not tree.update(tags): cls._tree = None
+
+    @classmethod
+    def _count_children(cls, tag_ids):
+        """
+        recounts the direct children of the tags (single update statement), and invalidates their caches
+
+        NOTES
+        - the count is recomputed rather than incremented, so it is also correct after tags have been
+            created concurrently (or with conflicts ignored)
+        """
+        tag_ids = set(tag_ids)
+        if not tag_ids: return
+        children = cls.objects.filter(_parent_tag=OuterRef('pk')).order_by().values('_parent_tag')
+        count = children.annotate(count=Count('pk')).values('count')
+        cls.objects.filter(id__in=tag_ids).update(_child_count=Coalesce(Subquery(count), 0))
+        cls._invalidate_shared()
+        if cls.cache:
+            for tag_id in tag_ids:
+                tag = cls.cache.get_by_id(tag_id)
+                if tag: cls.cache.invalidate(tag)
+
+    @classmethod
+    @contextmanager
+    def _collect_deletes(cls, tags=None):
+        """
+        collects the tags deleted via the ORM within (eg in a cascade, see `_tag_deleted`); at the end the
+        caches are invalidated, and the children of the parents that remain are recounted, only once
+
+        NOTES
+        - tags is a queryset of all tags about to be deleted (including the cascade); the items of the
+            `DenormalizedTagMixin` models tagged with them are retrieved before, and their denormalized
+            fields updated at the end (one query per model each, see `_denormalized_items`)
+        - everything runs in a single transaction
+        """
+        if getattr(cls._deleted, 'tags', None) != None:
+            if tags != None: cls._denormalized_items(tags, cls._deleted.items)
+            yield
+            return
+        cls._deleted.tags, cls._deleted.items = [], {}
+        try:
+            with transaction.atomic(using=router.db_for_write(cls)):
+                if tags != None: cls._denormalized_items(tags, cls._deleted.items)
+                yield
+                deleted_tags, items = cls._deleted.tags, cls._deleted.items
+                for model, item_ids in items.items(): model.tags_denormalize(item_ids)
+                if not deleted_tags: return
+                deleted = {t.id for t in deleted_tags}
+                cls.tags_changed(deleted_tags, deleted=True)
+                cls._count_children( t._parent_tag_id for t in deleted_tags
+                    if t._parent_tag_id != None and not t._parent_tag_id in deleted )
+        finally: cls._deleted.tags = cls._deleted.items = None
+
+    _deleted = threading.local()
+        # the tags deleted within `_collect_deletes`, and the items to denormalize (per thread)
+
+    @classmethod
+    def _denormalized_items(cls, tags, items=None):
+        """
+        adds the ids of the items tagged with tags (a queryset) to items (a dict model -> set of ids,
+        for all `DenormalizedTagMixin` models); returns items
+        """
+        if items == None: items = {}
+        for model in cls._tagged_models():
+            if not issubclass(model, DenormalizedTagMixin): continue
+            through, item_attname, tag_attname = model._tag_through()
+            item_ids = through.objects.filter(**{tag_attname+'__in': tags.values('id')}).values_list(item_attname, flat=True)
+            item_ids = set(item_ids.distinct())
+            if item_ids: items.setdefault(model, set()).update(item_ids)
+        return items
+
+    @classmethod
+    def _clear_local(cls):
+        """
+        clears all process-local caches (the `TagCache` as well as the `TagTree`)
+        """
+        if cls.cache: cls.cache.clear()
+        cls._tree = None
+
+    @classmethod
+    def load_tree(cls, refresh=False):
+        """
+        returns a `TagTree` snapshot of the entire hierarchy (retrieved with a single query)
+
+        NOTES
+        - by default a new snapshot is loaded on every call; if `tree_cache` is true'ish the snapshot
+            is kept, and updated incrementally whenever changes to tags are committed in this process;
+            if there is a shared cache the snapshot is reloaded when tags have been changed in other
+            processes, otherwise it is reloaded when older than `tree_max_age` seconds
+        - within a transaction a new snapshot is always loaded (so that it includes the changes of the
+            transaction), and it is not kept
+        - if `refresh` is true'ish the snapshot is always reloaded
+        """
+        if not cls.tree_cache or transaction.get_connection(router.db_for_read(cls)).in_atomic_block:
+            return TagTree.load(cls)
+        tree = cls._tree
+        if cls.shared_cache: cls.shared_cache.sync(cls._clear_local)
+        elif tree and cls.tree_max_age != None and time.monotonic() - tree.loaded > cls.tree_max_age: tree = None
+        if refresh or not tree or tree is not cls._tree:
+            tree = TagTree.load(cls)
+            cls._tree = tree
+        return tree
+
+    _tree = None
+        # the current `TagTree` snapshot (see `load_tree`)
+
+    tree_cache = getattr(settings, 'TAG_TREE_CACHE', False)
+        # whether to keep the `TagTree` snapshot between calls of `load_tree`
+
+    tree_max_age = 1.0
+        # the maximum age of the snapshot in seconds if there is no shared cache (None: no maximum)
+
+    def delete(self, *args, **kwargs):
+        """
+        deletes the tag and all below it, using the ORM cascade (see also `deltag`)
+
+        NOTES
+        - the caches are invalidated, and the number of children of the parent recounted, once for the
+            entire cascade, and the denormalized tag fields of the items tagged with any of the deleted
+            tags are updated (see `_collect_deletes`)
+        """
+        with self._collect_deletes(self.subtree_qs(self._tag)): return super().delete(*args, **kwargs)
+
+    @classmethod
+    def create_no_checks(cls, tagstr, parent_tag=None):
+        """
+        creates the tag object corresponding to the tag string (must not previously exist, exception else)
+        """
+        if tagstr=="": return RootTag()
+        if isinstance(parent_tag, RootTag): parent_tag = None
+        newtag = cls(_tag=tagstr, _parent_tag=parent_tag)
+        newtag.save()
+        return newtag
+
+    def move(self, new_tagstr):
+        """
+        moves the tag, with its entire subtree, to new_tagstr (eg `a::b` -> `x::b`); returns the moved tag
+
+        NOTES
+        - the paths, depths and parent links of the subtree are rewritten with set-based updates, so
+            the number of queries does not depend on the size of the subtree; everything runs in a
+            single transaction, and the ancestors of new_tagstr are created if need be
+        - if tags already exist at the new paths the moved tags are merged into them: their taggings
+            (see `_reassign_taggings`) and aliases are reassigned, their children re-parented, and they
+            are deleted (see also `merge_into`); as in `deltag` this bypasses the ORM unless other 
+            models refer to tags
+        - a tag can not be moved into its own subtree or onto one of its ancestors (`TagMoveError`)
+        - all caches are invalidated, and the numbers of children as well as the denormalized tag
+            fields (see `DenormalizedTagMixin`) are updated; tag objects are snapshots, so self (and
+            any other tag object of the subtree) is stale afterwards
+
+        USAGE
+            Tag.get('a::b').move('x::b')            # a::b::c becomes x::b::c
+            Tag.get('a::b').rename('c')             # a::b::c becomes a::c::c
+        """
+        cls = self.__class__
+        sep = cls.hierarchy_separator
+        old = self._tag
+        if isinstance(new_tagstr, TagBase): new_tagstr = new_tagstr.tag
+        if not new_tagstr: raise TagMoveError("can not move {} to the root".format(old))
+        if new_tagstr == old: return self
+        if new_tagstr.startswith(old + sep): raise TagMoveError("can not move {} into its own subtree".format(old))
+        if old.startswith(new_tagstr + sep): raise TagMoveError("can not move {} onto its ancestor".format(old))
+
+        def path(field): return Concat(Value(new_tagstr), Substr(field, len(old) + 1), output_field=models.CharField())
+        depth = F('_depth') + (new_tagstr.count(sep) - old.count(sep))
+        with transaction.atomic():
+            ancestors = cls.ancestor_tagstrs(new_tagstr)
+            parent = None
+            if ancestors: parent = cls.get_if_exists(ancestors[-1]) or cls._create_with_ancestors(ancestors[-1])
+                # not `get`, as an alias must not stand in for the new parent
+            existing = dict(cls.objects.filter(cls.subtree_q(new_tagstr)).values_list('_tag', 'id'))
+            recount = {self._parent_tag_id, parent.id if parent else None}
+
+            if not existing:
+                cls.objects.filter(cls.subtree_q(old)).update(_tag=path('_tag'), _depth=depth)
+                cls.objects.filter(id=self.id).update(_parent_tag=parent)
+                    # the other tags of the subtree keep their parents
+
+            else:
+                family = list(cls.objects.filter(cls.subtree_q(old)).values_list('id', '_tag', '_parent_tag_id'))
+                merged = { tag_id: existing[new_tagstr + tagstr[len(old):]] for tag_id, tagstr, parent_id in family
+                    if new_tagstr + tagstr[len(old):] in existing }
+                moved = [ tag_id for tag_id, tagstr, parent_id in family if not tag_id in merged ]
+                reparent = { tag_id: merged[parent_id] for tag_id, tagstr, parent_id in family
+                    if not tag_id in merged and parent_id in merged }
+                if not self.id in merged: reparent[self.id] = parent.id if parent else None
+                cls._reassign_taggings(merged)
+                for n in range(0, len(moved), cls.batch_size):
+                    cls.objects.filter(id__in=moved[n:n+cls.batch_size]).update(_tag=path('_tag'), _depth=depth)
+                reparent_ids = list(reparent)
+                for n in range(0, len(reparent_ids), cls.batch_size):
+                    batch = reparent_ids[n:n+cls.batch_size]
+                    cls.objects.filter(id__in=batch).update(_parent_tag=Case(
+                        *[ When(id=tag_id, then=Value(reparent[tag_id])) for tag_id in batch ],
+                        output_field=models.IntegerField()))
+                merged_ids = list(merged)
+                for n in range(0, len(merged_ids), cls.batch_size):
+                    batch = merged_ids[n:n+cls.batch_size]
+                    TagAlias.objects.filter(_tag__in=batch).update(_tag=Case(
+                        *[ When(_tag=tag_id, then=Value(merged[tag_id])) for tag_id in batch ],
+                        output_field=models.IntegerField()))
+                    qs = cls.objects.filter(id__in=batch)
+                    if cls._raw_delete_safe(): qs._raw_delete(qs.db)
+                    else:
+                        qs.delete()
+                        # their taggings and aliases have been reassigned, and their children re-parented or deleted
+                recount.update(merged.values())
+
+            cls._count_children( tag_id for tag_id in recount if tag_id != None )
+            cls.tags_changed()
+            subtree_ids = cls.subtree_qs(new_tagstr).values('id')
+            for model in cls._tagged_models():
+                if not issubclass(model, DenormalizedTagMixin): continue
+                through, item_attname, tag_attname = model._tag_through()
+                model.tags_denormalize(list(through.objects.filter(**{tag_attname+'__in': subtree_ids})
+                    .values_list(item_attname, flat=True).distinct()))
+        return cls.get(new_tagstr)
+
+    @classmethod
+    def deltag(cls, tagstr):
+        """
+        deletes the tag with its entire subtree and all their taggings; returns (total, per model) like `delete`
+
+        NOTES
+        - the tags are found by path prefix (see `subtree_q`) and deleted with set-based statements,
+            without retrieving them or their taggings (unlike `delete`, which collects every related
+            row of the cascade in memory): per tagged model one delete of the relations (and one query
+            retrieving the affected items if the model is a `DenormalizedTagMixin`), one delete of the
+            aliases, and one of the tags
+        - nothing is created if the tag does not exist, which returns (0, {}); before v1.7 `deltag`
+            returned None, and created a tag that did not exist (with its ancestors) before deleting it
+        - all caches are invalidated, and the number of children of the parent, as well as the denormalized
+            tag fields, are updated
+        - the rows are deleted with the (private) `QuerySet._raw_delete`, so no `pre_delete` or `post_delete`
+            signals are sent, neither for the tags (ie `_tag_deleted` and any other receivers do not run)
+            nor for their taggings and aliases; use `delete` if receivers must see every row
+        - if other models refer to tags, the deletion falls back to `delete` so that their `on_delete`
+            is honoured
+
+        USAGE
+            Tag.deltag('parent::child2')            # (5, {'tag.Tag': 2, 'tag._Dummy__tag_references': 3})
+            Tag.get('parent::child2').delete_subtree()
+        """
+        if isinstance(tagstr, TagBase): tagstr = tagstr.tag
+        if not tagstr: return 0, {}
+        tagged = cls._tagged_models()
+        tags = cls.objects.filter(cls.subtree_q(tagstr))
+        if not cls._raw_delete_safe():
+            return tags.delete()
+
+        counts = {}
+        with transaction.atomic():
+            parent_ids = list(cls.objects.filter(_tag=cls.parent_tagstr(tagstr)).values_list('id', flat=True))
+            for model in tagged:
+                through, item_attname, tag_attname = model._tag_through()
+                relations = through.objects.filter(**{tag_attname+'__in': tags.values('id')})
+                items = None
+                if issubclass(model, DenormalizedTagMixin):
+                    items = list(relations.values_list(item_attname, flat=True).distinct())
+                    if not items: continue
+                counts[through._meta.label] = relations._raw_delete(relations.db)
+                if items: model.tags_denormalize(items)
+            aliases = TagAlias.objects.filter(_tag__in=tags.values('id'))
+            counts[TagAlias._meta.label] = aliases._raw_delete(aliases.db)
+            counts[cls._meta.label] = tags._raw_delete(tags.db)
+            cls._count_children(parent_ids)
+            cls.tags_changed()
+        counts = {label: n for label, n in counts.items() if n}
+        return sum(counts.values()), counts
+
+    def delete_subtree(self):
+        """
+        deletes the tag with its entire subtree and all their taggings (see `deltag`)
+        """
+        return self.__class__.deltag(self._tag)
+
+    def merge_into(self, target, alias=None):
+        """
+        merges the tag, with its entire subtree, into target (a tag or tag string); returns target
+
+        NOTES
+        - the taggings of all tagged models are moved to target in bulk (pairs that already exist are
+            skipped), the children are re-parented (or merged into the children of target with the same
+            name), and the tag is deleted (see `move`); target is created if it does not exist
+        - if `alias` is true'ish (default: `aliases`), the tag strings of the merged tags are kept as
+            aliases (see `TagAlias`) of the tags they have been merged into, so that `get` resolves them
+
+        USAGE
+            Tag.get('lang::py').merge_into('lang::python')
+            Tag.get('lang::py')                                 # TAG('lang::python') if Tag.aliases
+        """
+        cls = self.__class__
+        if alias == None: alias = cls.aliases
+        with transaction.atomic():
+            target = cls.get(target)
+            family = list(cls.subtree_qs(self._tag).values_list('_tag', flat=True)) if alias else []
+            target = self.move(target)
+            if not family: return target
+            merged = { tagstr: target._tag + tagstr[len(self._tag):] for tagstr in family }
+            tags = cls._get_existing(merged.values())
+            for n in range(0, len(family), cls.batch_size):
+                TagAlias.objects.filter(_alias__in=family[n:n+cls.batch_size]).delete()
+            TagAlias.objects.bulk_create([ TagAlias(_alias=tagstr, _tag=tags[merged[tagstr]]) for tagstr in family ],
+                batch_size=cls.batch_size)
+        return target
+
+    def rename(self, new_short_tag):
+        """
+        renames the last part of the tag (eg `a::b` -> `a::c`), with its entire subtree (see `move`)
+        """
+        if not new_short_tag or self.hierarchy_separator in new_short_tag:
+            raise TagMoveError("invalid tag name {}".format(new_short_tag))
+        return self.move(self.hierarchy_separator.join(self.ancestor_tagstrs(self._tag)[-1:] + [new_short_tag]))
+
+    @classmethod
+    def _tagged_models(cls):
+        """
+        all models deriving from `TagMixin` (ie all models that have a relation to the tags)
+        """
+        return [ model for model in apps.get_models() if issubclass(model, TagMixin) ]
+
+    @classmethod
+    def _raw_delete_safe(cls):
+        """
+        whether tags can be deleted with `QuerySet._raw_delete`, ie whether only the tag relations of the 
+        tagged models, `TagAlias` and the tags themselves refer to tags (the `on_delete` of other models 
+        would be skipped)
+        """
+        tagged = cls._tagged_models()
+        known = set(tagged).union( model._tag_through()[0] for model in tagged ).union({cls, TagAlias})
+        return all( rel.related_model in known for rel in cls._meta.related_objects )
+
+    @classmethod
+    def _reassign_taggings(cls, tag_ids):
+        """
+        reassigns the taggings of all tagged models according to the dict tag_ids (old id -> new id)
+
+        NOTES
+        - per model this takes one query reading the relations, one delete statement, and one insert
+            per `batch_size` relations; pairs that already exist are skipped
+        """
+        if not tag_ids: return
+        for model in cls._tagged_models():
+            through, item_attname, tag_attname = model._tag_through()
+            qs = through.objects.filter(**{tag_attname+'__in': list(tag_ids)})
+            relations = list(qs.values_list(item_attname, tag_attname))
+            if not relations: continue
+            qs._raw_delete(qs.db)
+            model._relations_insert( (item_id, tag_ids[tag_id]) for item_id, tag_id in relations )
+
+    def __repr__(s):
+        return "TAG('{0.tag}')".format(s, s.__class__.__name__)
+
+
+@receiver(post_save, sender=Tag)
+def _tag_saved(sender, instance, **kwargs):
+    """invalidates the caches whenever a tag is saved"""
+    sender.tags_changed([instance])
+
+@receiver(post_delete, sender=Tag)
+def _tag_deleted(sender, instance, **kwargs):
+    """invalidates the caches whenever a tag is deleted (including deletions in a cascade)"""
+    tags = getattr(Tag._deleted, 'tags', None)
+    if tags != None: return tags.append(copy.copy(instance))
+        # handled by `_collect_deletes` (copied, as the ORM resets the ids at the end of the cascade)
+    sender.tags_changed([instance], deleted=True)
+    if instance._parent_tag_id != None: sender._count_children([instance._parent_tag_id])
+    
+
+def TAG(tagstr):
+    """convenience method for Tag.get"""
+    return Tag.get(tagstr)
+    
+    
+#####################################################################################################
+## TAG ALIAS
+class TagAlias(models.Model):
+    """
+    an alternative tag string for a tag, eg the tag string of a tag merged into it (see `Tag.merge_into`)
+
+    NOTES
+    - aliases are only resolved by `Tag.get` and `Tag.get_many` if `Tag.aliases` is true'ish (setting
+        `TAG_ALIASES`); a tag that exists always takes precedence over an alias
+    - the aliases of a tag are deleted with it, and are reassigned when it is merged into another tag
+    """
+    _alias = models.CharField(max_length=255, unique=True)
+        # the alternative tag string
+
+    _tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='_aliases')
+        # the tag it stands for
+
+    def __repr__(s):
+        return "TAGALIAS('{0._alias}' -> '{0._tag._tag}')".format(s)
+
+
+#####################################################################################################
+## TAG MIXIN
+
+#############################################################
+## ERROR / SUCCESS
+def _error(msg, reference=None, status=None):
+    if status == None: status = 404
+    return JsonResponse({'success': False, 'errmsg': msg, 'data': {}, 'reference': reference}, status=status)
+
+def _success(data, reference=None, status=None):
+    if status == None: status = 200
+    return JsonResponse({'data': data, 'success': True, 'reference': reference}, status=status)
+
+def _request_data(request):
+    """
+    returns the tuple (json-decoded request body, None), or (None, error response)
+    """
+    if request.method != "POST": return None, _error("request must be POST")
+    try: return json.loads(request.body.decode()), None
+    except: return None, _error('could not json-decode request body [{}]'.format(request.body.decode()))
+
+def _errmsg(e):
+    """
+    the error message returned by the API for the exception `e` raised when executing a token
+    """
+    if isinstance(e, TokenSignatureError): return 'token signature error [{}]'.format(str(e))
+    if isinstance(e, TokenFormatError): return 'token format error [{}]'.format(str(e))
+    if isinstance(e, TokenExpiredError): return 'token expired [{}]'.format(str(e))
+    if isinstance(e, TokenReplayError): return 'token already used [{}]'.format(str(e))
+    if isinstance(e, ItemDoesNotExistError): return 'item does not exist [{}]'.format(str(e))
+    if isinstance(e, TagDoesNotExistError): return 'tag does not exist [{}]'.format(str(e))
+    return 'error executing token [{}::{}]'.format(type(e), str(e))
+
+#############################################################
+## EXCEPTIONS
+class TokenSignatureError(RuntimeError): pass       # the token signature is invalid
+class TokenFormatError(RuntimeError): pass          # the token format is invalid
+class IllegalCommandError(RuntimeError): pass       # that command is not valid
+class ItemDoesNotExistError(RuntimeError): pass     # the item does not exist
+class TagDoesNotExistError(RuntimeError): pass      # the tag does not exist
+class TokenContentError(RuntimeError): pass         # the token content is invalid
+class TokenDefinitionError(RuntimeError): pass      # bad parameters when defining a token
+class TokenExpiredError(RuntimeError): pass         # the token has expired (or has no timestamp)
+class TokenReplayError(RuntimeError): pass          # the token has already been used
+class TagMoveError(RuntimeError): pass             # the tag can not be moved there
+
+
+#############################################################
+## TOKEN REPLAY WINDOW
+class TokenReplayWindow():
+    """
+    remembers the tokens used within the last `window` seconds, so that each is accepted only once
+
+    NOTES
+    - if `alias` is given the tokens are remembered in that Django cache (shared between processes,
+        using its atomic `add`), otherwise in a process-local `LRUCache` of at most `maxsize` tokens
+    - only a hash of the token is stored; the window should not be shorter than `Token.max_age`
+
+    USAGE
+        replay = TokenReplayWindow(3600)
+        replay.use(token)                   # True
+        replay.use(token)                   # False
+    """
+    def __init__(s, window, alias=None, maxsize=100000, prefix='tagtoken'):
+        s.window = window
+        s.alias = alias
+        s.prefix = prefix
+        s.lru = LRUCache(maxsize, ttl=window) if alias == None else None
+
+    def use(s, token):
+        """marks the token as used; returns False if it has already been used within the window"""
+        key = hashlib.sha256(token.encode()).hexdigest()
+        if s.lru != None: return s.lru.add(key, True)
+        return caches[s.alias].add('{}:{}'.format(s.prefix, key), True, timeout=s.window)
+
+    async def ause(s, token):
+        """async version of `use` (a shared cache is accessed via its async `aadd`)"""
+        key = hashlib.sha256(token.encode()).hexdigest()
+        if s.lru != None: return s.lru.add(key, True)
+        return await caches[s.alias].aadd('{}:{}'.format(s.prefix, key), True, timeout=s.window)
+
+
+#############################################################
+## TOKEN
+class Token():
+    """
+    allows definition tokens for the tag API
+
+    NOTES
+    - tokens are created in the compact format: a struct of version, command code, tag id and item
+        id (-1 meaning None), followed by the namespace, base64 encoded and signed; commands that 
+        have no code (eg those with parameters) use the legacy format `namespace::command::tag::item`
+    - tokens in either format are accepted; they are parsed once, on construction
+    - the signature is computed with a keyed HMAC object that is derived only once per signing key,
+        and is identical to that of the Django `Signer`
+    - if `cache` is set (see the `TAG_TOKEN_CACHE_SIZE` and `TAG_TOKEN_CACHE_TTL` settings), tokens 
+        that have been verified before are not verified and parsed again; as the cache is keyed on 
+        the signing key and salt, changing those invalidates the cached tokens
+    - if `max_age` is set (see the `TAG_TOKEN_MAX_AGE` setting), tokens are created with a timestamp
+        (as with the Django `TimestampSigner`), and tokens older than `max_age` seconds, or without 
+        timestamp, raise `TokenExpiredError`; as the timestamp is signed along with the token, this 
+        does not need any database access
+    """
+    __slots__ = ('version', 'namespace', 'command', 'parameters', 'tag_id', 'item_id', 'timestamp')
+
+    def __init__(s, token):
+        cache = s.cache
+        if cache != None and isinstance(token, str):
+            key = (settings.SECRET_KEY, s.salt, token)
+            fields = cache.get(key)
+            if fields != None:
+                s.version, s.namespace, s.command, parameters, s.tag_id, s.item_id, s.timestamp = fields
+                s.parameters = list(parameters)
+                s._check_age()
+                return
+        value = s.unsign(token)
+        value, sep, timestamp = value.rpartition(s.separators)
+        if sep and timestamp.isalnum(): s.timestamp = b62_decode(timestamp)
+        else: value, s.timestamp = value + sep + timestamp, None
+        s._check_age()
+        if s.separator in value: s._parse_legacy(value)
+        else: s._parse_compact(value)
+        if cache != None:
+            cache.set(key, (s.version, s.namespace, s.command, tuple(s.parameters), s.tag_id, s.item_id, s.timestamp))
+    
+    separators=":::"
+    separator="::"
+    separator2=":"
+    salt="token"
+
+    compact = True
+        # if False, tokens are created in the legacy format (eg while older servers are still running)
+
+    compact_version = 1
+        # the version of the compact format
+
+    command_codes = {'add': 1, 'remove': 2, 'toggle': 3}
+        # the commands that can be used in compact tokens
+
+    command_names = {code: command for command, code in command_codes.items()}
+
+    _struct = struct.Struct('>BBqq')
+        # version, command code, tag id, item id (followed by the namespace)
+
+    _keyed = None
+        # ((secret key, salt), keyed HMAC object); see `_keyed_hmac`
+
+    cache = LRUCache(
+        settings.TAG_TOKEN_CACHE_SIZE, getattr(settings, 'TAG_TOKEN_CACHE_TTL', None)
+    ) if getattr(settings, 'TAG_TOKEN_CACHE_SIZE', None) else None
+        # the optional cache of verified tokens, keyed on (secret key, salt, token); None means no caching
+
+    max_age = getattr(settings, 'TAG_TOKEN_MAX_AGE', None)
+        # the maximum token age in seconds; None means tokens are created without timestamp, and never expire
+
+    replay = TokenReplayWindow(
+        settings.TAG_TOKEN_REPLAY_WINDOW, getattr(settings, 'TAG_TOKEN_REPLAY_CACHE', None)
+    ) if getattr(settings, 'TAG_TOKEN_REPLAY_WINDOW', None) else None
+        # the optional replay window (see `TokenReplayWindow`) checked by `TagMixin.tag_token_execute`
+    
+    @classmethod
+    def create(cls, namespace, command, tag_id=None, item_id=None):
+        """
+        create a token
+        
+        PARAMETERS
+        - namespace: the token namespace (string, minimum 2 characters)
+        - command: the token command (can be a string, or a list of strings if it uses parameters)
+        - tag_id: the tag id (if any) this command relates to
+        - item_id: the item id (if any) this command relates to
+        """
+        return cls.sign(cls.payload(namespace, command, tag_id, item_id))
+
+    @classmethod
+    def create_many(cls, specs):
+        """
+        create many tokens at once
+
+        PARAMETERS
+        - specs: iterable of tuples (namespace, command, tag_id, item_id), as in `create`
+
+        NOTES
+        - the tokens are identical to those created by `create`
+        """
+        keyed = cls._keyed_hmac()
+        timestamp = cls._timestamp()
+        return [ cls.sign(cls.payload(*spec), keyed, timestamp) for spec in specs ]
+
+    @classmethod
+    def payload(cls, namespace, command, tag_id=None, item_id=None):
+        """
+        the (unsigned) token string (see `create`)
+        """
+        if len(namespace) < 2: raise TokenDefinitionError("namespace minimum 2 characters")
+        code = cls.command_codes.get(command) if isinstance(command, str) else None
+        ids = (tag_id, item_id)
+        if cls.compact and code and all(isinstance(i, int) or i == None for i in ids):
+            ids = [ -1 if i == None else i for i in ids ]
+            raw = cls._struct.pack(cls.compact_version, code, *ids) + namespace.encode()
+            return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+        if not isinstance(command, str): command = cls.separator2.join(command)
+        return cls.separator.join([namespace, command, str(tag_id), str(item_id)])
+
+    @classmethod
+    def signer(cls):
+        """
+        the signer used for signing the tokens
+        """
+        return Signer(sep=cls.separators, salt=cls.salt)
+
+    @classmethod
+    def _keyed_hmac(cls):
+        """
+        the keyed HMAC object of `signer` (to be copied for every token); see `Signer.signature`
+        """
+        params = (settings.SECRET_KEY, cls.salt)
+        keyed = cls._keyed
+        if keyed == None or keyed[0] != params:
+            signer = cls.signer()
+            hasher = getattr(hashlib, signer.algorithm)
+            key = hasher((signer.salt + 'signer' + signer.key).encode()).digest()
+            keyed = cls._keyed = (params, hmac.new(key, digestmod=hasher))
+        return keyed[1]
+
+    @classmethod
+    def _signature(cls, value, keyed):
+        """
+        the signature of value (as with `signer`) using the keyed HMAC object
+        """
+        mac = keyed.copy()
+        mac.update(value.encode())
+        return base64.urlsafe_b64encode(mac.digest()).strip(b"=").decode()
+
+    @classmethod
+    def _timestamp(cls):
+        """
+        the current timestamp (as in the Django `TimestampSigner`) if `max_age` is set, None else
+        """
+        if cls.max_age == None: return None
+        return b62_encode(int(time.time()))
+
+    @classmethod
+    def sign(cls, value, keyed=None, timestamp=None):
+        """
+        signs the value, adding a timestamp if `max_age` is set
+
+        NOTES
+        - `keyed` and `timestamp` are the results of `_keyed_hmac` and `_timestamp`, if already known
+        """
+        if timestamp == None: timestamp = cls._timestamp()
+        if timestamp != None: value = value + cls.separators + timestamp
+        if keyed == None: keyed = cls._keyed_hmac()
+        return value + cls.separators + cls._signature(value, keyed)
+
+    def _check_age(s):
+        """
+        raises `TokenExpiredError` if `max_age` is set, and the token is too old or has no timestamp
+        """
+        if s.max_age == None: return
+        if s.timestamp == None: raise TokenExpiredError("token without timestamp")
+        age = time.time() - s.timestamp
+        if age > s.max_age: raise TokenExpiredError("token age {:.0f}s > {}s".format(age, s.max_age))
+
+    @classmethod
+    def unsign(cls, token):
+        """
+        verifies the signature of the token, and returns the value (TokenSignatureError if invalid)
+
+        NOTES
+        - if the signature does not match the current key, the token is checked by `signer`, which
+            also accepts the fallback keys (`SECRET_KEY_FALLBACKS`)
+        """
+        if not isinstance(token, str): raise TokenSignatureError(token)
+        value, sep, signature = token.rpartition(cls.separators)
+        keyed = cls._keyed_hmac()
+        if sep and hmac.compare_digest(signature, cls._signature(value, keyed)): return value
+        try: return cls.signer().unsign(token)
+        except BadSignature: raise TokenSignatureError(token)
+
+    def _parse_legacy(s, value):
+        """
+        parses the value of a legacy format token
+        """
+        token = value.split(s.separator)
+        if len(token) != 4: raise TokenFormatError("Invalid token format [1]")
+        command = token[1].split(s.separator2)
+        s.version = 0
+        s.namespace = token[0]
+        s.command = command[0]
+        s.parameters = command[1:]
+        try: s.tag_id, s.item_id = (None if v == "None" else int(v) for v in token[2:])
+        except ValueError: raise TokenFormatError("Invalid token format [2]")
+
+    def _parse_compact(s, value):
+        """
+        parses the value of a compact format token
+        """
+        try:
+            raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+            s.version, code, tag_id, item_id = s._struct.unpack_from(raw)
+            s.namespace = raw[s._struct.size:].decode()
+        except Exception: raise TokenFormatError("Invalid token format [3]")
+        if s.version != s.compact_version: raise TokenFormatError("Invalid token version [{}]".format(s.version))
+        try: s.command = s.command_names[code]
+        except KeyError: raise TokenFormatError("Invalid command code [{}]".format(code))
+        s.parameters = []
+        s.tag_id = None if tag_id == -1 else tag_id
+        s.item_id = None if item_id == -1 else item_id
+
+    @property
+    def numparameters(s):
+        """
+        the number of token parameters
+        """ 
+        return len(s.parameters)
+
+    @property
+    def token(s):
+        """
+        the token fields as list of strings [namespace, command, tag_id, item_id], as in the legacy format
+            (the command including its parameters; ids that are None as "None")
+        """
+        command = s.separator2.join([s.command] + list(s.parameters))
+        return [s.namespace, command, str(s.tag_id), str(s.item_id)]
+
+    def __str__(s):
+        return "Token({})"
+
+
+#############################################################
+## TAG TOKENS
+class TagTokens(Mapping):
+    """
+    the tokens for one tag and item (the dict returned by `TagMixin.tag_token_all`), signed lazily
+
+    NOTES
+    - behaves like the dict {'tag': ..., 'add': ..., 'remove': ..., 'toggle': ...}, but every token is
+        only created (and signed) when it is accessed, eg from a template
+    """
+    commands = ('add', 'remove', 'toggle')
+
+    def __init__(s, model, tag_or_tag_id, item_id):
+        s.model = model
+        s.item_id = item_id
+        s.values = {'tag': tag_or_tag_id}
+
+    def __getitem__(s, key):
+        if not key in s.values:
+            if not key in s.commands: raise KeyError(key)
+            s.values[key] = s.model.tag_token(key, s.values['tag'], s.item_id)
+        return s.values[key]
+
+    def __iter__(s):
+        return iter(('tag',) + s.commands)
+
+    def __len__(s):
+        return 1 + len(s.commands)
+
+
+
+
+#############################################################
+## TAG QUERYSET
+class TagQuerySet(models.QuerySet):
+    """
+    the queryset of models using `TagMixin`
+
+    USAGE
+        items = MyTaggedClass.objects.filter(...).with_tags()
+        for item in items:
+            item.tags_str                       # no query
+            item.has_tag('aaa')                 # no query
+    """
+    def with_tags(self):
+        """
+        prefetches the tags of all records (a single query for the entire queryset)
+        """
+        return self.prefetch_related('_tag_references')
+
+
+#############################################################
+## TAG MIXIN
+class TagMixin(models.Model):
+    """
+    a mixin for Django models, linking them to the Tag model
+
+    NOTES
+    - this mixin contains a model field (`_tag_references`); in order for this field to actually
+        appear in the database table of the final the mixin must derive from `models.Model`*
+        
+    - for this table to not appear in the database, we need the Meta class with `abstract=True`
+
+    USAGE
+    Basic usage is here. See the tests for more detailed examples.
+    
+        class MyTaggedClass(TagMixin, models.Model):
+            ...
+            
+        tc = MyTaggedClass()
+        tc.tag_add('mytag1')
+        tc.tag_add('mytag1')
+        tc.tags                                 # {TAG('mytag1'), TAG('mytag2')}
+        tc.tag_remove('mytag1')
+        tc.tags                                 # {TAG('mytag2')}
+        MyTaggedClass.tagged_as('mytag2')       # set(tc)
+    
+    *see <http://stackoverflow.com/questions/6014282/django-creating-a-mixin-for-reusable-model-fields>
     """
 
     _tag_references = models.ManyToManyField(Tag, blank=True)
         # that's the key connection to the tags field
 
+    objects = TagQuerySet.as_manager()
+        # provides `with_tags`; models defining their own manager should derive it from `TagQuerySet`
+
     class Meta:
         abstract = True
 
@@ -479,25 +2273,63 @@ class TagMixin(models.Model):
         """
         removes a tag from a specific record
         """
-        self._tag_references.remove( Tag.get(tag_or_tagstr) )
+        self._tag_references.remove( Tag.get(tag_or_tagstr) )
+
+    def tag_toggle(self, tag_or_tagstr):
+        """
+        toggles a tag on a specific record, and returns whether the record has the tag afterwards
+
+        NOTES
+        - this is a conditional delete and, only if nothing was deleted, an insert; both are 
+            executed in a single transaction, so no separate read is needed
+        - like the bulk operations this does not send the `m2m_changed` signal
+        """
+        if self.id == None:
+            if self.save_if_necessary: self.save()
+        tag = Tag.get(tag_or_tagstr)
+        self._tags_prefetched_clear()
+        through, item_attname, tag_attname = self._tag_through()
+        with transaction.atomic():
+            deleted, _ = through.objects.filter(**{item_attname: self.id, tag_attname: tag.id}).delete()
+            if not deleted:
+                through.objects.bulk_create(
+                    [ through(**{item_attname: self.id, tag_attname: tag.id}) ], ignore_conflicts=True,
+                )
+        self._tag_references_changed([self])
+        return not deleted
+
+    async def atag_add(self, tag_or_tagstr):
+        """
+        async version of `tag_add`
+        """
+        if self.id == None:
+            if self.save_if_necessary: await self.asave()
+        await self._tag_references.aadd( await Tag.aget(tag_or_tagstr) )
+
+    async def atag_remove(self, tag_or_tagstr):
+        """
+        async version of `tag_remove`
+        """
+        await self._tag_references.aremove( await Tag.aget(tag_or_tagstr) )
 
-    def tag_toggle(self, tag_or_tagstr):
+    async def atag_toggle(self, tag_or_tagstr):
         """
-        toggles a tag on a specific record
+        async version of `tag_toggle` (the transaction runs in a thread)
         """
-        raise NotImplementedError('tag_toggle')
+        tag = await Tag.aget(tag_or_tagstr)
+        return await sync_to_async(self.tag_toggle)(tag)
 
     @property
     def tags(self):
         """
-        returns all tags from that specific record (as set)
+        returns all tags from that specific record (as set; no query if the tags have been prefetched)
         """
         return {t for t in self.tags_qs}
 
     @property
     def tags_str(self):
         """
-        returns all tags from that specific record (as string)
+        returns all tags from that specific record (as string; no query if the tags have been prefetched)
         """
         return " ".join([t.tag for t in self.tags_qs])
 
@@ -508,12 +2340,74 @@ class TagMixin(models.Model):
         """
         return self._tag_references.all()
 
+    @property
+    def _tags_prefetched(self):
+        """
+        returns the set of tag strings of that record if the tags have been prefetched, None else
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('_tag_references')
+        if prefetched == None: return None
+        cached = self.__dict__.get('_tags_prefetched_cache')
+        if cached == None or cached[0] is not prefetched:
+            cached = (prefetched, frozenset(t.tag for t in prefetched))
+            self.__dict__['_tags_prefetched_cache'] = cached
+        return cached[1]
+
+    def _tags_prefetched_clear(self):
+        """
+        discards the prefetched tags of that record (must be called whenever they are changed)
+        """
+        getattr(self, '_prefetched_objects_cache', {}).pop('_tag_references', None)
+
     def has_tag(self, tag_or_tagstr):
         """
         whether this item has that particular tag
+
+        NOTES
+        - if the tags have been prefetched (see `with_tags`) this is a set lookup, otherwise it
+            is a single query; in neither case is the tag created if it does not exist
+        - if `Tag.aliases` is true'ish a tag string that is an alias (and no tag, as in `Tag.get`)
+            stands for the tag it has been merged into; with prefetched tags, resolving it takes the
+            queries of `Tag.get_if_exists` and `Tag.get_aliases` (only if the tag string is not found)
+        """
+        tagstr = tag_or_tagstr.tag if isinstance(tag_or_tagstr, TagBase) else tag_or_tagstr
+        prefetched = self._tags_prefetched
+        if prefetched != None:
+            if tagstr in prefetched or isinstance(tag_or_tagstr, TagBase): return tagstr in prefetched
+            tag = self._tag_alias_target(tagstr)
+            return tag != None and tag.tag in prefetched
+        return self._tag_references.filter(self._has_tag_q(tag_or_tagstr)).exists()
+
+    async def ahas_tag(self, tag_or_tagstr):
+        """
+        async version of `has_tag`
+        """
+        tagstr = tag_or_tagstr.tag if isinstance(tag_or_tagstr, TagBase) else tag_or_tagstr
+        prefetched = self._tags_prefetched
+        if prefetched != None:
+            if tagstr in prefetched or isinstance(tag_or_tagstr, TagBase): return tagstr in prefetched
+            tag = await sync_to_async(self._tag_alias_target)(tagstr)
+            return tag != None and tag.tag in prefetched
+        return await self._tag_references.filter(self._has_tag_q(tag_or_tagstr)).aexists()
+
+    @staticmethod
+    def _has_tag_q(tag_or_tagstr):
         """
-        tag = Tag.get(tag_or_tagstr)
-        return tag in self.tags_qs
+        the Q object selecting the tag (see `has_tag`), or, if `Tag.aliases` is true'ish, the tag the
+        tag string stands for if it is an alias and no tag
+        """
+        if isinstance(tag_or_tagstr, TagBase): return Q(_tag=tag_or_tagstr.tag)
+        q = Q(_tag=tag_or_tagstr)
+        if not Tag.aliases: return q
+        return q | Q(Q(_aliases___alias=tag_or_tagstr), ~Exists(Tag.objects.filter(_tag=tag_or_tagstr)))
+
+    @staticmethod
+    def _tag_alias_target(tagstr):
+        """
+        the tag that tagstr stands for if it is an alias and no tag (and `Tag.aliases` is true'ish), None else
+        """
+        if not Tag.aliases or Tag.get_if_exists(tagstr) != None: return None
+        return Tag.get_aliases([tagstr]).get(tagstr)
     
     @classmethod
     def tags_fromqs(cls, self_queryset, as_queryset=False):
@@ -532,6 +2426,54 @@ class TagMixin(models.Model):
         return [tag for tag in tag_queryset.values_list('_tag', flat=True)]    
 
     @classmethod
+    def tag_counts_fromqs(cls, self_queryset, top=None, max_depth=None):
+        """
+        returns the tag counts for self_queryset, as list of tuples (tagstr, direct_count, subtree_count)
+
+        NOTES
+        - `direct_count` is the number of records in self_queryset tagged with that very tag, and
+            `subtree_count` the number of records tagged with the tag or any of its children (a
+            record tagged with several tags of the same subtree is counted once, consistent with
+            `tagged_as`)
+        - the counts are aggregated by the database (no tagging is retrieved): one query groups the
+            taggings by tag for the direct counts, and one groups them, per depth level, by their
+            ancestor at that level (a union of one group by per level) for the subtree counts; all
+            ancestors of the tags found are included (possibly with a direct count of 0)
+        - if `max_depth` is given only tags up to that depth are returned (but the subtree counts
+            still include the deeper tags)
+        - the result is ordered by tag string, or, if `top` is given, it contains the `top` tags with
+            the highest subtree count, in descending order
+
+        USAGE
+            qs = MyTaggedClass.objects.filter(...)
+            MyTaggedClass.tag_counts_fromqs(qs)                         # [('aaa', 0, 3), ('aaa::b', 2, 2), ...]
+            MyTaggedClass.tag_counts_fromqs(qs, top=10, max_depth=1)    # the 10 most used top-level tags
+        """
+        tag_field = cls._meta.get_field('_tag_references').m2m_reverse_field_name()
+        through, item_attname, tag_attname = cls._tag_through()
+        taggings = through.objects.filter(**{item_attname+'__in': self_queryset.values('pk')}).order_by()
+        direct = {
+            tagstr: (depth, count) for tagstr, depth, count in taggings
+            .values_list(tag_field+'___tag', tag_field+'___depth').annotate(count=Count(item_attname))
+        }
+        if not direct: return []
+        depth = max( d for d, count in direct.values() )
+        levels = range(1, (depth if max_depth == None else min(depth, max_depth)) + 1)
+        def level(d):
+            ancestor = Case(*[
+                When(**{tag_field+'___depth': d+k, 'then': F(tag_field+'__'+'_parent_tag__'*k+'_tag')})
+                for k in range(depth-d+1)
+            ], output_field=models.CharField())
+                # the ancestor at depth d of the tag of the tagging (following the parent links)
+            return (taggings.filter(**{tag_field+'___depth__gte': d}).annotate(ancestor=ancestor)
+                .values('ancestor').annotate(count=Count(item_attname, distinct=True)).values_list('ancestor', 'count'))
+        subtree = level(levels[0]).union(*[ level(d) for d in levels[1:] ], all=True)
+        counts = [ (tagstr, direct.get(tagstr, (0, 0))[1], count) for tagstr, count in subtree ]
+        if top == None: return sorted(counts)
+        return sorted(counts, key=lambda c: (-c[2], c[0]))[:top]
+
+    @classmethod
+    @instrumented('TagMixin.tagged_as')
     def tagged_as(cls, tag_or_tagstr, include_children=True, as_queryset=True):
         """
         returns all records that are tagged with this tag (and possibly its children)
@@ -541,14 +2483,276 @@ class TagMixin(models.Model):
             are returned, otherwise only with this tag
         - if `as_queryset` is true'ish, a queryset is returned that can be acted upon further
             (eg by filtering); otherwise a set is returned
+        - this is a single query, using a subquery on the relation table, so every record appears
+            only once, even if it is tagged with several tags of the family; the relation table should
+            have an index on (tag, item) for this to be fast (see `tag.operations.AddTagReferencesIndex`)
+        - the tag is not created if it does not exist
         """
-        tag = Tag.get(tag_or_tagstr)
-        if include_children: tag = tag.family
-        else: tag = [tag]
-        qset = cls.objects.filter(_tag_references__in=tag)
+        qset = cls.objects.filter(pk__in=cls._tagged_item_ids([tag_or_tagstr], include_children))
         if as_queryset: return qset
         return {record for record in qset}
 
+    ########################################
+    ## TAG QUERIES
+    @classmethod
+    def _tagged_item_ids(cls, tags_or_tagstrs, include_children=True):
+        """
+        returns a queryset of the ids of all records tagged with any of the tags (for use as subquery)
+
+        NOTES
+        - the tags can be tag objects or tag strings, or tuples (tag_or_tagstr, include_children) which
+            override `include_children` for that tag
+        - the tags are matched by tag string in the same query, so they do not need to be retrieved
+            (and tags that do not exist are not created)
+        """
+        field = cls._meta.get_field('_tag_references')
+        prefix = field.m2m_reverse_field_name() + '__'
+        through, item_attname, tag_attname = cls._tag_through()
+        q = Q(pk__in=[])
+        for tag in tags_or_tagstrs:
+            children = include_children
+            if isinstance(tag, tuple): tag, children = tag
+            tagstr = tag.tag if isinstance(tag, TagBase) else tag
+            if children: q = q | Tag.subtree_q(tagstr, prefix=prefix)
+            else: q = q | Q(**{prefix+'_tag': tagstr})
+        return through.objects.filter(q).values(item_attname)
+
+    @classmethod
+    def tagged_with(cls, all_of=(), any_of=(), none_of=(), include_children=True, queryset=None):
+        """
+        returns a queryset of all records tagged with all tags in all_of, any tag in any_of, and no tag in none_of
+
+        NOTES
+        - the result is a lazy queryset that is executed as a single query (every condition being a
+            subquery on the relation table), so it can be further filtered, paginated etc in the database
+        - tags can be tag objects or tag strings, or tuples (tag_or_tagstr, include_children); if
+            `include_children` is true'ish a tag also matches all its children
+        - empty conditions are ignored (ie `any_of=()` does not restrict the result)
+        - `queryset` allows to restrict the records (default: all records)
+
+        USAGE
+            MyTaggedClass.tagged_with(all_of=['aaa', 'bbb'], none_of=['aaa::ccc'])
+            MyTaggedClass.tagged_with(any_of=['aaa', ('bbb', False)], queryset=MyTaggedClass.objects.filter(...))
+        """
+        if queryset == None: queryset = cls.objects.all()
+        for tag in all_of: queryset = queryset.filter(pk__in=cls._tagged_item_ids([tag], include_children))
+        any_of, none_of = list(any_of), list(none_of)
+        if any_of: queryset = queryset.filter(pk__in=cls._tagged_item_ids(any_of, include_children))
+        if none_of: queryset = queryset.exclude(pk__in=cls._tagged_item_ids(none_of, include_children))
+        return queryset
+
+    @classmethod
+    def tagged_with_all(cls, tags_or_tagstrs, include_children=True, queryset=None):
+        """
+        returns a queryset of all records tagged with all of the tags (see `tagged_with`)
+        """
+        return cls.tagged_with(all_of=tags_or_tagstrs, include_children=include_children, queryset=queryset)
+
+    @classmethod
+    def tagged_with_any(cls, tags_or_tagstrs, include_children=True, queryset=None):
+        """
+        returns a queryset of all records tagged with any of the tags (see `tagged_with`)
+        """
+        tags_or_tagstrs = list(tags_or_tagstrs)
+        if not tags_or_tagstrs: return (queryset if queryset != None else cls.objects).none()
+        return cls.tagged_with(any_of=tags_or_tagstrs, include_children=include_children, queryset=queryset)
+
+    @classmethod
+    def tagged_without(cls, tags_or_tagstrs, include_children=True, queryset=None):
+        """
+        returns a queryset of all records tagged with none of the tags (see `tagged_with`)
+        """
+        return cls.tagged_with(none_of=tags_or_tagstrs, include_children=include_children, queryset=queryset)
+
+    ########################################
+    ## BULK TAGGING
+    @classmethod
+    def _tag_through(cls):
+        """
+        returns (through model, item id attribute, tag id attribute) of the `_tag_references` relation
+        """
+        field = cls._meta.get_field('_tag_references')
+        through = field.remote_field.through
+        item_attname = through._meta.get_field(field.m2m_field_name()).attname
+        tag_attname = through._meta.get_field(field.m2m_reverse_field_name()).attname
+        return through, item_attname, tag_attname
+
+    @classmethod
+    def _item_id(cls, item_or_item_id):
+        """
+        returns the item id (saving the item first if need be, and if `save_if_necessary`)
+        """
+        if isinstance(item_or_item_id, int): return item_or_item_id
+        if item_or_item_id.id == None:
+            if item_or_item_id.save_if_necessary: item_or_item_id.save()
+        return item_or_item_id.id
+
+    @classmethod
+    def _tags_prefetched_clear_many(cls, items):
+        """
+        discards the prefetched tags of all items (ignoring item ids)
+        """
+        for item in items:
+            if not isinstance(item, int): item._tags_prefetched_clear()
+
+    @classmethod
+    def _item_ids(cls, items):
+        """
+        returns the list of item ids for items (a queryset, or an iterable of items or item ids)
+        """
+        if isinstance(items, models.QuerySet): return list(items.values_list('id', flat=True))
+        return [ cls._item_id(item) for item in items ]
+
+    @staticmethod
+    def _tags_get(tags_or_tagstrs, create=True):
+        """
+        returns a dict tag_or_tagstr -> tag (tag strings are resolved with a single query)
+
+        NOTES
+        - if `create` is true'ish missing tags are created (see `Tag.get_many`); otherwise they are
+            simply omitted from the result
+        """
+        tags_or_tagstrs = list(tags_or_tagstrs)
+        if create: return Tag.get_many(tags_or_tagstrs)
+        existing = Tag._get_existing([t for t in tags_or_tagstrs if isinstance(t, str)])
+        result = {t: existing.get(t) if isinstance(t, str) else t for t in tags_or_tagstrs}
+        return {t: tag for t, tag in result.items() if tag != None}
+
+    @classmethod
+    def tag_add_many(cls, pairs):
+        """
+        adds many tags to many records at once
+
+        NOTES
+        - `pairs` is an iterable of (item_or_item_id, tag_or_tagstr) tuples; pairs whose tag is None are
+            ignored (as in `tag_add`)
+        - all tags are retrieved (or created) using `Tag.get_many`, and all relations are inserted
+            using `bulk_create` (one statement per `Tag.batch_size` relations); relations that
+            already exist are ignored
+        - `bulk_create` does not send the `m2m_changed` signal
+
+        USAGE
+            MyTaggedClass.tag_add_many([(rec1, 'tag1'), (rec1, 'aaa::111'), (rec2.id, 'tag1')])
+        """
+        pairs = [ (item, tag) for item, tag in pairs if tag != None ]
+        cls._tags_prefetched_clear_many(item for item, tag in pairs)
+        pairs = [ (cls._item_id(item), tag) for item, tag in pairs ]
+        tags = cls._tags_get(tag for item_id, tag in pairs)
+        cls._relations_insert( (item_id, tags[tag].id) for item_id, tag in pairs )
+
+    @classmethod
+    def tag_remove_many(cls, pairs):
+        """
+        removes many tags from many records at once (with a single delete statement)
+
+        NOTES
+        - `pairs` is an iterable of (item_or_item_id, tag_or_tagstr) tuples
+        - tags that do not exist are ignored (and not created)
+        """
+        pairs = list(pairs)
+        cls._tags_prefetched_clear_many(item for item, tag in pairs)
+        pairs = [ (cls._item_id(item), tag) for item, tag in pairs ]
+        tags = cls._tags_get((tag for item_id, tag in pairs), create=False)
+        cls._relations_delete( (item_id, tags[tag].id) for item_id, tag in pairs if tag in tags )
+
+    @classmethod
+    def _relations_insert(cls, relations):
+        """
+        inserts the (item_id, tag_id) relations (one statement per `Tag.batch_size` relations)
+
+        NOTES
+        - relations that already exist are ignored
+        """
+        relations = set(relations)
+        if not relations: return
+        through, item_attname, tag_attname = cls._tag_through()
+        through.objects.bulk_create(
+            [ through(**{item_attname: item_id, tag_attname: tag_id}) for item_id, tag_id in relations ],
+            batch_size=Tag.batch_size, ignore_conflicts=True,
+        )
+        cls._tag_references_changed({item_id for item_id, tag_id in relations})
+
+    @classmethod
+    def _relations_delete(cls, relations):
+        """
+        deletes the (item_id, tag_id) relations (with a single delete statement)
+        """
+        item_ids_by_tag_id = {}
+        for item_id, tag_id in relations:
+            item_ids_by_tag_id.setdefault(tag_id, set()).add(item_id)
+        if not item_ids_by_tag_id: return
+        through, item_attname, tag_attname = cls._tag_through()
+        q = Q()
+        for tag_id, item_ids in item_ids_by_tag_id.items():
+            q = q | Q(**{tag_attname: tag_id, item_attname+'__in': item_ids})
+        through.objects.filter(q).delete()
+        cls._tag_references_changed(set(chain.from_iterable(item_ids_by_tag_id.values())))
+
+    @classmethod
+    def _tag_references_changed(cls, items):
+        """
+        called after the tags of items (a queryset, or an iterable of items or item ids) have been 
+        changed other than through the related manager (ie without the `m2m_changed` signal)
+        """
+        pass
+
+    @classmethod
+    def bulk_tag(cls, items, tags_or_tagstrs):
+        """
+        adds all tags to all items (a queryset, or an iterable of items or item ids)
+
+        USAGE
+            MyTaggedClass.bulk_tag(MyTaggedClass.objects.filter(...), ['tag1', 'aaa::111'])
+        """
+        tags_or_tagstrs = list(tags_or_tagstrs)
+        cls.tag_add_many( (item_id, tag) for item_id in cls._item_ids(items) for tag in tags_or_tagstrs )
+
+    @classmethod
+    def bulk_untag(cls, items, tags_or_tagstrs):
+        """
+        removes all tags from all items (a queryset, or an iterable of items or item ids)
+
+        NOTES
+        - this executes a single delete statement (plus the retrieval of the tags from tag strings);
+            querysets are used as subquery, so the items are not retrieved
+        """
+        tags = cls._tags_get(tags_or_tagstrs, create=False)
+        if not tags: return
+        if not isinstance(items, models.QuerySet):
+            items = list(items)
+            cls._tags_prefetched_clear_many(items)
+            items = cls._item_ids(items)
+        through, item_attname, tag_attname = cls._tag_through()
+        through.objects.filter(**{
+            item_attname+'__in':    items,
+            tag_attname+'__in':     [tag.id for tag in tags.values()],
+        }).delete()
+        cls._tag_references_changed(items)
+
+    def tag_set(self, tags_or_tagstrs):
+        """
+        sets the tags of a specific record (ie adds the missing ones, and removes all others)
+
+        NOTES
+        - the current tags are retrieved with a single query, and only the difference is written; the
+            read and the writes run in a single transaction
+        """
+        tags = self._tags_get(tags_or_tagstrs)
+        item_id = self._item_id(self)
+        self._tags_prefetched_clear()
+        target = {tag.id for tag in tags.values() if isinstance(tag, Tag)}
+        through, item_attname, tag_attname = self._tag_through()
+        with transaction.atomic():
+            current = set(self._tag_references.values_list('id', flat=True))
+            if target - current:
+                through.objects.bulk_create(
+                    [ through(**{item_attname: item_id, tag_attname: tag_id}) for tag_id in target - current ],
+                    batch_size=Tag.batch_size, ignore_conflicts=True,
+                )
+            if current - target:
+                through.objects.filter(**{item_attname: item_id, tag_attname+'__in': current - target}).delete()
+            if current != target: self._tag_references_changed([self])
+
     ########################################
     ## TAG TOKEN XXX
     @classmethod
@@ -582,10 +2786,14 @@ class TagMixin(models.Model):
         """
         return s.tag_token("toggle", tag_or_tag_id, s.id)
 
-    def tag_token_all(s, tag_or_tag_id):
+    def tag_token_all(s, tag_or_tag_id, lazy=False):
         """
         return a dict of all tokens for this tag, item
+
+        NOTES
+        - if `lazy` is true'ish the tokens are only created when accessed (see `TagTokens`)
         """
+        if lazy: return TagTokens(s.__class__, tag_or_tag_id, s.id)
         return {
             'tag':      tag_or_tag_id,
             'add':      s.tag_token_add(tag_or_tag_id),
@@ -599,15 +2807,77 @@ class TagMixin(models.Model):
         returns a list of dicts for all tags, and all tokens for each of those tags, for this item
         
         NOTES
-        - all tags being defined as all Tag.all_leaves
-        - the dicts are those created by `tag_token_all`
+        - all tags being defined as all `Tag.all_leaves`, in that order
+        - the dicts are those created by `tag_token_all` (lazy iff `tag_tokens_lazy`)
+        - for many items use `tags_token_all_many`
+        """
+        return s.tags_token_all_many([s])[s.id]
+
+    tag_tokens_lazy = False
+        # if True, the tokens returned by `tags_token_all` are only created when accessed
+
+    @classmethod
+    def tags_token_all_many(cls, items, lazy=None):
         """
-        return [ s.tag_token_all(t) for t in Tag.all_leaves()]
+        returns a dict item id -> `tags_token_all` for all items
+
+        NOTES
+        - the leaves are those of `Tag.all_leaves`, in that order; they are retrieved with a single
+            query per call, and shared by all items
+        - the tokens are either all created at once (see `Token.create_many`) or, if `lazy` is
+            true'ish, when accessed (see `TagTokens`); `lazy` defaults to `tag_tokens_lazy`
+
+        USAGE
+        In the `views.py` file:
+
+            items = SomeModel.objects.filter(...)
+            context['items'] = items
+            context['tokens'] = SomeModel.tags_token_all_many(items)
+        """
+        if lazy == None: lazy = cls.tag_tokens_lazy
+        items = list(items)
+        leaves = tuple(Tag.all_leaves())
+        if lazy:
+            return { item.id: [ TagTokens(cls, tag, item.id) for tag in leaves ] for item in items }
+        commands = TagTokens.commands
+        tokens = iter(Token.create_many(
+            (cls.__name__, command, tag.id, item.id) for item in items for tag in leaves for command in commands
+        ))
+        return {
+            item.id: [ dict(chain((('tag', tag),), ((command, next(tokens)) for command in commands)))
+                        for tag in leaves ]
+            for item in items
+        }
         
 
     ########################################
     ## TAG TOKEN EXECUTE
     @classmethod
+    def _token(cls, token):
+        """
+        returns the parsed token, after checking its signature, age and namespace
+
+        NOTES
+        - all checks happen before any database query; the replay window is checked separately
+            (see `_token_use`), once the item, the tag and the command have been validated
+        """
+        t = Token(token)
+        if t.namespace != cls.__name__: 
+            raise TokenContentError("using {} token for a {} object".format(t.namespace, cls.__name__))
+        return t
+
+    @classmethod
+    def _token_use(cls, token):
+        """marks the token as used in the replay window (if any); raises TokenReplayError if it already was"""
+        if Token.replay != None and not Token.replay.use(token): raise TokenReplayError(token)
+
+    @classmethod
+    async def _atoken_use(cls, token):
+        """async version of `_token_use`"""
+        if Token.replay != None and not await Token.replay.ause(token): raise TokenReplayError(token)
+
+    @classmethod
+    @instrumented('TagMixin.tag_token_execute')
     def tag_token_execute(cls, token, params=None):
         """
         execute a token command
@@ -617,30 +2887,134 @@ class TagMixin(models.Model):
         - `params` are the parameters 
         ##(can be bytes; if string assumes it is json encoded)
         """
-        t = Token(token)
-        if t.namespace != cls.__name__: 
-            raise TokenContentError("using {} token for a {} object".format(t.namespace, cls.__name__))
+        t = cls._token(token)
 
         try: item = cls.objects.get(id=t.item_id)
         except: raise ItemDoesNotExistError(t.item_id)
         
-        try: tag = Tag.objects.get(id=t.tag_id)
+        try: tag = Tag.get_by_id(t.tag_id)
         except: raise TagDoesNotExistError(t.tag_id)
+
+        if not t.command in TagTokens.commands: raise IllegalCommandError(t.command)
+        cls._token_use(token)
+            # only a token that passed all checks is used up
         
         result = {'item_id': t.item_id, 'tag_id': t.tag_id, 'tag': tag.tag, 'short_tag': tag.short_tag}
         
         # add/remove/toggle
-        if    t.command == "add":     item.tag_add(tag)
-        elif  t.command == "remove":  item.tag_remove(tag)
-        elif  t.command == "toggle":  item.tag_toggle(tag)
+        if t.command == "add":        
+            item.tag_add(tag)
+            result['item_has_tag'] = True
+        elif t.command == "remove":   
+            item.tag_remove(tag)
+            result['item_has_tag'] = False
+        else:   
+            result['item_has_tag'] = item.tag_toggle(tag)
 
-        # error
-        else:
-            raise IllegalCommandError(t.command)
+        return result
+
+    @classmethod
+    async def atag_token_execute(cls, token, params=None):
+        """
+        async version of `tag_token_execute`
+
+        NOTES
+        - the queries use the async ORM, which still runs them in a thread (see `tag_as_async_view`);
+            a shared replay window is checked using the async cache API
+        """
+        t = cls._token(token)
+
+        try: item = await cls.objects.aget(id=t.item_id)
+        except: raise ItemDoesNotExistError(t.item_id)
+        
+        try: tag = await Tag.aget_by_id(t.tag_id)
+        except: raise TagDoesNotExistError(t.tag_id)
+
+        if not t.command in TagTokens.commands: raise IllegalCommandError(t.command)
+        await cls._atoken_use(token)
+        
+        result = {'item_id': t.item_id, 'tag_id': t.tag_id, 'tag': tag.tag, 'short_tag': tag.short_tag}
+        
+        # add/remove/toggle
+        if t.command == "add":        
+            await item.atag_add(tag)
+            result['item_has_tag'] = True
+        elif t.command == "remove":   
+            await item.atag_remove(tag)
+            result['item_has_tag'] = False
+        else:   
+            result['item_has_tag'] = await item.atag_toggle(tag)
 
-        result['item_has_tag'] = item.has_tag(tag)
         return result
 
+    @classmethod
+    @instrumented('TagMixin.tag_token_execute_many')
+    def tag_token_execute_many(cls, tokens, params=None):
+        """
+        execute many token commands at once
+
+        NOTES
+        - returns a list with one entry per token, in the same order as `tokens`; entries are either
+            `{'success': True, 'data': ...}` where data is as returned by `tag_token_execute`, or
+            `{'success': False, 'errmsg': ...}`; an invalid token does not affect the other ones
+        - all tokens are verified first; then the items and the tags are retrieved with one query
+            each, and the existing relations with one more; all changes are written in a single 
+            transaction (at most one insert and one delete statement)
+        - a token is marked as used in the replay window (if any) only once its item and tag 
+            have been found
+        - the commands are applied in order, so eg toggling the same tag twice is a no-op
+        - `bulk_create` does not send the `m2m_changed` signal
+
+        USAGE
+            results = MyTaggedClass.tag_token_execute_many([token1, token2, token3])
+        """
+        results = [None]*len(tokens)
+        valid = []
+        for n, token in enumerate(tokens):
+            try:
+                t = cls._token(token)
+                if not t.command in TagTokens.commands: raise IllegalCommandError(t.command)
+                valid.append((n, t))
+            except Exception as e:
+                results[n] = {'success': False, 'errmsg': _errmsg(e)}
+
+        items = cls.objects.in_bulk({t.item_id for n, t in valid if t.item_id != None})
+        tags = Tag.objects.in_bulk({t.tag_id for n, t in valid if t.tag_id != None})
+        relations = {(t.item_id, t.tag_id) for n, t in valid if t.item_id in items and t.tag_id in tags}
+        through, item_attname, tag_attname = cls._tag_through()
+
+        with transaction.atomic():
+            existing = set()
+            if relations:
+                existing = set(through.objects.filter(**{
+                    item_attname+'__in':    {item_id for item_id, tag_id in relations},
+                    tag_attname+'__in':     {tag_id for item_id, tag_id in relations},
+                }).values_list(item_attname, tag_attname)) & relations
+            
+            state = set(existing)
+            for n, t in valid:
+                if not t.item_id in items: e = ItemDoesNotExistError(t.item_id)
+                elif not t.tag_id in tags: e = TagDoesNotExistError(t.tag_id)
+                elif Token.replay != None and not Token.replay.use(tokens[n]): e = TokenReplayError(tokens[n])
+                else: e = None
+                if e != None:
+                    results[n] = {'success': False, 'errmsg': _errmsg(e)}
+                    continue
+                relation = (t.item_id, t.tag_id)
+                if    t.command == "add":     state.add(relation)
+                elif  t.command == "remove":  state.discard(relation)
+                else:                         state ^= {relation}
+                tag = tags[t.tag_id]
+                results[n] = {'success': True, 'data': {
+                    'item_id': t.item_id, 'tag_id': t.tag_id, 'tag': tag.tag, 'short_tag': tag.short_tag,
+                    'item_has_tag': relation in state,
+                }}
+
+            cls._relations_insert(state - existing)
+            cls._relations_delete(existing - state)
+
+        return results
+
     ########################################
     ## TAG AS VIEW
     @classmethod
@@ -653,6 +3027,9 @@ class TagMixin(models.Model):
 
         - the data has to be transmitted in json, not URL encoded; fields:
             - `token`: the API token that determines the request
+            - `tokens`: alternatively, a list of tokens that are executed together (see 
+                `tag_token_execute_many`); `data` is then a list of per-token results, each with
+                its own `success`, and `errmsg` or `data` fields
             - `parameters`: additional parameters (currently ignored)
             - `reference`: frontend reference data, returned unchanged*
             
@@ -714,34 +3091,196 @@ class TagMixin(models.Model):
         @csrf_exempt
         def view(request):
     
-            if request.method != "POST": return _error("request must be POST")
-            
-            try: data = json.loads(request.body.decode())
-            except: 
-                raise
-                return _error('could not json-decode request body [{}]'.format(request.body.decode()))
+            data, error = _request_data(request)
+            if error: return error
+
+            params = data['params'] if 'params' in data else None
+            reference = data['reference'] if 'reference' in data else None
+
+            if 'tokens' in data:
+                if not isinstance(data['tokens'], list): return _error('tokens must be a list', reference)
+                try: results = cls.tag_token_execute_many(data['tokens'], params)
+                except Exception as e: return _error(_errmsg(e), reference)
+                return _success(results, reference)
 
             try: token = data['token']
             except: return _error('missing token')
+            
+            try: result = cls.tag_token_execute(token, params)
+            except Exception as e: 
+                #raise
+                return _error(_errmsg(e), reference)
+
+            return _success(result, reference)
+
+        return view
+
+    @classmethod
+    def tag_as_async_view(cls):
+        """
+        returns an async API view function (for ASGI deployments); otherwise identical to `tag_as_view`
+
+        NOTES
+        - single tokens are executed with the async ORM (see `atag_token_execute`), so the request 
+            does not hold a worker while it waits; note that Django's async ORM still runs each query 
+            (and `atag_toggle`, and `Tag.aget` on a cache miss) synchronously in a thread, so the 
+            database work itself is not made asynchronous; lists of tokens run `tag_token_execute_many` 
+            in a thread
+
+        USAGE
+        In the `urls.py` file:
+
+            urlpatterns += [
+                url(r'^api/somemodel$', SomeModel.tag_as_async_view(), name="api_somemodel_tag"),
+            ]
+        """
+        async def view(request):
+    
+            data, error = _request_data(request)
+            if error: return error
 
             params = data['params'] if 'params' in data else None
             reference = data['reference'] if 'reference' in data else None
+
+            if 'tokens' in data:
+                if not isinstance(data['tokens'], list): return _error('tokens must be a list', reference)
+                try: results = await sync_to_async(cls.tag_token_execute_many)(data['tokens'], params)
+                except Exception as e: return _error(_errmsg(e), reference)
+                return _success(results, reference)
+
+            try: token = data['token']
+            except: return _error('missing token')
             
-            try: result = cls.tag_token_execute(token, params)
-            except TokenSignatureError as e: return _error('token signature error [{}]'.format(str(e)), reference)
-            except TokenFormatError as e: return _error('token format error [{}]'.format(str(e)), reference)
-            #except ParamsError as e: return _error('parameter error [{}]'.format(str(e)), reference)
-            except ItemDoesNotExistError as e: return _error('item does not exist [{}]'.format(str(e)), reference)
-            except TagDoesNotExistError as e: return _error('tag does not exist [{}]'.format(str(e)), reference)
+            try: result = await cls.atag_token_execute(token, params)
             except Exception as e: 
-                #raise
-                return _error('error executing token [{}::{}]'.format(type(e), str(e)), reference)
+                return _error(_errmsg(e), reference)
 
             return _success(result, reference)
 
+        view.csrf_exempt = True
+            # this is what `csrf_exempt` does; the decorator itself does not support async views 
         return view
     
 
+#############################################################
+## DENORMALIZED TAG MIXIN
+class DenormalizedTagMixin(TagMixin):
+    """
+    a `TagMixin` that also stores the tags of every record in its own table, so reading them needs no join
+
+    NOTES
+    - `_tags_str` holds the sorted tag strings (as returned by `tags_str`), and `_tags_ids` the ids of
+        those tags (sorted, and separated as well as enclosed by spaces, eg " 3 7 12 ")
+    - the fields are updated whenever tags are added or removed using the `TagMixin` methods, the 
+        bulk methods, or the related manager (via the `m2m_changed` signal), and when tags are deleted,
+        moved or merged (`delete`, `deltag`, `move`, `merge_into`); they have to be rebuilt after
+        changes that bypass those (eg raw SQL), using the `tag_denormalize` management command
+    - `tags_str` and `tag_ids` read the fields, and `tagged_as_denormalized` filters on them; note 
+        that on records already retrieved the fields are only updated by the methods changing the 
+        tags of that record (eg `tag_add`, `tag_toggle`, `tag_set`), not by the bulk methods
+
+    USAGE
+        class MyTaggedClass(DenormalizedTagMixin, models.Model):
+            ...
+
+        MyTaggedClass.objects.filter(...).only('title', '_tags_str')                # no join
+        MyTaggedClass.tagged_as_denormalized('aaa')                                 # no join
+    """
+
+    _tags_str = models.TextField(blank=True, default="", editable=False)
+        # the sorted tag strings, separated by spaces
+
+    _tags_ids = models.TextField(blank=True, default=" ", editable=False)
+        # the sorted tag ids, separated and enclosed by spaces
+
+    class Meta:
+        abstract = True
+
+    @property
+    def tags_str(self):
+        """
+        returns all tags from that specific record (as string; from the denormalized field, no query)
+        """
+        return self._tags_str
+
+    @property
+    def tag_ids(self):
+        """
+        returns the ids of all tags from that specific record (as list; from the denormalized field, no query)
+        """
+        return [ int(tag_id) for tag_id in self._tags_ids.split() ]
+
+    @classmethod
+    def tagged_as_denormalized(cls, tag_or_tagstr, include_children=True):
+        """
+        returns a queryset of all records tagged with that tag (or its children), using the denormalized field
+
+        NOTES
+        - the tag ids are retrieved with a single query (none for a tag object without children); the 
+            records are then filtered on the denormalized field only (`LIKE` conditions, no join)
+        """
+        if isinstance(tag_or_tagstr, TagBase) and not include_children: tag_ids = [tag_or_tagstr.id]
+        else:
+            tagstr = tag_or_tagstr.tag if isinstance(tag_or_tagstr, TagBase) else tag_or_tagstr
+            if include_children: tag_ids = list(Tag.subtree_qs(tagstr).values_list('id', flat=True))
+            else: tag_ids = list(Tag.objects.filter(_tag=tagstr).values_list('id', flat=True))
+        if not tag_ids: return cls.objects.none()
+        q = Q()
+        for tag_id in tag_ids: q = q | Q(_tags_ids__contains=' {} '.format(tag_id))
+        return cls.objects.filter(q)
+
+    @classmethod
+    def _tag_references_changed(cls, items):
+        cls.tags_denormalize(items)
+
+    @classmethod
+    def tags_denormalize(cls, items):
+        """
+        updates the denormalized fields of items (a queryset, or an iterable of items or item ids)
+
+        NOTES
+        - per `Tag.batch_size` items, the tags are retrieved with a single query, and the fields are
+            updated with a single `bulk_update` statement
+        - the fields of the items passed as objects are updated as well
+        """
+        if isinstance(items, models.QuerySet): items = items.values_list('id', flat=True)
+        objects = {}
+        for item in items:
+            if isinstance(item, int): objects.setdefault(item, None)
+            else: objects[item.id] = item
+        item_ids = [ item_id for item_id in objects if item_id != None ]
+        through, item_attname, tag_attname = cls._tag_through()
+        tagstr_lookup = through._meta.get_field(tag_attname).name + '___tag'
+        for n in range(0, len(item_ids), Tag.batch_size):
+            tags = { item_id: [] for item_id in item_ids[n:n+Tag.batch_size] }
+            for item_id, tag_id, tagstr in through.objects.filter(**{item_attname+'__in': list(tags)}).values_list(
+                item_attname, tag_attname, tagstr_lookup
+            ):
+                tags[item_id].append((tagstr, tag_id))
+            updates = []
+            for item_id, item_tags in tags.items():
+                item = objects[item_id] or cls(id=item_id)
+                item._tags_str = " ".join(sorted( tagstr for tagstr, tag_id in item_tags ))
+                item._tags_ids = " {} ".format(" ".join(str(t) for t in sorted( tag_id for tagstr, tag_id in item_tags )))
+                updates.append(item)
+            cls.objects.bulk_update(updates, ['_tags_str', '_tags_ids'])
+
+@receiver(m2m_changed)
+def _tag_references_m2m_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """updates the denormalized fields when tags are changed via the related manager (see `DenormalizedTagMixin`)"""
+    items_model = model if reverse else type(instance)
+    if not issubclass(items_model, DenormalizedTagMixin): return
+    if sender is not items_model._tag_through()[0]: return
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'): items_model.tags_denormalize([instance])
+    elif action == 'pre_clear':
+        instance._tags_denormalize_pending = list(items_model.objects.filter(_tag_references=instance).values_list('id', flat=True))
+    elif action == 'post_clear':
+        items_model.tags_denormalize(instance.__dict__.pop('_tags_denormalize_pending', []))
+    elif action in ('post_add', 'post_remove'):
+        items_model.tags_denormalize(pk_set)
+
+
 #####################################################################################################
 ## _DUMMY      
 class _Dummy(TagMixin, models.Model):
@@ -756,6 +3295,18 @@ class _Dummy(TagMixin, models.Model):
         return "{1}(title='{0.title}')".format(self, self.__class__.__name__)
 
 
+class _DenormalizedDummy(DenormalizedTagMixin, models.Model):
+    """
+    a dummy model allowing to test denormalized tagging
+    """
+
+    title = models.CharField(max_length=32, unique=True, blank=True, default="", null=False, db_index=True)
+        # some text that allows to identify the record
+
+    def __repr__(self):
+        return "{1}(title='{0.title}')".format(self, self.__class__.__name__)
+
+
 # THIS CODE SHOULD BE CONVERTED INTO UNIT TESTS
 # TODO
 # 
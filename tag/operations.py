@@ -0,0 +1,70 @@
+"""
+migration operations for the tag app
+
+Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
+Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
+"""
+from django.db import models
+from django.db.migrations.operations.base import Operation
+
+import hashlib
+
+
+#####################################################################################################
+## ADD TAG REFERENCES INDEX
+class AddTagReferencesIndex(Operation):
+    """
+    adds an index on (tag, item) to the relation table of a model using `TagMixin`
+
+    NOTES
+    - the relation table automatically created for `_tag_references` is indexed on (item, tag), which
+        is the wrong order for finding all items tagged with a given tag (eg in `tagged_as`); with
+        this index those queries only have to read the index
+    - the index is created with the schema editor (`add_index`, so the DDL is that of the backend), but
+        it is not part of the migration state: the relation table is created automatically for the
+        m2m field, and has no model state of its own that could hold it (an explicit `through` model
+        would, but `TagMixin` is abstract and used by many models); hence `state_forwards` does nothing,
+        and the operation has to be added via a migration of the app defining the model
+
+    USAGE
+    In a migration of the app defining `MyTaggedClass`:
+
+        from tag.operations import AddTagReferencesIndex
+
+        class Migration(migrations.Migration):
+            dependencies = [...]
+            operations = [
+                AddTagReferencesIndex('mytaggedclass'),
+            ]
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def deconstruct(self):
+        return (self.__class__.__name__, [self.model_name], {})
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _index(self, app_label, state):
+        """returns (relation model, index on (tag, item))"""
+        model = state.apps.get_model(app_label, self.model_name)
+        field = model._meta.get_field('_tag_references')
+        through = field.remote_field.through
+        table = through._meta.db_table
+        name = "{}_{}_tag_item".format(table[:30], hashlib.md5(table.encode()).hexdigest()[:8])
+        return through, models.Index(fields=[field.m2m_reverse_field_name(), field.m2m_field_name()], name=name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        through, index = self._index(app_label, to_state)
+        if self.allow_migrate_model(schema_editor.connection.alias, through): schema_editor.add_index(through, index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        through, index = self._index(app_label, from_state)
+        if self.allow_migrate_model(schema_editor.connection.alias, through): schema_editor.remove_index(through, index)
+
+    def describe(self):
+        return "Add (tag, item) index to the tag relation table of {}".format(self.model_name)
@@ -4,16 +4,29 @@ testing code for `tag.py`
 Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
 Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
 """
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, RequestFactory
 from django.conf import settings
-from django.core.urlresolvers import reverse_lazy, reverse
+from django.core.management import call_command
+from django.core.signing import TimestampSigner
+from django.urls import reverse_lazy, reverse
 #from Presmo.tools import ignore_failing_tests, ignore_long_tests
 
 from django.db.utils import IntegrityError
+from django.http import Http404
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test.utils import CaptureQueriesContext
+from django.db.models.signals import post_delete
+
+import inspect
+import io
+import json
+import time
+from unittest import mock
 
 
 from .models import *
-from .models.tag import _Dummy
+from .models.tag import _Dummy, _DenormalizedDummy
 
 class TestTags(TestCase):
     """
@@ -192,8 +205,591 @@ class TestTags(TestCase):
         s.assertEqual( aaa_bbb_ccc.direct_children, set())
         s.assertEqual( aaa_bbb_ccc.children, set())
         s.assertEqual( aaa_bbb_ccc.family, {aaa_bbb_ccc})
+
+    ####################################################################
+    ## TEST ANCESTORS
+    def test_ancestors(s):
+        """test the ancestor chain and the stored depth"""
+
+        s.assertEqual( Tag.ancestor_tagstrs('a1::b1::c1'), ['a1', 'a1::b1'] )
+        s.assertEqual( Tag.ancestor_tagstrs('a1'), [] )
+
+        with s.assertNumQueries(7): c1 = Tag.get('a1::b1::c1')
+            # get_if_exists, one query for all ancestors, three inserts, two recounts of the parents
+        with s.assertNumQueries(0): s.assertEqual( c1.depth, 3 )
+        with s.assertNumQueries(1): s.assertEqual( [t.tag for t in c1.ancestors], ['a1', 'a1::b1'] )
+        s.assertEqual( [t.tag for t in TagBase.ancestors.fget(c1)], ['a1', 'a1::b1'] )
+        s.assertEqual( Tag.get('a1').ancestors, () )
+        s.assertEqual( RootTag().ancestors, () )
+
+        with s.assertNumQueries(6): c2 = Tag.get('a1::b1::c2::d2')
+            # get_if_exists, one query for all ancestors, two inserts, two recounts of the parents
+        s.assertEqual( c2.parent.tag, 'a1::b1::c2' )
+        s.assertEqual( Tag.get_if_exists('a1::b1::c2::d2').depth, 4 )
+        s.assertEqual( Tag(_tag='a1::b1::c2').depth, 1 )
+            # unsaved and without parent
+
+    ####################################################################
+    ## TEST GET MANY
+    def test_get_many(s):
+        """test bulk retrieval and creation of tags"""
+
+        Tag.get('m1::existing')
+        tagstrs = ['m{}::n{}::o{}'.format(i, j, k) for i in range(3) for j in range(10) for k in range(10)]
+        tagstrs += ['m1::existing', 'm2', None, '']
+        with s.assertNumQueries(10):
+            tags = Tag.get_many(tagstrs)
+                # one query retrieving existing tags, then per level one insert, one retrieval and one recount
+        s.assertEqual( len(Tag.objects.all()), 2 + 2 + 30 + 300 )
+        s.assertEqual( list(tags), tagstrs )
+        s.assertEqual( tags['m1::existing'], Tag.get('m1::existing') )
+        s.assertEqual( tags['m2::n3::o4'].tag, 'm2::n3::o4' )
+        s.assertEqual( tags['m2::n3::o4'].parent, Tag.get('m2::n3') )
+        s.assertEqual( Tag.get_if_exists('m2::n3::o4').depth, 3 )
+        s.assertEqual( tags[None], None )
+        s.assertEqual( tags[''].__class__, RootTag )
+        s.assertTrue( all(t.id for t in tags.values() if isinstance(t, Tag)) )
+
+        with s.assertNumQueries(1): tags2 = Tag.get_many(tagstrs)
+        s.assertEqual( {t: tags2[t].id for t in tagstrs[:-2]}, {t: tags[t].id for t in tagstrs[:-2]} )
+        s.assertEqual( Tag.get_many([tags['m2']]), {tags['m2']: tags['m2']} )
         
 
+class TestTagCache(TestCase):
+    """
+    testing the process-local tag cache
+    """
+    def setUp(s):
+        Tag.cache = TagCache(maxsize=10)
+
+    def tearDown(s):
+        Tag.cache = None
+
+    def test_lru(s):
+        """test the underlying LRU cache"""
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        s.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+            # evicts 'b', which is now the least recently used
+        s.assertEqual(lru.get('b'), None)
+        s.assertEqual(lru.get('c'), 3)
+        s.assertEqual(len(lru), 2)
+        s.assertEqual(lru.stats['hits'], 2)
+        s.assertEqual(lru.stats['misses'], 1)
+        s.assertEqual(lru.pop('a'), 1)
+        s.assertEqual(len(lru), 1)
+
+        lru = LRUCache(maxsize=2, ttl=0.05)
+        lru.set('a', 1)
+        s.assertEqual(lru.get('a'), 1)
+        time.sleep(0.1)
+        s.assertEqual(lru.get('a'), None)
+        s.assertEqual(len(lru), 0)
+
+    def test_cache(s):
+        """test caching and invalidation of tags"""
+        tag = Tag.get('cache::a::b')
+        with s.assertNumQueries(1): s.assertEqual(Tag.get('cache::a::b'), tag)
+        with s.assertNumQueries(0): s.assertEqual(Tag.get('cache::a::b'), tag)
+        with s.assertNumQueries(0): s.assertEqual(Tag.get_by_id(tag.id), tag)
+        s.assertEqual(Tag.cache.stats['hits'], 2)
+
+        Tag.get('cache::a')
+        with s.assertNumQueries(1): Tag.get_many(['cache::a::b'])
+            # 'cache' is not yet cached
+        with s.assertNumQueries(0): Tag.get_many(['cache::a::b'])
+        Tag.get('cache').delete()
+            # cascade deletes cache::a and cache::a::b, and invalidates them
+        s.assertEqual(Tag.get_if_exists('cache::a::b'), None)
+        s.assertEqual(Tag.get_if_exists('cache::a'), None)
+        with s.assertRaises(Tag.DoesNotExist): Tag.get_by_id(tag.id)
+
+        tag = Tag.get('cache2')
+        Tag.get('cache2')
+        tag._tag = 'cache3'
+        tag.save()
+        s.assertEqual(Tag.get_if_exists('cache2'), None)
+        s.assertEqual(Tag.get('cache3').id, tag.id)
+
+        for n in range(20): Tag.get('cache4::{}'.format(n))
+        s.assertTrue(len(Tag.cache.lru) <= 10)
+
+
+class TestSharedTagCache(TestCase):
+    """
+    testing the shared tag cache (using the default cache backend)
+    """
+    def setUp(s):
+        Tag.shared_cache = SharedTagCache(prefix='tagtest')
+
+    def tearDown(s):
+        Tag.shared_cache = None
+        Tag.cache = None
+
+    def test_shared_cache(s):
+        """test caching and invalidation of tags and subtrees"""
+        tag = Tag.get('shared::a')
+        with s.assertNumQueries(1): s.assertEqual(Tag.get_if_exists('shared::a'), tag)
+        with s.assertNumQueries(0): s.assertEqual(Tag.get_if_exists('shared::a').id, tag.id)
+
+        with s.assertNumQueries(2): s.assertEqual({t.tag for t in Tag.get('shared').family}, {'shared', 'shared::a'})
+            # the tag, and its subtree
+        with s.assertNumQueries(0): s.assertEqual({t.tag for t in Tag.get('shared').children}, {'shared::a'})
+
+        generation = Tag.shared_cache.generation
+        with s.captureOnCommitCallbacks(execute=True): Tag.get('shared::b')
+            # invalidates all entries
+        s.assertNotEqual(Tag.shared_cache.generation, generation)
+        s.assertEqual({t.tag for t in Tag.get('shared').children}, {'shared::a', 'shared::b'})
+        s.assertEqual(len(tuple(Tag.get('shared').leaves)), 2)
+
+        with s.captureOnCommitCallbacks(execute=True): Tag.get_many(['shared::c::d'])
+        s.assertEqual(len(Tag.get('shared').children), 4)
+        with s.captureOnCommitCallbacks(execute=True): Tag.get('shared::c').delete()
+        s.assertEqual(len(Tag.get('shared').children), 2)
+        s.assertEqual(Tag.get_if_exists('shared::c::d'), None)
+
+    def test_invalidate_on_commit(s):
+        """the entries are only invalidated once the changes are committed"""
+        generation = Tag.shared_cache.generation
+        with s.captureOnCommitCallbacks(execute=True) as callbacks:
+            Tag.get('shared_commit::a')
+            Tag.get('shared_commit::a').delete()
+            s.assertEqual(Tag.shared_cache.generation, generation)
+        s.assertTrue(callbacks)
+        s.assertNotEqual(Tag.shared_cache.generation, generation)
+
+        generation = Tag.shared_cache.generation
+        with s.captureOnCommitCallbacks(execute=True) as callbacks:
+            with s.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    Tag.get('shared_commit::b')
+                    raise RuntimeError()
+        s.assertEqual(callbacks, [])
+        s.assertEqual(Tag.shared_cache.generation, generation)
+
+    def test_local_sync(s):
+        """the local cache is cleared when the generation counter changes"""
+        Tag.cache = TagCache()
+        Tag.shared_cache.sync_interval = 0
+        tag = Tag.get('shared_sync')
+        Tag.get('shared_sync')
+        with s.assertNumQueries(0): Tag.get('shared_sync')
+        Tag.shared_cache.invalidate()
+            # eg from another process
+        s.assertEqual(Tag.get('shared_sync'), tag)
+        s.assertEqual(len(Tag.cache.lru), 2)
+
+    def test_unavailable(s):
+        """an unavailable cache backend falls back to the database"""
+        Tag.shared_cache = SharedTagCache('no-such-cache')
+        with s.assertLogs('tag.models.tag', 'WARNING'):
+            with s.captureOnCommitCallbacks(execute=True): tag = Tag.get('shared_unavailable::a')
+            # creating the tags tries to invalidate the cache, which is logged
+        with s.assertNumQueries(1): s.assertEqual(Tag.get_if_exists('shared_unavailable::a'), tag)
+        s.assertEqual(Tag.shared_cache.generation, None)
+        s.assertEqual(len(Tag.get('shared_unavailable').children), 1)
+        with s.assertLogs('tag.models.tag', 'WARNING'):
+            with s.captureOnCommitCallbacks(execute=True): tag.delete()
+        s.assertEqual(Tag.get_if_exists('shared_unavailable::a'), None)
+
+
+class TestTagTree(TestCase):
+    """
+    testing the in-memory snapshot of the hierarchy
+    """
+    def setUp(s):
+        for tagstr in ['t1::a::x', 't1::a::y', 't1::b', 't2']: Tag.get(tagstr)
+
+    def tearDown(s):
+        Tag._tree = None
+
+    def test_tree(s):
+        """test navigating the tree"""
+        with s.assertNumQueries(1): tree = Tag.load_tree()
+        with s.assertNumQueries(0):
+            s.assertEqual( len(tree), 6 )
+            s.assertEqual( [t.tag for t in tree.roots], ['t1', 't2'] )
+            s.assertEqual( [t.tag for t in tree.leaves()], ['t1::a::x', 't1::a::y', 't1::b', 't2'] )
+            s.assertEqual( [t.tag for t in tree.leaves('t1::a')], ['t1::a::x', 't1::a::y'] )
+            s.assertEqual( {t.tag for t in tree.children('t1')}, {'t1::a', 't1::a::x', 't1::a::y', 't1::b'} )
+            s.assertEqual( {t.tag for t in tree.direct_children('t1')}, {'t1::a', 't1::b'} )
+            s.assertEqual( len(tree.family(Tag(_tag='t1::a'))), 3 )
+            s.assertEqual( tree.depth('t1::a::x'), 3 )
+            s.assertEqual( [t.tag for t in tree.path('t1::a::x')], ['t1', 't1::a', 't1::a::x'] )
+            s.assertTrue( tree.is_leaf('t2') )
+            s.assertFalse( tree.is_leaf('t1::a') )
+            s.assertEqual( tree.parent('t1::a').tag, 't1' )
+            s.assertEqual( tree.parent('t1').__class__, RootTag )
+            s.assertEqual( tree.get('t1::a::x').depth, 3 )
+            s.assertEqual( tree.get('nonexisting'), None )
+            s.assertTrue( 't1::b' in tree )
+        s.assertEqual( tree.get('t1::a::x')._parent_tag_id, Tag.get('t1::a').id )
+        s.assertEqual( tree.get('t1::b'), Tag.get('t1::b') )
+        s.assertEqual( tree.get('t1::b').id, Tag.get('t1::b').id )
+
+    def test_not_kept(s):
+        """by default the snapshot is not kept"""
+        Tag.load_tree()
+        with s.assertNumQueries(1): tree = Tag.load_tree()
+        Tag.get('t3')
+        s.assertTrue( 't3' in Tag.load_tree() )
+        s.assertFalse( 't3' in tree )
+
+    def test_is_leaf(s):
+        """test is_leaf"""
+        tag = Tag.get('t1::b')
+        with s.assertNumQueries(0): s.assertTrue( tag.is_leaf )
+            # the number of children is stored on the tag
+        parent = Tag.get('t1::a')
+        s.assertFalse( parent.is_leaf )
+        with CaptureQueriesContext(connection) as queries:
+            s.assertTrue( parent.has_children )
+            s.assertFalse( tag.has_children )
+        s.assertEqual( len(queries), 2 )
+        s.assertTrue( all( 'LIMIT 1' in q['sql'] for q in queries ) )
+            # checking existence only
+
+    def test_child_count(s):
+        """test the stored number of children"""
+        s.assertEqual( Tag.get('t1')._child_count, 2 )
+        s.assertEqual( Tag.get('t1::a')._child_count, 2 )
+        s.assertEqual( Tag.load_tree().get('t1::a')._child_count, 2 )
+        parent = Tag.get('t1::b')
+        Tag.get('t1::b::z')
+        s.assertFalse( Tag.get('t1::b').is_leaf )
+        s.assertTrue( parent.is_leaf )
+            # the tag object is a snapshot (like `depth`)
+        Tag.get_many(['t3::a', 't3::b', 't2::c'])
+        s.assertEqual( Tag.get('t3')._child_count, 2 )
+        s.assertEqual( Tag.get('t2')._child_count, 1 )
+
+        Tag.get('t1::a::x').delete()
+        s.assertEqual( Tag.get('t1::a')._child_count, 1 )
+        Tag.get('t1::a').delete()
+            # the cascade deletes t1::a::y as well
+        s.assertEqual( Tag.get('t1')._child_count, 1 )
+
+        Tag.get_many(['t4::a::x', 't4::a::y::z', 't4::b'])
+        with CaptureQueriesContext(connection) as queries: Tag.get('t4::a').delete()
+        s.assertEqual( len([q for q in queries if q['sql'].startswith('UPDATE')]), 1 )
+            # a single recount for the entire cascade, of the parent only
+        s.assertEqual( Tag.get('t4')._child_count, 1 )
+        s.assertEqual( Tag.get_if_exists('t4::a::y'), None )
+
+        Tag.get_many(['t0::x', 't0::a'])
+        with s.assertNumQueries(1):
+            s.assertEqual( [t.tag for t in Tag.all_leaves()], ['t1::b::z', 't2::c', 't3::a', 't3::b', 't4::b', 't0::a', 't0::x'] )
+                # the roots are ordered by id
+        tags = [Tag.get('t3'), Tag.get('t1::b'), Tag.get('t0::a')]
+        with s.assertNumQueries(1):
+            s.assertEqual( [t.tag for t in Tag.all_leaves(tags)], ['t3::a', 't3::b', 't1::b::z', 't0::a'] )
+        s.assertEqual( [t.tag for t in Tag.get('t1').leaves], ['t1::b::z'] )
+
+    def test_leaves_order(s):
+        """the leaves are ordered depth first, siblings by tag string"""
+        Tag.get_many(['t5::b-c', 't5::b::c', 't5::a'])
+        s.assertEqual( [t.tag for t in Tag.get('t5').leaves], ['t5::a', 't5::b::c', 't5::b-c'] )
+        s.assertEqual( [t.tag for t in Tag.all_leaves([Tag.get('t5')])], ['t5::a', 't5::b::c', 't5::b-c'] )
+        s.assertEqual( [t.tag for t in Tag.all_leaves()][-3:], ['t5::a', 't5::b::c', 't5::b-c'] )
+        s.assertEqual( [t.tag for t in Tag.load_tree().leaves('t5')], ['t5::a', 't5::b::c', 't5::b-c'] )
+
+    def test_reparent(s):
+        """saving a tag with a new parent updates the depths and the numbers of children"""
+        tag = Tag.get('t1::a')
+        tag._parent_tag = Tag.get('t1::b')
+        tag.save()
+        s.assertEqual( Tag.get('t1::a').depth, 3 )
+        s.assertEqual( Tag.get('t1::a::x').depth, 4 )
+        s.assertEqual( Tag.get('t1')._child_count, 1 )
+        s.assertEqual( Tag.get('t1::b')._child_count, 1 )
+        tag._parent_tag = None
+        tag.save()
+        s.assertEqual( Tag.get('t1::a').depth, 1 )
+        s.assertEqual( Tag.get('t1::a::y').depth, 2 )
+        s.assertEqual( Tag.get('t1::b')._child_count, 0 )
+        s.assertTrue( Tag.get('t1::b').is_leaf )
+
+    def test_bulk_delete(s):
+        """deleting a queryset of tags recounts the children once"""
+        Tag.get_many(['t1::a::z', 't1::b::x', 't2::a'])
+        with CaptureQueriesContext(connection) as queries:
+            Tag.objects.filter(_tag__in=['t1::a::x', 't1::a::y', 't1::b', 't2::a']).delete()
+        s.assertEqual( len([q for q in queries if q['sql'].startswith('UPDATE')]), 1 )
+        s.assertEqual( Tag.get('t1::a')._child_count, 1 )
+        s.assertEqual( Tag.get('t1')._child_count, 1 )
+        s.assertEqual( Tag.get('t2')._child_count, 0 )
+        s.assertEqual( Tag.get_if_exists('t1::b::x'), None )
+
+
+class TestTagTreeCache(TransactionTestCase):
+    """
+    testing the snapshot of the hierarchy kept between calls (`Tag.tree_cache`)
+    """
+    def setUp(s):
+        patcher = mock.patch.object(Tag, 'tree_cache', True)
+        patcher.start()
+        s.addCleanup(patcher.stop)
+        for tagstr in ['t1::a::x', 't1::a::y', 't1::b', 't2']: Tag.get(tagstr)
+
+    def tearDown(s):
+        Tag.tags_changed()
+            # the tables are flushed without signals
+
+    def test_incremental(s):
+        """the snapshot is updated incrementally"""
+        tree = Tag.load_tree()
+        Tag.get('t1::b::c')
+        Tag.get_many(['t3::a', 't1::b::d'])
+        with s.assertNumQueries(0): tree = Tag.load_tree()
+        s.assertEqual( [t.tag for t in tree.leaves('t1::b')], ['t1::b::c', 't1::b::d'] )
+        s.assertEqual( [t.tag for t in tree.roots], ['t1', 't2', 't3'] )
+
+        Tag.get('t1::a').delete()
+        with s.assertNumQueries(0): tree = Tag.load_tree()
+        s.assertEqual( len(tree), 7 )
+        s.assertFalse( 't1::a::x' in tree )
+        s.assertEqual( [t.tag for t in tree.roots], ['t1', 't2', 't3'] )
+        s.assertEqual( {t.tag for t in tree.children('t1')}, {'t1::b', 't1::b::c', 't1::b::d'} )
+
+        tag = Tag.get('t2')
+        tag._tag = 't2x'
+        tag.save()
+        s.assertEqual( Tag.load_tree().get('t2x').id, tag.id )
+        s.assertEqual( Tag.load_tree().get('t2'), None )
+
+        Tag.tags_changed()
+        with s.assertNumQueries(1): Tag.load_tree()
+
+    def test_rollback(s):
+        """changes rolled back do not show in the snapshot"""
+        tree = Tag.load_tree()
+        with s.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Tag.get('t3::phantom')
+                s.assertTrue( 't3::phantom' in Tag.load_tree() )
+                    # within a transaction a new snapshot is loaded, and not kept
+                raise RuntimeError()
+        with s.assertNumQueries(0): s.assertTrue( Tag.load_tree() is tree )
+        s.assertFalse( 't3' in tree )
+        s.assertEqual( [t.tag for t in Tag.all_leaves()], ['t1::a::x', 't1::a::y', 't1::b', 't2'] )
+
+        with transaction.atomic():
+            Tag.get('t3::a')
+            s.assertFalse( 't3' in tree )
+                # the snapshot is only updated on commit
+        s.assertTrue( 't3::a' in Tag.load_tree() )
+
+
+class TestSubtree(TestCase):
+    """
+    testing the single-query subtree engine (and benchmarking it against walking the tree)
+    """
+
+    def queries(s, func):
+        """returns (result, number of queries) when calling func"""
+        with CaptureQueriesContext(connection) as ctx: result = func()
+        return result, len(ctx.captured_queries)
+
+    def walk(s, tag):
+        """the children, found by walking the tree (the way `children` was implemented before v1.6)"""
+        children = tag.direct_children
+        for t in tag.direct_children:
+            children = children.union(s.walk(t))
+        return children
+
+    def compare(s, tag):
+        """compares walking the tree with the subtree engine; returns query counts"""
+        before, n_before = s.queries(lambda: s.walk(tag))
+        after, n_after = s.queries(lambda: tag.children)
+        s.assertEqual(before, after)
+        s.assertEqual(n_after, 1)
+        return n_before, n_after
+
+    def test_deep(s):
+        """deep tree: a single chain of tags"""
+        tagstr = "::".join("d{}".format(i) for i in range(10))
+        Tag.get(tagstr)
+        n_before, n_after = s.compare(Tag.get('d0'))
+        s.assertEqual(n_before, 20)
+        s.assertEqual(len(Tag.get('d0').family), 10)
+        s.assertEqual([t.tag for t in Tag.get('d0').leaves], [tagstr])
+
+    def test_wide(s):
+        """wide tree: one root, 20 children with 3 grandchildren each"""
+        for i in range(20):
+            for j in range(3): Tag.get('w::{}::{}'.format(i, j))
+        n_before, n_after = s.compare(Tag.get('w'))
+        s.assertEqual(n_before, 162)
+        s.assertEqual(len(Tag.get('w').children), 80)
+        s.assertEqual(len(tuple(Tag.get('w').leaves)), 60)
+        s.assertEqual(len(tuple(Tag.get('w::1').leaves)), 3)
+
+    def test_prefix(s):
+        """the subtree is an exact (case sensitive) prefix match on the hierarchy"""
+        Tag.get('pre::a')
+        Tag.get('prefix::a')
+        Tag.get('PRE::b')
+        Tag.get('pre_x')
+        s.assertEqual({t.tag for t in Tag.get('pre').family}, {'pre', 'pre::a'})
+        s.assertEqual({t.tag for t in Tag.get('PRE').children}, {'PRE::b'})
+
+
+class TestInstrumentation(TestCase):
+    """
+    testing the instrumentation of the tag operations
+    """
+    def tearDown(s):
+        Tag.instrumentation = None
+
+    def test_registry(s):
+        """test counting queries into the registry"""
+        Tag.instrumentation = Instrumentation()
+        Tag.get('inst::a::b')
+        Tag.get('inst::a::b')
+        stats = Tag.instrumentation.registry.stats
+        s.assertEqual( stats['Tag.get']['calls'], 2 )
+        s.assertEqual( stats['Tag.get']['queries'], 7 + 1 )
+            # creating the tag (see `test_ancestors`), then retrieving it
+        s.assertEqual( sum(count for bound, count in stats['Tag.get']['queries_histogram']), 2 )
+        s.assertEqual( stats['Tag.get']['queries_histogram'][1], [1, 1] )
+        s.assertTrue( stats['Tag.get']['wall_time'] >= stats['Tag.get']['db_time'] > 0 )
+
+        Tag.get('inst').family
+        stats = Tag.instrumentation.registry.stats
+        s.assertEqual( stats['Tag.family']['queries'], 1 )
+        s.assertEqual( stats['Tag.subtree']['calls'], 1 )
+            # nested operations are counted in both
+
+        d = _Dummy.objects.create(title='inst')
+        _Dummy.tag_token_execute(d.tag_token_add(Tag.get('inst::a')))
+        s.assertEqual( Tag.instrumentation.registry.stats['TagMixin.tag_token_execute']['calls'], 1 )
+        s.assertEqual( len(_Dummy.tagged_as('inst', as_queryset=False)), 1 )
+        s.assertEqual( Tag.instrumentation.registry.stats['TagMixin.tagged_as']['queries'], 1 )
+
+        Tag.instrumentation.registry.reset()
+        s.assertEqual( Tag.instrumentation.registry.stats, {} )
+
+    def test_sinks(s):
+        """test the logging and the signal sinks"""
+        received = []
+        def receiver(sender, **kwargs): received.append(kwargs)
+        tag_operation.connect(receiver)
+        try:
+            Tag.instrumentation = Instrumentation(['log', 'signal', lambda *args: 1/0])
+            with s.assertLogs('tag.instrumentation', 'DEBUG'):
+                with s.assertLogs('tag.models.tag', 'WARNING'): Tag.get('inst_sinks')
+                    # a failing sink is logged, but does not fail the operation
+        finally:
+            tag_operation.disconnect(receiver)
+        s.assertEqual( received[0]['operation'], 'Tag.get' )
+        s.assertEqual( received[0]['queries'], 2 )
+            # get_if_exists and the insert
+
+    def test_off(s):
+        """test that nothing is measured when switched off"""
+        Tag.get('inst_off')
+        with s.assertNumQueries(1): Tag.get('inst_off')
+
+    def test_view(s):
+        """test the debug view"""
+        from .views import instrumentation
+        factory = RequestFactory()
+        with s.settings(DEBUG=False):
+            with s.assertRaises(Http404): instrumentation(factory.get('/'))
+        with s.settings(DEBUG=True):
+            s.assertEqual( json.loads(instrumentation(factory.get('/')).content)['enabled'], False )
+            Tag.instrumentation = Instrumentation()
+            Tag.get('inst_view')
+            data = json.loads(instrumentation(factory.get('/')).content)
+            s.assertEqual( data['operations']['Tag.get']['calls'], 1 )
+            instrumentation(factory.post('/'))
+            s.assertEqual( json.loads(instrumentation(factory.get('/')).content)['operations'], {} )
+
+
+class TestToken(TestCase):
+    """
+    testing the tokens
+    """
+    def test_compact(s):
+        """the compact token format"""
+
+        token = Token.create('myns', 'add', 1, 100)
+        s.assertFalse( '::' in token.split(':::')[0] )
+        t = Token(token)
+        s.assertEqual( (t.version, t.namespace, t.command, t.parameters, t.tag_id, t.item_id), (1, 'myns', 'add', [], 1, 100) )
+        t = Token(Token.create('myns', 'toggle'))
+        s.assertEqual( (t.command, t.tag_id, t.item_id), ('toggle', None, None) )
+        s.assertEqual( Token.create_many([('myns', 'add', 1, 100)]), [token] )
+        s.assertEqual( Token.signer().unsign(token), token.split(':::')[0] )
+            # the signature is that of the Django signer
+        with s.assertRaises(TokenSignatureError): Token(token[:-1])
+        with s.assertRaises(TokenSignatureError): Token(None)
+        with s.assertRaises(TokenFormatError): Token(Token.sign('AAAA'))
+        with s.settings(SECRET_KEY='another key'):
+            with s.assertRaises(TokenSignatureError): Token(token)
+            s.assertEqual( Token(Token.create('myns', 'add', 1, 100)).item_id, 100 )
+
+    def test_cache(s):
+        """the verified token cache"""
+
+        token = Token.create('myns', 'add', 1, 100)
+        cache, Token.cache = Token.cache, LRUCache(10)
+        try:
+            s.assertEqual( Token(token).item_id, 100 )
+            t = Token(token)
+            s.assertEqual( (t.namespace, t.command, t.tag_id, t.item_id), ('myns', 'add', 1, 100) )
+            s.assertEqual( (Token.cache.stats['hits'], Token.cache.stats['misses']), (1, 1) )
+            with s.assertRaises(TokenSignatureError): Token(token[:-1])
+            s.assertEqual( len(Token.cache), 1 )
+                # invalid tokens are not cached
+            with s.settings(SECRET_KEY='another key'):
+                with s.assertRaises(TokenSignatureError): Token(token)
+        finally: Token.cache = cache
+
+    def test_expiry(s):
+        """timestamped tokens and the replay window"""
+
+        token = Token.create('myns', 'add', 1, 100)
+        Token.max_age = 60
+        try:
+            with s.assertRaises(TokenExpiredError): Token(token)
+            token = Token.create('myns', 'add', 1, 100)
+            s.assertEqual( Token(token).item_id, 100 )
+            s.assertAlmostEqual( Token(token).timestamp, time.time(), delta=2 )
+            s.assertEqual( Token.create_many([('myns', 'add', 1, 100)]), [token] )
+            s.assertEqual( TimestampSigner(sep=':::', salt='token').unsign(token, max_age=60), token.split(':::')[0] )
+            old = Token.signer().sign(token.split(':::')[0] + ':::a')
+                # timestamp 'a', ie 36s after the epoch
+            with s.assertRaises(TokenExpiredError): Token(old)
+        finally: Token.max_age = None
+        s.assertEqual( Token(old).timestamp, 36 )
+
+        replay = TokenReplayWindow(60)
+        s.assertTrue( replay.use(token) )
+        s.assertFalse( replay.use(token) )
+        s.assertTrue( replay.use(old) )
+
+    def test_legacy(s):
+        """the legacy token format"""
+
+        token = Token.signer().sign('myns::mycmd:p1:p2::1::None')
+        t = Token(token)
+        s.assertEqual( (t.version, t.namespace, t.command, t.parameters, t.tag_id, t.item_id), (0, 'myns', 'mycmd', ['p1', 'p2'], 1, None) )
+        s.assertEqual( t.token, ['myns', 'mycmd:p1:p2', '1', 'None'] )
+        s.assertEqual( Token(Token.create('myns', 'add', 1, 100)).token, ['myns', 'add', '1', '100'] )
+            # the same fields for compact tokens
+        s.assertEqual( t.numparameters, 2 )
+        s.assertEqual( Token.create('myns', ['mycmd', 'p1', 'p2'], 1), token )
+        s.assertEqual( Token(Token.signer().sign('myns::add::1::100')).item_id, 100 )
+        with s.assertRaises(TokenFormatError): Token(Token.signer().sign('myns::add::1'))
+        Token.compact = False
+        try: s.assertEqual( Token.create('myns', 'add', 1, 100), Token.signer().sign('myns::add::1::100') )
+        finally: Token.compact = True
+
+
 class TestTagging(TestCase):
     """
     testing the tagging
@@ -245,6 +841,62 @@ class TestTagging(TestCase):
         s.assertEqual( {t.tag for t in tags}, {'p1::c1', 'p1::c2'})
 
 
+    def test_toggle(s):
+        """toggling tags"""
+
+        d1 = s.data(1)
+        tag = s.tag('tg::1')
+        with s.assertNumQueries(4): s.assertTrue( d1.tag_toggle(tag) )
+            # savepoint, delete, insert, release savepoint
+        s.assertEqual( {t.tag for t in d1.tags}, {'tg::1'} )
+        with s.assertNumQueries(3): s.assertFalse( d1.tag_toggle(tag) )
+            # savepoint, delete, release savepoint
+        s.assertEqual( d1.tags, set() )
+
+        d1 = _Dummy.objects.with_tags().get(id=d1.id)
+        s.assertTrue( d1.tag_toggle('tg::1') )
+        s.assertTrue( d1.has_tag('tg::1') )
+
+        token = d1.tag_token_toggle(tag)
+        with s.assertNumQueries(5): s.assertFalse( _Dummy.tag_token_execute(token)['item_has_tag'] )
+            # item, tag, savepoint, delete, release savepoint
+        s.assertTrue( _Dummy.tag_token_execute(token)['item_has_tag'] )
+        s.assertFalse( _Dummy.tag_token_execute(d1.tag_token_remove(tag))['item_has_tag'] )
+
+    async def test_async(s):
+        """the async tagging methods and view"""
+
+        d1 = await _Dummy.objects.aget(title='Record 1')
+        tag = await Tag.aget('as::1')
+        s.assertEqual( tag, await Tag.aget('as::1') )
+        s.assertEqual( tag, await Tag.aget_by_id(tag.id) )
+        await d1.atag_add('as::1')
+        s.assertTrue( await d1.ahas_tag('as::1') )
+        s.assertFalse( await d1.atag_toggle(tag) )
+        s.assertFalse( await d1.ahas_tag(tag) )
+        await d1.atag_add(tag)
+        await d1.atag_remove('as::1')
+        s.assertFalse( await d1.ahas_tag(tag) )
+
+        token = d1.tag_token_toggle(tag)
+        s.assertTrue( (await _Dummy.atag_token_execute(token))['item_has_tag'] )
+        view = _Dummy.tag_as_async_view()
+        data = json.dumps({'token': token, 'reference': 'ref'})
+        response = await view(RequestFactory().post('/', data, content_type='application/json'))
+        response = json.loads(response.content.decode())
+        s.assertEqual( (response['success'], response['reference']), (True, 'ref') )
+        s.assertFalse( response['data']['item_has_tag'] )
+        response = await view(RequestFactory().post('/', json.dumps({'token': 'invalid'}), content_type='application/json'))
+        s.assertFalse( json.loads(response.content.decode())['success'] )
+
+        Token.replay = TokenReplayWindow(60, alias='default', prefix='tagtoken-test')
+        try:
+            token = d1.tag_token_add(tag)
+            s.assertTrue( (await _Dummy.atag_token_execute(token))['item_has_tag'] )
+            with s.assertRaises(TokenReplayError): await _Dummy.atag_token_execute(token)
+            s.assertFalse( await Token.replay.ause(token) )
+        finally: Token.replay = None
+
     def test_tagging_str(s):
         """tagging (using internal tag access)"""
 
@@ -333,6 +985,285 @@ class TestTagging(TestCase):
         s.assertEqual( len(_Dummy.tagged_as(aa, True, False)), 1)
 
 
+    def test_bulk(s):
+        """test bulk adding and removing of tags"""
+
+        d1, d2, d3 = s.data(1), s.data(2), s.data(3)
+        Tag.get('bulk::a')
+        with s.assertNumQueries(7):
+            _Dummy.tag_add_many([(d1, 'bulk::a'), (d1, 'bulk::b'), (d2.id, 'bulk::a'), (d2, 'other')])
+                # one query for the existing tags, two per level for creating the missing ones (plus one
+                # recount for the level with parents), one insert
+        s.assertEqual( {t.tag for t in d1.tags}, {'bulk::a', 'bulk::b'} )
+        s.assertEqual( {t.tag for t in d2.tags}, {'bulk::a', 'other'} )
+
+        other = Tag.get_if_exists('other')
+        with s.assertNumQueries(2):
+            _Dummy.tag_add_many([(d1, 'bulk::a'), (d3, other)])
+                # existing relations are ignored
+        s.assertEqual( {t.tag for t in d1.tags}, {'bulk::a', 'bulk::b'} )
+        s.assertEqual( {t.tag for t in d3.tags}, {'other'} )
+        d3.tag_add(None)
+        _Dummy.tag_add_many([(d3, None), (d3, 'other')])
+        s.assertEqual( {t.tag for t in d3.tags}, {'other'} )
+            # None is ignored, as in `tag_add`
+
+        with s.assertNumQueries(2):
+            _Dummy.tag_remove_many([(d1, 'bulk::a'), (d2, 'bulk::a'), (d3, 'other'), (d3, 'nonexisting')])
+        s.assertEqual( Tag.get_if_exists('nonexisting'), None )
+        s.assertEqual( {t.tag for t in d1.tags}, {'bulk::b'} )
+        s.assertEqual( {t.tag for t in d2.tags}, {'other'} )
+        s.assertEqual( d3.tags, set() )
+
+        _Dummy.bulk_tag(_Dummy.objects.filter(id__in=[4,5,6]), ['bulk::c', 'bulk::d'])
+        s.assertEqual( len(_Dummy.tagged_as('bulk::c', as_queryset=False)), 3 )
+        s.assertEqual( len(_Dummy.tagged_as('bulk', as_queryset=False)), 3+1 )
+        with s.assertNumQueries(2):
+            _Dummy.bulk_untag(_Dummy.objects.filter(id__in=[4,5]), ['bulk::c', 'bulk::x'])
+                # the tags, and a single delete
+        s.assertEqual( _Dummy.tagged_as('bulk::c', as_queryset=False), {s.data(6)} )
+        _Dummy.bulk_untag([s.data(6), 4], ['bulk::d'])
+        s.assertEqual( _Dummy.tagged_as('bulk::d', as_queryset=False), {s.data(5)} )
+
+        d = _Dummy(title='bulk')
+        d.tag_set(['bulk::a', 'bulk::b'])
+            # saves the record
+        s.assertEqual( {t.tag for t in d.tags}, {'bulk::a', 'bulk::b'} )
+        with s.assertNumQueries(6):
+            d.tag_set(['bulk::b', 'bulk::c'])
+                # the tags, savepoint, the current tags, one insert, one delete, release savepoint
+        s.assertEqual( {t.tag for t in d.tags}, {'bulk::b', 'bulk::c'} )
+        d.tag_set([])
+        s.assertEqual( d.tags, set() )
+
+    def test_prefetch(s):
+        """test that prefetched tags are used by all accessors"""
+
+        _Dummy.bulk_tag(_Dummy.objects.all(), ['pf::a', 'pf::b'])
+        s.data(1).tag_add('pf::c')
+
+        with s.assertNumQueries(2):
+            items = list(_Dummy.objects.all().with_tags())
+            for item in items:
+                s.assertEqual( item.tags_str.split(" ")[:2], ['pf::a', 'pf::b'] )
+                s.assertEqual( len(item.tags), 3 if item.id == 1 else 2 )
+                s.assertTrue( item.has_tag('pf::a') )
+                s.assertTrue( item.has_tag(Tag(_tag='pf::b')) )
+                s.assertEqual( item.has_tag('pf::c'), item.id == 1 )
+                s.assertFalse( item.has_tag('pf') )
+
+        item = items[1]
+        item.tag_add('pf::c')
+            # discards the prefetched tags
+        s.assertTrue( item.has_tag('pf::c') )
+        item.tag_set(['pf::a'])
+        s.assertFalse( item.has_tag('pf::c') )
+        _Dummy.tag_add_many([(items[2], 'pf::d')])
+        s.assertTrue( items[2].has_tag('pf::d') )
+
+        d3 = s.data(3)
+        with s.assertNumQueries(1): s.assertFalse( d3.has_tag('pf::nonexisting') )
+        s.assertEqual( Tag.get_if_exists('pf::nonexisting'), None )
+
+    def test_tagged_with(s):
+        """test and / or / not queries"""
+
+        d = {n: s.data(n) for n in range(1, 7)}
+        _Dummy.tag_add_many([
+            (d[1], 'q::a'), (d[1], 'q::b'),
+            (d[2], 'q::a::x'), (d[2], 'q::b'),
+            (d[3], 'q::a'),
+            (d[4], 'q::b'), (d[4], 'r'),
+            (d[5], 'r'),
+        ])
+        ids = lambda qs: {item.id for item in qs}
+
+        with s.assertNumQueries(1):
+            s.assertEqual( ids(_Dummy.tagged_with_all(['q::a', 'q::b'])), {1, 2} )
+        s.assertEqual( ids(_Dummy.tagged_with_all(['q::a', 'q::b'], include_children=False)), {1} )
+        s.assertEqual( ids(_Dummy.tagged_with_all([('q::a', False), 'q'])), {1, 3} )
+        s.assertEqual( ids(_Dummy.tagged_with_all([Tag.get('q::a'), 'nonexisting'])), set() )
+        s.assertEqual( ids(_Dummy.tagged_with_all([])), {1, 2, 3, 4, 5, 6} )
+
+        s.assertEqual( ids(_Dummy.tagged_with_any(['q::a', 'r'])), {1, 2, 3, 4, 5} )
+        s.assertEqual( ids(_Dummy.tagged_with_any(['q::a::x', 'nonexisting'])), {2} )
+        s.assertEqual( ids(_Dummy.tagged_with_any([])), set() )
+
+        s.assertEqual( ids(_Dummy.tagged_without(['q'])), {5, 6} )
+        s.assertEqual( ids(_Dummy.tagged_without(['q::a'], include_children=False)), {2, 4, 5, 6} )
+
+        with s.assertNumQueries(1):
+            qs = _Dummy.tagged_with(all_of=['q::b'], any_of=['q::a', 'r'], none_of=['q::a::x'])
+            s.assertEqual( ids(qs), {1, 4} )
+        qs = _Dummy.tagged_with(all_of=['q'], queryset=_Dummy.objects.filter(id__gte=2))
+        s.assertEqual( ids(qs.order_by('id')[:1]), {2} )
+        s.assertEqual( Tag.get_if_exists('nonexisting'), None )
+
+    def test_tagged_as_distinct(s):
+        """records tagged with several tags of the family appear only once"""
+
+        d1 = s.data(1)
+        d1.tag_add('dist::a')
+        d1.tag_add('dist::a::b')
+        d1.tag_add('dist')
+        s.data(2).tag_add('dist::a::b')
+        with s.assertNumQueries(1):
+            s.assertEqual( sorted(d.id for d in _Dummy.tagged_as('dist::a')), [1, 2] )
+        s.assertEqual( _Dummy.tagged_as('dist').count(), 2 )
+        s.assertEqual( _Dummy.tagged_as('dist::a', include_children=False).count(), 1 )
+        s.assertEqual( _Dummy.tagged_as('dist::nonexisting').count(), 0 )
+        s.assertEqual( Tag.get_if_exists('dist::nonexisting'), None )
+
+    def test_tag_references_index(s):
+        """the relation tables have an index on (tag, item)"""
+        for model, item_column in [(_Dummy, '_dummy_id'), (_DenormalizedDummy, '_denormalizeddummy_id')]:
+            through = model._meta.get_field('_tag_references').remote_field.through
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, through._meta.db_table)
+            s.assertIn( ['tag_id', item_column], [c['columns'] for c in constraints.values() if c['index']] )
+
+    def test_tag_counts(s):
+        """test faceted tag counts"""
+
+        d = {n: s.data(n) for n in range(1, 7)}
+        _Dummy.tag_add_many([
+            (d[1], 'f::a'), (d[1], 'f::b::x'),
+            (d[2], 'f::a'), (d[2], 'g'),
+            (d[3], 'f::b::y'),
+            (d[6], 'g'),
+        ])
+        qs = _Dummy.objects.filter(id__lte=5)
+        with s.assertNumQueries(2): counts = _Dummy.tag_counts_fromqs(qs)
+        s.assertEqual( counts, [
+            ('f', 0, 3), ('f::a', 2, 2), ('f::b', 0, 2), ('f::b::x', 1, 1), ('f::b::y', 1, 1), ('g', 1, 1),
+        ])
+            # d1 is tagged twice below f, but counted once
+        s.assertEqual( counts[0][2], _Dummy.tagged_as('f').filter(id__lte=5).count() )
+        s.assertEqual( _Dummy.tag_counts_fromqs(qs, max_depth=1), [('f', 0, 3), ('g', 1, 1)] )
+        s.assertEqual( _Dummy.tag_counts_fromqs(qs, top=2), [('f', 0, 3), ('f::a', 2, 2)] )
+        s.assertEqual( _Dummy.tag_counts_fromqs(_Dummy.objects.all(), top=1, max_depth=1), [('f', 0, 3)] )
+        s.assertEqual( _Dummy.tag_counts_fromqs(_Dummy.objects.none()), [] )
+
+    def test_tokens_all(s):
+        """test creating the tokens for many items and leaves"""
+        Tag.get_many(['tk::a::x', 'tk::a::y', 'tk::b'])
+        items = list(_Dummy.objects.all())
+        token = Token.create('_Dummy', 'add', Tag.get('tk::b').id, items[0].id)
+        s.assertEqual( Token.create_many([('_Dummy', 'add', Tag.get('tk::b').id, items[0].id)]), [token] )
+
+        with s.assertNumQueries(1): tokens = _Dummy.tags_token_all_many(items)
+            # retrieving the leaves; the tokens are created without queries
+        with s.assertNumQueries(1): lazy_tokens = _Dummy.tags_token_all_many(items, lazy=True)
+        s.assertEqual( len(tokens), 6 )
+        s.assertEqual( [t['tag'].tag for t in tokens[items[0].id]], ['tk::a::x', 'tk::a::y', 'tk::b'] )
+        s.assertEqual( tokens[items[0].id][2]['add'], token )
+        s.assertEqual( lazy_tokens[items[0].id][2]['add'], token )
+        s.assertEqual( tokens, lazy_tokens )
+        s.assertEqual( tokens[items[1].id], items[1].tags_token_all )
+        s.assertEqual( [t['tag'] for t in tokens[items[0].id]], list(Tag.all_leaves()) )
+            # the same leaves, in the same order
+        s.assertEqual( items[1].tag_token_all(Tag.get('tk::b')), items[1].tag_token_all(Tag.get('tk::b'), lazy=True) )
+
+        lazy = items[2].tag_token_all(Tag.get('tk::b'), lazy=True)
+        s.assertEqual( len(lazy.values), 1 )
+        lazy['remove']
+        s.assertEqual( set(lazy.values), {'tag', 'remove'} )
+        with s.assertRaises(KeyError): lazy['nonexisting']
+
+        _Dummy.tag_token_execute(tokens[items[3].id][0]['add'])
+        s.assertEqual( {t.tag for t in items[3].tags}, {'tk::a::x'} )
+        _Dummy.tag_token_execute(lazy_tokens[items[3].id][0]['remove'])
+        s.assertEqual( items[3].tags, set() )
+
+    def test_tokens_checked(s):
+        """expired tokens are rejected before any query, replayed ones once validated"""
+
+        d1, tag = s.data(1), s.tag('tc')
+        token = d1.tag_token_add(tag)
+        Token.max_age = 60
+        try:
+            with s.assertNumQueries(0):
+                with s.assertRaises(TokenExpiredError): _Dummy.tag_token_execute(token)
+            token = d1.tag_token_add(tag)
+        finally: Token.max_age = None
+        Token.replay = TokenReplayWindow(60)
+        try:
+            s.assertTrue( _Dummy.tag_token_execute(token)['item_has_tag'] )
+            with s.assertNumQueries(2):
+                with s.assertRaises(TokenReplayError): _Dummy.tag_token_execute(token)
+                    # the item and the tag are validated first
+            s.assertEqual( _Dummy.tag_token_execute_many([token])[0]['errmsg'][:18], 'token already used' )
+
+            gone = _Dummy.objects.create(title='gone')
+            token = gone.tag_token_add(tag)
+            gone.delete()
+            for n in range(2):
+                with s.assertRaises(ItemDoesNotExistError): _Dummy.tag_token_execute(token)
+                s.assertFalse( _Dummy.tag_token_execute_many([token])[0]['success'] )
+            s.assertTrue( Token.replay.use(token) )
+                # a token that failed validation has not been used up
+        finally: Token.replay = None
+
+    def test_tokens_execute_many(s):
+        """test executing many tokens at once"""
+
+        items = list(_Dummy.objects.all()[:4])
+        tag1, tag2 = Tag.get('tx::1'), Tag.get('tx::2')
+        items[1].tag_add(tag1)
+        items[2].tag_add(tag2)
+        tokens = [
+            items[0].tag_token_add(tag1),
+            items[1].tag_token_remove(tag1),
+            items[2].tag_token_toggle(tag2),
+            items[3].tag_token_toggle(tag1),
+            items[3].tag_token_toggle(tag2),
+            items[3].tag_token_toggle(tag2),
+            'invalid',
+            Token.create('Other', 'add', tag1.id, items[0].id),
+            _Dummy.tag_token('add', tag1, 9999),
+        ]
+        with s.assertNumQueries(7):
+            results = _Dummy.tag_token_execute_many(tokens)
+            # items, tags, existing relations, insert, delete, and the savepoint
+        s.assertEqual( [r['success'] for r in results], [True]*6 + [False]*3 )
+        s.assertEqual( [r['data']['item_has_tag'] for r in results[:6]], [True, False, False, True, True, False] )
+        s.assertEqual( results[0]['data']['tag'], 'tx::1' )
+        s.assertTrue( results[6]['errmsg'].startswith('token') )
+        s.assertTrue( results[8]['errmsg'].startswith('item does not exist') )
+        s.assertEqual( [{t.tag for t in item.tags} for item in items], [{'tx::1'}, set(), set(), {'tx::1'}] )
+
+        view = _Dummy.tag_as_view()
+        data = json.dumps({'tokens': tokens[:2], 'reference': 'ref'})
+        response = json.loads(view(RequestFactory().post('/', data, content_type='application/json')).content.decode())
+        s.assertTrue( response['success'] )
+        s.assertEqual( response['reference'], 'ref' )
+        s.assertEqual( [r['data']['item_has_tag'] for r in response['data']], [True, False] )
+
+    def test_loadtest(s):
+        """smoke test of the loadtest management command"""
+        tag = Tag.get('_loadtest')
+        n_items = _Dummy.objects.count()
+        out = io.StringIO()
+        call_command('tag_loadtest', requests=2, threads=1, concurrency=1, stdout=out)
+        s.assertEqual( [line.split()[0] for line in out.getvalue().splitlines()], ['sync', 'async'] )
+        s.assertEqual( Tag.get_if_exists('_loadtest'), tag )
+            # the tag existed before, so it is kept
+        s.assertEqual( _Dummy.objects.count(), n_items )
+
+    def test_benchmark(s):
+        """test the benchmark management command"""
+        n_tags, n_items = Tag.objects.count(), _Dummy.objects.count()
+        out = io.StringIO()
+        call_command('tag_benchmark', depth=2, fanout=3, items=10, tags_per_item=2, repeat=2, stdout=out)
+        report = json.loads(out.getvalue())
+        s.assertEqual( report['setup']['tags'], n_tags + 3 + 9 )
+        s.assertEqual( report['setup']['assignments'], 20 )
+        s.assertEqual( report['benchmarks']['Tag.all_leaves']['queries'], 1 )
+        s.assertEqual( report['benchmarks']['token_create']['queries'], 0 )
+        s.assertTrue( report['benchmarks']['view']['median'] > 0 )
+        s.assertEqual( (Tag.objects.count(), _Dummy.objects.count()), (n_tags, n_items) )
+            # everything is rolled back
+
     def test_repr(s):
         """tests representation and TAG shortcut"""
 
@@ -362,3 +1293,301 @@ class TestTagging(TestCase):
 
 
  
+
+
+class TestDenormalized(TestCase):
+    """
+    testing the denormalized tag fields
+    """
+    def setUp(s):
+        for n in range(4): _DenormalizedDummy(title='Record {}'.format(n)).save()
+        s.items = list(_DenormalizedDummy.objects.order_by('id'))
+
+    def fields(s, item):
+        item = _DenormalizedDummy.objects.get(id=item.id)
+        return item._tags_str, item.tag_ids
+
+    def test_single(s):
+        """the single record methods and the related manager"""
+
+        d0, d1 = s.items[:2]
+        a, b = Tag.get('dn::a'), Tag.get('dn::b')
+        d0.tag_add(b)
+        d0.tag_add(a)
+        s.assertEqual( d0.tags_str, 'dn::a dn::b' )
+        s.assertEqual( s.fields(d0), ('dn::a dn::b', sorted([a.id, b.id])) )
+        d0.tag_remove(a)
+        s.assertEqual( s.fields(d0), ('dn::b', [b.id]) )
+        s.assertTrue( d0.tag_toggle(a) )
+        s.assertEqual( d0.tag_ids, sorted([a.id, b.id]) )
+        d0.tag_set([a])
+        s.assertEqual( s.fields(d0), ('dn::a', [a.id]) )
+        d0._tag_references.clear()
+        s.assertEqual( s.fields(d0), ('', []) )
+
+        a._denormalizeddummy_set.add(d0, d1)
+        s.assertEqual( [s.fields(d)[0] for d in (d0, d1)], ['dn::a', 'dn::a'] )
+        a._denormalizeddummy_set.clear()
+        s.assertEqual( [s.fields(d)[0] for d in (d0, d1)], ['', ''] )
+
+    def test_bulk(s):
+        """the bulk methods, filtering, and the management command"""
+
+        d0, d1, d2, d3 = s.items
+        _DenormalizedDummy.bulk_tag(s.items, ['dn::a', 'dn::b::c'])
+        s.assertEqual( [s.fields(d)[0] for d in s.items], ['dn::a dn::b::c']*4 )
+        _DenormalizedDummy.bulk_untag(_DenormalizedDummy.objects.filter(id__in=[d0.id, d1.id]), ['dn::a'])
+        _DenormalizedDummy.tag_remove_many([(d2, 'dn::b::c')])
+        s.assertEqual( [s.fields(d)[0] for d in s.items], ['dn::b::c', 'dn::b::c', 'dn::a', 'dn::a dn::b::c'] )
+
+        with s.assertNumQueries(2):
+            # subtree ids, records
+            s.assertEqual( set(_DenormalizedDummy.tagged_as_denormalized('dn::b')), {d0, d1, d3} )
+        s.assertEqual( set(_DenormalizedDummy.tagged_as_denormalized('dn::b', False)), set() )
+        a = Tag.get('dn::a')
+        with s.assertNumQueries(1):
+            s.assertEqual( set(_DenormalizedDummy.tagged_as_denormalized(a, False)), {d2, d3} )
+        s.assertEqual( set(_DenormalizedDummy.tagged_as_denormalized('dn::nonexisting')), set() )
+
+        _DenormalizedDummy.objects.update(_tags_str='', _tags_ids=' ')
+        call_command('tag_denormalize', 'tag._DenormalizedDummy', batch_size=3, stdout=io.StringIO())
+        s.assertEqual( [s.fields(d)[0] for d in s.items], ['dn::b::c', 'dn::b::c', 'dn::a', 'dn::a dn::b::c'] )
+
+    def test_delete(s):
+        """the fields are updated whenever tags are deleted"""
+
+        d0, d1, d2, d3 = s.items
+        _DenormalizedDummy.bulk_tag([d0, d1], ['dn::a', 'dn::b::c', 'dn::d', 'dn::e'])
+        _DenormalizedDummy.tag_add_many([(d2, 'dn::b')])
+        Tag.get('dn::b').delete()
+            # the cascade deletes dn::b::c as well
+        s.assertEqual( [s.fields(d)[0] for d in s.items], ['dn::a dn::d dn::e', 'dn::a dn::d dn::e', '', ''] )
+        Tag.deltag('dn::d')
+        s.assertEqual( s.fields(d0), ('dn::a dn::e', sorted([Tag.get('dn::a').id, Tag.get('dn::e').id])) )
+        with mock.patch.object(Tag, '_raw_delete_safe', classmethod(lambda cls: False)):
+            Tag.deltag('dn::e')
+        s.assertEqual( [s.fields(d)[0] for d in s.items], ['dn::a', 'dn::a', '', ''] )
+
+
+class TestMove(TestCase):
+    """
+    testing moving, renaming and merging tags
+    """
+    def setUp(s):
+        s.items = [ _Dummy.objects.create(title='Record {}'.format(n)) for n in range(4) ]
+        s.denormalized = _DenormalizedDummy.objects.create(title='Record')
+
+    def tagstrs(s, item):
+        return sorted( t.tag for t in _Dummy.objects.get(id=item.id).tags )
+
+    def test_move(s):
+        """moving a subtree to a new path"""
+        Tag.get_many(['mv::b::c', 'mv::b::d', 'mv::e'])
+        b, c = Tag.get('mv::b'), Tag.get('mv::b::c')
+        s.items[0].tag_add(c)
+        s.denormalized.tag_add(c)
+
+        with CaptureQueriesContext(connection) as ctx: moved = b.move('x::b')
+        s.assertEqual( moved.id, b.id )
+        s.assertEqual( Tag.get_if_exists('mv::b::c'), None )
+        s.assertEqual( Tag.get('x::b::c').id, c.id )
+        s.assertEqual( (Tag.get('x::b::c').depth, Tag.get('x::b::c').parent), (3, moved) )
+        s.assertEqual( moved.parent, Tag.get('x') )
+        s.assertEqual( (Tag.get('mv')._child_count, Tag.get('x')._child_count), (1, 1) )
+        s.assertEqual( s.tagstrs(s.items[0]), ['x::b::c'] )
+        s.assertEqual( _DenormalizedDummy.objects.get(id=s.denormalized.id)._tags_str, 'x::b::c' )
+
+        Tag.get_many(['y::b::{}'.format(n) for n in range(30)])
+        s.denormalized.tag_add(Tag.get('y::b::0'))
+        y = Tag.get('y::b')
+        with CaptureQueriesContext(connection) as ctx2: y.move('z::b')
+        s.assertEqual( len(ctx2.captured_queries), len(ctx.captured_queries) )
+            # the number of queries does not depend on the size of the subtree
+        s.assertEqual( len(Tag.get('z::b').children), 30 )
+
+        moved = moved.move('b')
+        s.assertEqual( (moved.depth, moved.parent.tag, Tag.get('b::d').depth), (1, '', 2) )
+        s.assertEqual( Tag.get('mv::e').rename('f'), Tag.get('mv::f') )
+        s.assertEqual( Tag.get('b').rename('g').tag, 'g' )
+        s.assertEqual( s.tagstrs(s.items[0]), ['g::c'] )
+
+    def test_merge(s):
+        """moving onto existing tags merges them"""
+        Tag.get_many(['lang::py::django', 'lang::py::numpy', 'lang::python::django', 'lang::python::flask'])
+        py, python = Tag.get('lang::py'), Tag.get('lang::python')
+        d0, d1, d2, d3 = s.items
+        d0.tag_add(py)
+        d1.tag_add(py)
+        d1.tag_add(python)
+        d2.tag_add(Tag.get('lang::py::django'))
+        d3.tag_add(Tag.get('lang::py::numpy'))
+        s.denormalized.tag_add(py)
+
+        s.assertEqual( py.move('lang::python'), python )
+        s.assertEqual( Tag.get_if_exists('lang::py'), None )
+        s.assertEqual( Tag.objects.filter(_tag__startswith='lang::py::').count(), 0 )
+        s.assertEqual( sorted(t.tag for t in python.direct_children), ['lang::python::django', 'lang::python::flask', 'lang::python::numpy'] )
+        s.assertEqual( Tag.get('lang::python::numpy').parent, python )
+        s.assertEqual( (Tag.get('lang')._child_count, Tag.get('lang::python')._child_count), (1, 3) )
+        s.assertEqual( [s.tagstrs(d) for d in s.items],
+            [['lang::python'], ['lang::python'], ['lang::python::django'], ['lang::python::numpy']] )
+        s.assertEqual( _DenormalizedDummy.objects.get(id=s.denormalized.id)._tags_str, 'lang::python' )
+
+    def test_merge_fallback(s):
+        """merging uses `delete` if other models refer to tags"""
+        Tag.get_many(['fb::a::x', 'fb::b'])
+        deleted = []
+        def receiver(sender, instance, **kwargs): deleted.append(instance.tag)
+        post_delete.connect(receiver, sender=Tag)
+        try:
+            with mock.patch.object(Tag, '_raw_delete_safe', classmethod(lambda cls: False)):
+                Tag.get('fb::a').merge_into('fb::b')
+        finally: post_delete.disconnect(receiver, sender=Tag)
+        s.assertEqual( deleted, ['fb::a'] )
+        s.assertEqual( Tag.get('fb::b::x').parent.tag, 'fb::b' )
+        s.assertTrue( Tag._raw_delete_safe() )
+            # only the test models refer to tags
+
+    def test_errors(s):
+        """moves that are not possible"""
+        tag = Tag.get('err::a::b')
+        with s.assertRaises(TagMoveError): tag.move('err::a::b::c')
+        with s.assertRaises(TagMoveError): tag.move('err::a')
+        with s.assertRaises(TagMoveError): tag.move('')
+        with s.assertRaises(TagMoveError): tag.rename('x::y')
+        s.assertEqual( tag.move('err::a::b'), tag )
+
+    def test_merge_into(s):
+        """merging a tag into another one, keeping aliases"""
+        py, python = Tag.get('mi::py'), Tag.get('mi::python')
+        Tag.get('mi::py::django')
+        d0, d1 = s.items[:2]
+        d0.tag_add(py)
+        d1.tag_add(py)
+        d1.tag_add(python)
+        s.assertEqual( py.merge_into(python, alias=True), python )
+        s.assertEqual( _Dummy.tagged_as(python, False, as_queryset=False), {d0, d1} )
+        s.assertEqual( TagAlias.objects.get(_alias='mi::py')._tag, python )
+        s.assertEqual( TagAlias.objects.get(_alias='mi::py::django')._tag, Tag.get('mi::python::django') )
+
+        s.assertEqual( Tag.get('mi::python').merge_into('mi::lang').tag, 'mi::lang' )
+            # the target is created, and the aliases are moved along
+        s.assertEqual( TagAlias.objects.get(_alias='mi::py')._tag, Tag.get('mi::lang') )
+        s.assertEqual( TagAlias.objects.filter(_alias='mi::python').count(), 0 )
+            # aliases are only created if asked for (or if `Tag.aliases`)
+
+    def test_aliases(s):
+        """resolving aliases in get and get_many"""
+        Tag.get('al::py').merge_into('al::python', alias=True)
+        python = Tag.get('al::python')
+        try:
+            Tag.aliases = True
+            s.assertEqual( Tag.get('al::py'), python )
+            s.assertEqual( Tag.get_if_exists('al::py'), None )
+            with s.assertNumQueries(3):
+                tags = Tag.get_many(['al::py', 'al::python'])
+                    # one query for the tags, one for the aliases, one for the tags they stand for
+            s.assertEqual( tags, {'al::py': python, 'al::python': python} )
+            s.assertEqual( Tag.get_many(['al::py', 'al2::py'])['al2::py'].tag, 'al2::py' )
+            s.assertEqual( Tag.get_many(['al::py::x'])['al::py::x'].parent.tag, 'al::py' )
+                # the alias is not resolved for the tags below, so al::py is created
+            s.assertEqual( Tag.get('al::py').tag, 'al::py' )
+                # tags that exist take precedence
+
+            Tag.get('al::b').merge_into('al::c')
+            Tag.cache = TagCache()
+            Tag.get('al::b')
+            with s.assertNumQueries(1): s.assertEqual( Tag.get('al::b').tag, 'al::c' )
+                # aliases are cached (the query checks that there is no such tag)
+            Tag.get('al::c').delete()
+            s.assertEqual( Tag.get('al::b').tag, 'al::b' )
+
+            Tag.get('al::d').merge_into('al::e')
+            s.assertEqual( Tag.get('al::d').tag, 'al::e' )
+            Tag.create_no_checks('al::d', Tag.get('al'))
+            s.assertEqual( Tag.get('al::d').tag, 'al::d' )
+                # a tag created with the name of a cached alias takes precedence
+            Tag.get('al::f'), Tag.get('al::f')
+            misses = Tag.cache.stats['misses']
+            Tag.get('al::f')
+            s.assertEqual( Tag.cache.stats['misses'], misses )
+                # no alias lookup for tags that exist
+
+            Tag.get('al::g').merge_into('al::h')
+            s.assertEqual( Tag.get('al::x').move('al::g::x').parent.tag, 'al::g' )
+                # the new parent is created rather than resolved as an alias
+        finally:
+            Tag.aliases = False
+            Tag.cache = None
+
+    def test_has_tag_aliases(s):
+        """resolving aliases in has_tag"""
+        item = _Dummy.objects.create(title='aliased')
+        item.tag_add('ha::old')
+        Tag.get('ha::old').merge_into('ha::new', alias=True)
+        s.assertFalse( item.has_tag('ha::old') )
+        try:
+            Tag.aliases = True
+            with s.assertNumQueries(1): s.assertTrue( item.has_tag('ha::old') )
+            s.assertTrue( item.has_tag('ha::new') )
+            s.assertFalse( item.has_tag('ha::other') )
+            prefetched = _Dummy.objects.filter(id=item.id).with_tags()[0]
+            s.assertTrue( prefetched.has_tag('ha::old') )
+
+            Tag.create_no_checks('ha::old', Tag.get('ha'))
+            s.assertFalse( item.has_tag('ha::old') )
+            s.assertFalse( prefetched.has_tag('ha::old') )
+                # tags that exist take precedence
+        finally:
+            Tag.aliases = False
+
+    def test_raw_delete(s):
+        """the private Django API that `deltag` and `move` rely on"""
+        s.assertTrue( hasattr(QuerySet, '_raw_delete'), 'QuerySet._raw_delete has gone; deltag and move need updating' )
+        s.assertEqual( list(inspect.signature(QuerySet._raw_delete).parameters), ['self', 'using'] )
+        Tag.get_many(['raw::a', 'raw::b'])
+        deleted = []
+        def receiver(sender, instance, **kwargs): deleted.append(instance)
+        post_delete.connect(receiver, sender=Tag)
+        try:
+            qs = Tag.objects.filter(_tag__in=['raw::a', 'raw::b'])
+            s.assertEqual( qs._raw_delete(qs.db), 2 )
+                # returns the number of rows deleted
+        finally: post_delete.disconnect(receiver, sender=Tag)
+        s.assertEqual( deleted, [] )
+            # and sends no signals
+        Tag.tags_changed()
+
+    def test_deltag(s):
+        """deleting a subtree with set-based statements"""
+        Tag.get_many(['del::a::b', 'del::a::c', 'del::d'])
+        Tag.get('del::x').merge_into('del::a::c', alias=True)
+        d0, d1 = s.items[:2]
+        d0.tag_add(Tag.get('del::a::b'))
+        d0.tag_add(Tag.get('del::d'))
+        d1.tag_add(Tag.get('del::a'))
+        d1.tag_add(Tag.get('del::a::c'))
+        s.denormalized.tag_add(Tag.get('del::a::b'))
+        Tag.cache = TagCache()
+        try:
+            Tag.get('del::a::b')
+            with s.assertNumQueries(11):
+                result = Tag.deltag('del::a')
+                    # savepoint, parent, relations of two models (plus, for the denormalized one, the items
+                    # before and their tags after, and the update), aliases, tags, parent recount, release
+            s.assertEqual( result, (8, {
+                'tag.Tag': 3, 'tag.TagAlias': 1,
+                'tag._Dummy__tag_references': 3, 'tag._DenormalizedDummy__tag_references': 1,
+            }) )
+            s.assertEqual( Tag.get_if_exists('del::a::b'), None )
+            s.assertEqual( Tag.get('del')._child_count, 1 )
+            s.assertEqual( [s.tagstrs(d) for d in (d0, d1)], [['del::d'], []] )
+            s.assertEqual( _DenormalizedDummy.objects.get(id=s.denormalized.id)._tags_str, '' )
+        finally:
+            Tag.cache = None
+
+        with s.assertNumQueries(0): s.assertEqual( Tag.deltag(''), (0, {}) )
+        s.assertEqual( Tag.deltag('del::nonexisting'), (0, {}) )
+        s.assertEqual( Tag.get_if_exists('del::nonexisting'), None )
+        s.assertEqual( Tag.get('del').delete_subtree(), (3, {'tag.Tag': 2, 'tag._Dummy__tag_references': 1}) )
+        s.assertEqual( Tag.objects.filter(_tag__startswith='del').count(), 0 )
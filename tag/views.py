@@ -1,3 +1,29 @@
-from django.shortcuts import render
+"""
+views for the `tag` app
 
-# Create your views here.
+Copyright (c) Stefan LOESCH, oditorium 2016. All rights reserved.
+Licensed under the Mozilla Public License, v. 2.0 <https://mozilla.org/MPL/2.0/>
+"""
+from django.conf import settings
+from django.http import JsonResponse, Http404
+
+from .models.tag import Tag
+
+
+def instrumentation(request):
+    """
+    debug view returning the instrumentation registry (see `Instrumentation`) as JSON
+
+    NOTES
+    - only available if `DEBUG` is set or for staff users (404 otherwise)
+    - a POST request resets the registry
+
+    USAGE (urls.py)
+        from tag.views import instrumentation
+        url(r'^tag/instrumentation/$', instrumentation),
+    """
+    user = getattr(request, 'user', None)
+    if not settings.DEBUG and not (user and user.is_staff): raise Http404
+    if Tag.instrumentation == None: return JsonResponse({'enabled': False, 'operations': {}})
+    if request.method == 'POST': Tag.instrumentation.registry.reset()
+    return JsonResponse({'enabled': True, 'operations': Tag.instrumentation.registry.stats})